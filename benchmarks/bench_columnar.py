@@ -0,0 +1,80 @@
+"""
+This file benchmarks the summary backends against each other.
+It loads generated transactions into a fresh SQLite database, builds the Parquet dataset from
+it and times single user summaries over a whole year and over a partial month and a half,
+and a batch summary of every user for one quarter, on both backends.
+Run it with: python benchmarks/bench_columnar.py [rows]   (needs pyarrow)
+"""
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import columnar
+import datagen
+import ingest
+import models
+import summary
+
+# Number of single user summaries timed for each range
+QUERIES = 200
+
+RANGES = {
+    "year": (datetime(2024, 1, 1), datetime(2024, 12, 31, 23, 59, 59)),
+    "partial": (datetime(2024, 3, 10, 12, 0), datetime(2024, 4, 25, 6, 0)),
+}
+BATCH_RANGE = (datetime(2024, 4, 1), datetime(2024, 6, 30, 23, 59, 59))
+
+
+# This returns the average time of calling query once per user, in milliseconds
+def time_queries(query, user_ids) -> float:
+    started = time.perf_counter()
+    for user_id in user_ids:
+        query(user_id)
+    return (time.perf_counter() - started) / len(user_ids) * 1000
+
+
+# This loads the rows, builds the dataset and prints the time of each summary on both backends
+def run(rows: int) -> None:
+    frame = datagen.generate(rows)
+    user_ids = np.random.default_rng(1).choice(frame["user_id"].unique(), QUERIES).tolist()
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{directory}/bench.db")
+        models.base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        root = f"{directory}/dataset"
+
+        started = time.perf_counter()
+        ingest.bulk_upsert(db, frame)
+        db.commit()
+        print(f"sqlite load:      {time.perf_counter() - started:8.2f}s")
+        started = time.perf_counter()
+        columnar.rebuild(db, root)
+        print(f"parquet build:    {time.perf_counter() - started:8.2f}s")
+
+        for name, (start_date, end_date) in RANGES.items():
+            sqlite_ms = time_queries(lambda user_id: summary.get_CSV_summary(db, user_id, start_date, end_date), user_ids)
+            parquet_ms = time_queries(lambda user_id: columnar.get_CSV_summary(user_id, start_date, end_date, root), user_ids)
+            print(f"{name + ' summary:':17} sqlite {sqlite_ms:8.2f}ms  parquet {parquet_ms:8.2f}ms")
+
+        started = time.perf_counter()
+        summary.get_batch_summary(db, None, *BATCH_RANGE)
+        sqlite_s = time.perf_counter() - started
+        started = time.perf_counter()
+        columnar.get_batch_summary(None, *BATCH_RANGE, root)
+        parquet_s = time.perf_counter() - started
+        print(f"all users batch:  sqlite {sqlite_s * 1000:8.2f}ms  parquet {parquet_s * 1000:8.2f}ms")
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,107 @@
+"""
+This file benchmarks the streaming export endpoint, GET /transactions/export.
+It fills a SQLite database in a temporary directory, starts the API with uvicorn against it and
+exports every transaction once in each format (and as gzip compressed CSV), each from a newly
+started server. For each export it prints the time to the first byte, the total time, the rows
+per second, the bytes sent and how much the server's peak memory grew while it was streaming.
+The growth includes the SQLite page cache and the pages of the database file read through
+mmap (SQLITE_MMAP_SIZE), run it with SQLITE_MMAP_SIZE=0 to see the memory the export itself uses.
+Run it with: python benchmarks/bench_export.py [rows]   (arrow needs pyarrow)
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import datagen
+import ingest
+import models
+
+PORT = 8766
+
+EXPORTS = [("csv", None), ("csv", "gzip"), ("ndjson", None), ("arrow", None)]
+
+
+# This returns a memory figure of a process in MB from /proc, VmRSS for now or VmHWM for the peak
+def memory_mb(pid: int, field: str) -> float:
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith(field + ":"):
+            return int(line.split()[1]) / 1024
+    return 0.0
+
+
+# This starts the API in a subprocess and waits until it answers
+def start_server(database_url: str) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT), "--log-level", "critical"],
+        cwd=ROOT, env=dict(os.environ, DATABASE_URL=database_url),
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{PORT}/summary/cache/stats")
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("The server did not start")
+
+
+# This streams one export and returns its time to first byte, total time, bytes and the server's memory growth
+def measure(server: subprocess.Popen, format: str, compression) -> dict:
+    params = {"start_date": "2000-01-01", "end_date": "2100-01-01", "format": format}
+    if compression:
+        params["compression"] = compression
+    resident = memory_mb(server.pid, "VmRSS")
+    first_byte = None
+    size = 0
+    started = time.perf_counter()
+    with httpx.stream("GET", f"http://127.0.0.1:{PORT}/transactions/export", params=params, timeout=600) as response:
+        response.raise_for_status()
+        for chunk in response.iter_raw():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)
+    return {
+        "ttfb_ms": first_byte * 1000,
+        "total_s": time.perf_counter() - started,
+        "bytes": size,
+        "memory_mb": memory_mb(server.pid, "VmHWM") - resident,
+    }
+
+
+def run(rows: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{directory}/bench.db"
+        engine = create_engine(database_url)
+        models.base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        ingest.bulk_upsert(db, datagen.generate(rows))
+        db.commit()
+        db.close()
+        engine.dispose()
+
+        print(f"{rows:,} rows       first byte    total      rows/s       size   memory")
+        for format, compression in EXPORTS:
+            server = start_server(database_url)
+            try:
+                result = measure(server, format, compression)
+            finally:
+                server.terminate()
+                server.wait()
+            name = format + ("+gzip" if compression else "")
+            print(f"{name:14} {result['ttfb_ms']:9.1f}ms {result['total_s']:7.2f}s {rows / result['total_s']:10,.0f} "
+                  f"{result['bytes'] / 1024 / 1024:8.1f}MB {result['memory_mb']:6.1f}MB")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,73 @@
+"""
+This file benchmarks the bulk ingestion path used by POST /upload/.
+It generates a CSV of transactions with datagen.py, parses it the same way
+the endpoint does and times the upsert into a fresh SQLite database, then times loading the
+same rows again (all unchanged), with a tenth of the amounts changed, and the whole file again
+through ingest_csv (recognised from its digest), with the bytes each load adds to the database and WAL.
+Run it with: python benchmarks/bench_ingest.py [rows]
+"""
+import io
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import datagen
+import ingest
+import models
+
+
+# This returns the bytes used by the database file and its WAL
+def database_bytes(directory: str) -> int:
+    return sum(path.stat().st_size for path in Path(directory).glob("bench.db*"))
+
+
+# This times parsing and a cold load, then the reloads described above
+def run(rows: int) -> None:
+    csv_text = datagen.generate(rows).to_csv(index=False)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{directory}/bench.db")
+        models.base.metadata.create_all(bind=engine)
+        session = sessionmaker(bind=engine)
+
+        started = time.perf_counter()
+        frame = pd.read_csv(io.StringIO(csv_text))
+        frame["timestamp"] = pd.to_datetime(frame["timestamp"])
+        parsed = time.perf_counter()
+        print(f"parse:        {parsed - started:7.2f}s")
+
+        changed = frame.copy()
+        changed.loc[changed.index % 10 == 0, "transaction_amount"] += 1.0
+        loads = [
+            ("cold load:", lambda db: ingest.bulk_upsert(db, frame, counts=counts)),
+            ("re-load:", lambda db: ingest.bulk_upsert(db, frame, counts=counts)),
+            ("10% changed:", lambda db: ingest.bulk_upsert(db, changed, counts=counts)),
+            ("csv:", lambda db: ingest.ingest_csv(db, io.BytesIO(csv_text.encode()))),
+            ("same csv:", lambda db: ingest.ingest_csv(db, io.BytesIO(csv_text.encode()))),
+        ]
+        for label, load in loads:
+            counts = ingest.MergeCounts()
+            size = database_bytes(directory)
+            db = session()
+            started = time.perf_counter()
+            result = load(db)
+            db.commit()
+            elapsed = time.perf_counter() - started
+            db.close()
+            if isinstance(result, ingest.IngestResult):
+                counts = result
+            print(f"{label:13} {elapsed:7.2f}s  {rows / elapsed:12,.0f} rows/s  "
+                  f"+{(database_bytes(directory) - size) / 1024 / 1024:6.1f}MB  "
+                  f"inserted {counts.inserted} updated {counts.updated} unchanged {counts.unchanged}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,63 @@
+"""
+This file benchmarks parsing a large upload on one core and on several.
+It writes a CSV of transactions made by datagen.py to a temporary file, then times
+reading and validating it with pd.read_csv in chunks and with the csvparse worker pool at
+different worker counts, without writing to a database.
+Run it with: python benchmarks/bench_parse.py [rows] [worker counts, e.g. 1,2,4,8]
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import csvparse
+import datagen
+import ingest
+import validation
+
+
+# This reads every chunk from the reader, validates it and returns the rows read
+def consume(reader) -> int:
+    rows = 0
+    duplicates = validation.DuplicateTracker()
+    for chunk in reader:
+        rows += len(validation.validate_transactions(chunk, duplicates))
+    return rows
+
+
+# This times the sequential reader, then the worker pool with each worker count
+def run(rows: int, worker_counts: list) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "upload.csv"
+        datagen.write_csv(path, rows)
+        size_mb = path.stat().st_size / 1024 / 1024
+
+        started = time.perf_counter()
+        with open(path, "rb") as source:
+            consume(pd.read_csv(source, chunksize=ingest.UPLOAD_CHUNK_ROWS))
+        elapsed = time.perf_counter() - started
+        print(f"pandas chunks:      {elapsed:7.2f}s  {size_mb / elapsed:7.1f} MB/s")
+
+        for workers in worker_counts:
+            csvparse.PARSE_WORKERS = workers
+            csvparse._pool = None
+            with open(path, "rb") as source:
+                # The pool is started before timing, so process start up is not counted
+                csvparse._parse_pool().submit(int).result()
+                started = time.perf_counter()
+                consume(csvparse.parse_in_parallel(source, ingest.UPLOAD_CHUNK_ROWS))
+                elapsed = time.perf_counter() - started
+            csvparse._pool.shutdown()
+            print(f"{workers} parse workers: {elapsed:8.2f}s  {size_mb / elapsed:7.1f} MB/s  ({csvparse.CSV_ENGINE} engine)")
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000,
+        [int(count) for count in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 2, 4, 8],
+    )
@@ -0,0 +1,123 @@
+"""
+This file benchmarks the transactions stored in one table against monthly partitions.
+For each setting it loads the same generated transactions (a year of them) into a fresh SQLite
+database (in a separate process, because partitioning is chosen when storage.py is imported)
+and prints the load time, the average time of a single user summary over a partial month and a
+half and of a whole year aggregated from the raw transactions, and the time taken to remove
+the oldest RETENTION_DROP_MONTHS months: a DELETE of their rows, rollups and sketches from the
+single table, or partitions.drop_before with monthly partitions.
+Run it with: python benchmarks/bench_partitions.py [rows]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+# Number of single user summaries timed for each query
+QUERIES = 200
+
+# Number of the oldest months removed in the retention measurement
+RETENTION_DROP_MONTHS = 3
+
+PARTIAL_RANGE = (datetime(2024, 3, 10, 12, 0), datetime(2024, 4, 25, 6, 0))
+YEAR_RANGE = (datetime(2024, 1, 1), datetime(2024, 12, 31, 23, 59, 59))
+
+
+# This returns the average time of calling query once per user, in milliseconds
+def time_queries(query, user_ids) -> float:
+    started = time.perf_counter()
+    for user_id in user_ids:
+        query(user_id)
+    return (time.perf_counter() - started) / len(user_ids) * 1000
+
+
+# This removes the months before cutoff (e.g. 202404) the way a single table has to, row by row
+def delete_before(db, cutoff: int) -> None:
+    from sqlalchemy import text
+    import partitions
+
+    first_day = partitions.first_day(cutoff)
+    db.execute(text("DELETE FROM transactions WHERE timestamp < :first_day"), {"first_day": datetime.combine(first_day, datetime.min.time())})
+    db.execute(text("DELETE FROM daily_rollups WHERE day < :first_day"), {"first_day": first_day})
+    db.execute(text("DELETE FROM amount_sketches WHERE month < :first_day"), {"first_day": first_day})
+
+
+# This loads and measures one setting, it runs in a process started with TRANSACTION_PARTITIONS set
+def measure(rows: int) -> dict:
+    import numpy as np
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import datagen
+    import ingest
+    import models
+    import partitions
+    import storage
+    import summary
+
+    frame = datagen.generate(rows)
+    user_ids = np.random.default_rng(1).choice(frame["user_id"].unique(), QUERIES).tolist()
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/bench.db"
+        engine = create_engine(f"sqlite:///{path}")
+        models.base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+
+        started = time.perf_counter()
+        ingest.bulk_upsert(db, frame)
+        db.commit()
+        load_s = time.perf_counter() - started
+        del frame
+
+        result = {
+            "partitions": storage.TRANSACTION_PARTITIONS,
+            "load_s": load_s,
+            "partial_ms": time_queries(lambda user_id: summary.get_CSV_summary(db, user_id, *PARTIAL_RANGE), user_ids),
+            "raw_year_ms": time_queries(lambda user_id: summary._raw_aggregate(db, user_id, *YEAR_RANGE), user_ids),
+        }
+
+        cutoff = partitions.add_months(partitions.month_of(datagen.START), RETENTION_DROP_MONTHS)
+        started = time.perf_counter()
+        if partitions.ENABLED:
+            partitions.drop_before(db, cutoff)
+        else:
+            delete_before(db, cutoff)
+        db.commit()
+        result["retention_s"] = time.perf_counter() - started
+        result["file_bytes"] = os.path.getsize(path)
+        db.close()
+        engine.dispose()
+    return result
+
+
+# This runs both settings and prints them side by side
+def run(rows: int) -> None:
+    results = {}
+    for setting in ("none", "monthly"):
+        output = subprocess.run(
+            [sys.executable, __file__, str(rows), "--measure"],
+            env=dict(os.environ, TRANSACTION_PARTITIONS=setting), capture_output=True, text=True, check=True,
+        ).stdout
+        results[setting] = json.loads(output.splitlines()[-1])
+
+    single, monthly = results["none"], results["monthly"]
+    print(f"{rows:,} rows                 one table    monthly")
+    print(f"load:                   {single['load_s']:8.2f}s   {monthly['load_s']:8.2f}s")
+    for name in ("partial_ms", "raw_year_ms"):
+        print(f"{name[:-3] + ' summary:':22} {single[name]:8.2f}ms  {monthly[name]:8.2f}ms")
+    print(f"drop {RETENTION_DROP_MONTHS} months:          {single['retention_s']:8.3f}s   {monthly['retention_s']:8.3f}s")
+    print(f"database file:          {single['file_bytes'] / 1024 / 1024:7.1f}MB   {monthly['file_bytes'] / 1024 / 1024:7.1f}MB")
+
+
+if __name__ == "__main__":
+    if "--measure" in sys.argv:
+        print(json.dumps(measure(int(sys.argv[1]))))
+    else:
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
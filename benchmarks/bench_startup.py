@@ -0,0 +1,139 @@
+"""
+This file benchmarks how long the API takes from a cold start to its first summary.
+It fills a SQLite database in a temporary directory and, for each startup setting, measures
+  import_main    importing main.py in a new Python process
+  cold_start     starting uvicorn until the first GET /summary/{user_id} has been answered
+  first_summary  that first summary request on its own, once the server accepts connections
+  warm_summary   the median of the summary requests after it
+with the database prepared by the server at startup (the default), prepared beforehand
+(DATABASE_SETUP_ON_STARTUP=false) and prepared beforehand with DATABASE_PREWARM=true.
+Each setting is started STARTS times and the medians are printed. benchmarks/suite.py tracks
+the default setting against its baseline with measure.
+Run it with: python benchmarks/bench_startup.py [rows]
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+PORT = 8767
+
+# Number of times each setting is started, the medians are kept
+STARTS = 5
+
+# Number of summary requests timed after the first one
+WARM_REQUESTS = 20
+
+SETTINGS = {
+    "setup at startup": {},
+    "setup beforehand": {"DATABASE_SETUP_ON_STARTUP": "false"},
+    "prewarmed": {"DATABASE_SETUP_ON_STARTUP": "false", "DATABASE_PREWARM": "true"},
+}
+
+IMPORT_MAIN = "import time; started = time.perf_counter(); import main; print((time.perf_counter() - started) * 1000)"
+
+
+# This returns the time taken to import main.py in a new process, in milliseconds
+def import_main_ms(env: dict) -> float:
+    output = subprocess.run([sys.executable, "-c", IMPORT_MAIN], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.splitlines()[-1])
+
+
+# This waits until the server accepts connections, which uvicorn does once the lifespan startup is done
+def wait_for_port(server: subprocess.Popen, timeout: float = 120) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited while starting")
+        try:
+            socket.create_connection(("127.0.0.1", PORT), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.005)
+    raise RuntimeError("The server did not start")
+
+
+"""
+This function starts the API once with the given environment and returns its startup timings in milliseconds.
+The summaries are for user_id over params' dates (by default most of the generated year), with
+the summary cache off so every request reaches the database.
+"""
+def measure(env: dict, user_id: int, params: dict = None) -> dict:
+    env = dict(env, SUMMARY_CACHE_ENTRIES="0")
+    params = params or {"start_date": "2024-01-01T12:00:00", "end_date": "2024-12-20T12:00:00"}
+    result = {"import_main_ms": import_main_ms(env)}
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT), "--log-level", "critical"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(server)
+        with httpx.Client(base_url=f"http://127.0.0.1:{PORT}") as client:
+            first = time.perf_counter()
+            client.get(f"/summary/{user_id}", params=params).raise_for_status()
+            done = time.perf_counter()
+            result["cold_start_ms"] = (done - started) * 1000
+            result["first_summary_ms"] = (done - first) * 1000
+            latencies = []
+            for _ in range(WARM_REQUESTS):
+                request_started = time.perf_counter()
+                client.get(f"/summary/{user_id}", params=params).raise_for_status()
+                latencies.append((time.perf_counter() - request_started) * 1000)
+            result["warm_summary_ms"] = float(np.median(latencies))
+    finally:
+        server.terminate()
+        server.wait()
+    return result
+
+
+# This starts the API STARTS times and returns the median of each timing
+def median_of_starts(env: dict, user_id: int, params: dict = None) -> dict:
+    runs = [measure(env, user_id, params) for _ in range(STARTS)]
+    return {name: float(np.median([run[name] for run in runs])) for name in runs[0]}
+
+
+def run(rows: int) -> None:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import datagen
+    import ingest
+    import models
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{directory}/bench.db"
+        engine = create_engine(database_url)
+        models.base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        frame = datagen.generate(rows)
+        user_id = int(frame["user_id"].iloc[0])
+        ingest.bulk_upsert(db, frame)
+        db.commit()
+        db.close()
+        engine.dispose()
+        del frame
+
+        env = dict(os.environ, DATABASE_URL=database_url)
+        env.pop("DATABASE_READ_URL", None)
+        # Prepares the database once, as a deployment does before starting its servers
+        subprocess.run([sys.executable, "startup.py"], cwd=ROOT, env=env, check=True, capture_output=True)
+
+        print(f"{rows:,} rows            import main   cold start   first summary   warm summary")
+        for name, setting in SETTINGS.items():
+            result = median_of_starts(dict(env, **setting), user_id)
+            print(f"{name:22} {result['import_main_ms']:9.0f}ms {result['cold_start_ms']:10.0f}ms "
+                  f"{result['first_summary_ms']:13.1f}ms {result['warm_summary_ms']:12.1f}ms")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
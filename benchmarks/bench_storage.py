@@ -0,0 +1,112 @@
+"""
+This file benchmarks the standard and compact storage layouts of the transactions table.
+For each layout it loads the same generated transactions into a fresh SQLite database (in a
+separate process, because the layout is chosen when models.py is imported) and prints the load
+time, the size of the database and of each table and index, and the average time of a single
+user summary over a partial month and a half, of the same summary with stats, and of a whole
+year aggregated straight from the transactions table (the read the rollup normally saves).
+The index or table a summary reads is the part of the database that has to stay in the page
+cache for summaries to be fast, so its size is printed as the summary working set.
+Run it with: python benchmarks/bench_storage.py [rows]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+# Number of single user summaries timed for each query
+QUERIES = 200
+
+PARTIAL_RANGE = (datetime(2024, 3, 10, 12, 0), datetime(2024, 4, 25, 6, 0))
+YEAR_RANGE = (datetime(2024, 1, 1), datetime(2024, 12, 31, 23, 59, 59))
+
+# The b-tree each layout answers the raw summary query from
+SUMMARY_BTREE = {"standard": "ix_transactions_user_id_timestamp_amount", "compact": "transactions"}
+
+
+# This returns the average time of calling query once per user, in milliseconds
+def time_queries(query, user_ids) -> float:
+    started = time.perf_counter()
+    for user_id in user_ids:
+        query(user_id)
+    return (time.perf_counter() - started) / len(user_ids) * 1000
+
+
+# This loads and measures one layout, it runs in a process started with TRANSACTION_STORAGE set
+def measure(rows: int) -> dict:
+    import numpy as np
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import datagen
+    import ingest
+    import models
+    import storage
+    import summary
+
+    frame = datagen.generate(rows)
+    user_ids = np.random.default_rng(1).choice(frame["user_id"].unique(), QUERIES).tolist()
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/bench.db"
+        engine = create_engine(f"sqlite:///{path}")
+        models.base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+
+        started = time.perf_counter()
+        ingest.bulk_upsert(db, frame)
+        db.commit()
+        load_s = time.perf_counter() - started
+        del frame
+
+        btrees = dict(db.connection().exec_driver_sql("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall())
+        result = {
+            "layout": storage.TRANSACTION_STORAGE,
+            "load_s": load_s,
+            "file_bytes": os.path.getsize(path),
+            "btrees": {name: size for name, size in btrees.items() if "transactions" in name},
+            "working_set_bytes": btrees[SUMMARY_BTREE[storage.TRANSACTION_STORAGE]],
+            "partial_ms": time_queries(lambda user_id: summary.get_CSV_summary(db, user_id, *PARTIAL_RANGE), user_ids),
+            "stats_ms": time_queries(
+                lambda user_id: summary.get_summary_statistics(db, user_id, *PARTIAL_RANGE, stats=True), user_ids),
+            "raw_year_ms": time_queries(lambda user_id: summary._raw_aggregate(db, user_id, *YEAR_RANGE), user_ids),
+        }
+        db.close()
+        engine.dispose()
+    return result
+
+
+# This runs both layouts and prints them side by side
+def run(rows: int) -> None:
+    results = {}
+    for layout in ("standard", "compact"):
+        output = subprocess.run(
+            [sys.executable, __file__, str(rows), "--measure"],
+            env=dict(os.environ, TRANSACTION_STORAGE=layout), capture_output=True, text=True, check=True,
+        ).stdout
+        results[layout] = json.loads(output.splitlines()[-1])
+
+    mb = 1024 * 1024
+    standard, compact = results["standard"], results["compact"]
+    print(f"{rows:,} rows                 standard     compact")
+    print(f"load:                   {standard['load_s']:8.2f}s   {compact['load_s']:8.2f}s")
+    print(f"database file:          {standard['file_bytes'] / mb:7.1f}MB   {compact['file_bytes'] / mb:7.1f}MB")
+    print(f"summary working set:    {standard['working_set_bytes'] / mb:7.1f}MB   {compact['working_set_bytes'] / mb:7.1f}MB")
+    for name in ("partial_ms", "stats_ms", "raw_year_ms"):
+        print(f"{name[:-3] + ' summary:':22} {standard[name]:8.2f}ms  {compact[name]:8.2f}ms")
+    for layout, result in results.items():
+        sizes = ", ".join(f"{name} {size / mb:.1f}MB" for name, size in sorted(result["btrees"].items()))
+        print(f"{layout}: {sizes}")
+
+
+if __name__ == "__main__":
+    if "--measure" in sys.argv:
+        print(json.dumps(measure(int(sys.argv[1]))))
+    else:
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,114 @@
+"""
+This file load tests GET /summary/{user_id} with the sync and the async handler.
+It fills a SQLite database in a temporary directory, starts the API with uvicorn against it
+(once with ASYNC_SUMMARIES off and once with it on, with the summary cache turned off so every
+request reaches the database) and sends requests from 1, 50 and 500 concurrent clients.
+It prints the successful requests per second, the p50/p99 latency and the failed requests of each run.
+Run it with: python benchmarks/bench_summary_load.py [rows] [requests per run]   (needs aiosqlite)
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import datagen
+import ingest
+import models
+
+CONCURRENCY = [1, 50, 500]
+PORT = 8765
+
+
+# This sends requests from the given number of concurrent clients
+# It returns the latency of every successful request in seconds, the number of failed requests and the elapsed time
+async def load(requests: int, concurrency: int, user_ids: list) -> tuple:
+    latencies = []
+    failures = 0
+    queue = asyncio.Queue()
+    for index in range(requests):
+        queue.put_nowait(user_ids[index % len(user_ids)])
+
+    async def client_loop(client):
+        nonlocal failures
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await client.get(f"/summary/{user_id}", params={"start_date": "2024-02-10T12:00:00", "end_date": "2024-09-20"})
+            except httpx.TransportError:
+                response = None
+            if response is not None and response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failures += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", limits=limits, timeout=120) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return np.array(latencies), failures, elapsed
+
+
+# This starts the API in a subprocess and waits until it answers
+def start_server(database_url: str, async_summaries: bool) -> subprocess.Popen:
+    env = dict(os.environ, DATABASE_URL=database_url, ASYNC_SUMMARIES=str(async_summaries).lower(),
+               SUMMARY_CACHE_ENTRIES="0", DATABASE_POOL_SIZE="20", DATABASE_MAX_OVERFLOW="80")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT), "--log-level", "critical"],
+        cwd=ROOT, env=env,
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{PORT}/summary/cache/stats")
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("The server did not start")
+
+
+# This fills the database, then runs every concurrency level against both handlers
+def run(rows: int, requests: int) -> None:
+    frame = datagen.generate(rows)
+    user_ids = frame["user_id"].unique().tolist()
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{directory}/bench.db"
+        engine = create_engine(database_url)
+        models.base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        ingest.bulk_upsert(db, frame)
+        db.commit()
+        db.close()
+        engine.dispose()
+
+        for async_summaries in (False, True):
+            server = start_server(database_url, async_summaries)
+            try:
+                for concurrency in CONCURRENCY:
+                    latencies, failures, elapsed = asyncio.run(load(requests, concurrency, user_ids))
+                    print(f"{'async' if async_summaries else 'sync':5} clients={concurrency:<4} "
+                          f"{len(latencies) / elapsed:8.0f} req/s  p50 {np.percentile(latencies, 50) * 1000:8.1f}ms  "
+                          f"p99 {np.percentile(latencies, 99) * 1000:8.1f}ms  failed {failures}")
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+    )
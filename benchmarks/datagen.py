@@ -0,0 +1,92 @@
+"""
+This file generates synthetic transactions for the benchmarks and for suade_generic_test.py.
+Every column is built from whole numpy arrays with a seeded generator, so the same settings
+always give the same transactions and a million rows take about a second instead of minutes.
+The row count, the number of users, how skewed the transactions are towards a few busy users
+(a Zipf exponent, 0 spreads them evenly) and the number of days they cover can all be changed.
+Rows are made in chunks of CHUNK_ROWS, so a CSV far larger than memory can be written.
+Run it with: python benchmarks/datagen.py [output.csv] [rows] [users] [skew] [days] [seed]
+"""
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+# Rows generated at a time, so writing a large CSV keeps memory bounded
+CHUNK_ROWS = 500_000
+
+# The first day transactions can fall on
+START = datetime(2024, 1, 1)
+
+HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+# Where the dashes of a UUID go among its 32 hex digits
+UUID_DASHES = [8, 12, 16, 20]
+
+
+# This turns an (n, 16) array of random bytes into n version 4 UUID strings
+def uuid4_strings(random_bytes: np.ndarray) -> np.ndarray:
+    random_bytes = random_bytes.copy()
+    random_bytes[:, 6] = (random_bytes[:, 6] & 0x0F) | 0x40
+    random_bytes[:, 8] = (random_bytes[:, 8] & 0x3F) | 0x80
+    digits = np.empty((len(random_bytes), 32), dtype=np.uint8)
+    digits[:, 0::2] = HEX_DIGITS[random_bytes >> 4]
+    digits[:, 1::2] = HEX_DIGITS[random_bytes & 0x0F]
+    text = np.insert(digits, UUID_DASHES, ord("-"), axis=1)
+    return text.view("S36").ravel().astype("U36")
+
+
+# This returns the chance of each user id (1 to users) getting a transaction
+# The ranks are shuffled, so the busiest users are spread over the ids instead of being the lowest ones
+def user_weights(users: int, skew: float, rng: np.random.Generator) -> np.ndarray:
+    weights = np.arange(1, users + 1, dtype="float64") ** -skew
+    weights = rng.permutation(weights)
+    return weights / weights.sum()
+
+
+"""
+This function yields the transactions in DataFrames of up to CHUNK_ROWS rows.
+All chunks come from one generator seeded with seed, so the rows only depend on the settings.
+The user ids run from 1 to users, the product ids from 1 to 500, the timestamps are whole
+seconds within days days from START and the amounts are between 5 and 500 with two decimals.
+"""
+def chunks(rows: int, users: int = 1000, skew: float = 0.0, days: int = 365, seed: int = 0) -> Iterator[pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    cumulative = np.cumsum(user_weights(users, skew, rng))
+    start = np.datetime64(START, "s")
+    for offset in range(0, rows, CHUNK_ROWS):
+        size = min(CHUNK_ROWS, rows - offset)
+        yield pd.DataFrame({
+            "transaction_id": uuid4_strings(rng.integers(0, 256, (size, 16), dtype=np.uint8)),
+            "user_id": np.searchsorted(cumulative, rng.random(size), side="right").clip(max=users - 1) + 1,
+            "product_id": rng.integers(1, 501, size),
+            "timestamp": start + rng.integers(0, days * 24 * 3600, size).astype("timedelta64[s]"),
+            "transaction_amount": np.round(rng.uniform(5.0, 500.0, size), 2),
+        }, index=pd.RangeIndex(offset, offset + size))
+
+
+# This returns all the transactions in one DataFrame
+def generate(rows: int, users: int = 1000, skew: float = 0.0, days: int = 365, seed: int = 0) -> pd.DataFrame:
+    return pd.concat(chunks(rows, users, skew, days, seed))
+
+
+# This writes the transactions to a CSV file one chunk at a time
+def write_csv(path, rows: int, users: int = 1000, skew: float = 0.0, days: int = 365, seed: int = 0) -> None:
+    with Path(path).open("w", newline="") as file:
+        for number, chunk in enumerate(chunks(rows, users, skew, days, seed)):
+            chunk.to_csv(file, index=False, header=number == 0)
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    write_csv(
+        arguments[0] if len(arguments) > 0 else "dummy_transactions.csv",
+        int(arguments[1]) if len(arguments) > 1 else 1_000_000,
+        int(arguments[2]) if len(arguments) > 2 else 1000,
+        float(arguments[3]) if len(arguments) > 3 else 0.0,
+        int(arguments[4]) if len(arguments) > 4 else 365,
+        int(arguments[5]) if len(arguments) > 5 else 0,
+    )
@@ -0,0 +1,291 @@
+"""
+This file runs the benchmark suite and compares it with a stored baseline.
+It writes transactions made by datagen.py to CSV files, starts the API against a new SQLite
+database in a temporary directory (with the summary cache off, so every request reaches the
+database) and measures:
+  cold_ingest         loading the CSV into the empty database, in rows per second
+  reingest            loading it again with every amount changed, so every row is updated
+  single_summary      GET /summary/{user_id} one request at a time, p50 and p99
+  batch_summary       POST /summary/batch for all users, p50 and p99
+  concurrent_summary  GET /summary/{user_id} from many clients at once, requests per second, p50 and p99
+  startup             importing main.py, and starting the API in a new process until its first
+                      summary is answered, see bench_startup.py
+(the summary scenarios are run SUMMARY_REPEATS times and the median of each metric is kept)
+and the peak memory of the process and the size of the database.
+The results are written to a JSON file and compared with the baseline: a metric that is worse
+than the baseline by more than the tolerance (and by more than its noise floor) is reported and
+the run exits with status 1. Runs are only compared when the data and scenario settings match.
+The baseline holds timings from one machine, so save a new one (--save-baseline) on the machine
+the suite is run on before comparing there.
+Run it with: python benchmarks/suite.py [--rows N] [--users N] [--skew S] [--days N] [--seed N]
+             [--output results.json] [--baseline baseline.json] [--tolerance 0.25] [--save-baseline]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import bench_startup
+import datagen
+
+BASELINE = ROOT / "benchmarks" / "baseline.json"
+
+# The number of requests each summary scenario sends, and the clients sending them concurrently
+SINGLE_REQUESTS = 300
+BATCH_REQUESTS = 20
+CONCURRENT_REQUESTS = 1000
+CONCURRENT_CLIENTS = 50
+
+# The summary scenarios are run this many times and the median of each metric is kept, as tail latencies are noisy
+SUMMARY_REPEATS = 3
+
+# A metric may be this much worse than the baseline (0.25 is 25%) before the run fails
+TOLERANCE = 0.25
+
+# Differences smaller than these are measurement noise, whatever the tolerance
+NOISE_FLOOR = {"_ms": 0.5, "_mb": 2.0, "_per_s": 0.0}
+
+
+# This returns the p50 and p99 of latencies given in seconds, in milliseconds
+def percentiles(latencies: list) -> tuple:
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    return float(p50), float(p99)
+
+
+# This returns the peak resident memory of this process in MB (ru_maxrss is in KB on Linux and bytes on macOS)
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+# This writes the transactions again with every amount changed, for the re-ingest
+def write_changed_csv(path: Path, config: dict) -> None:
+    with path.open("w", newline="") as file:
+        for number, chunk in enumerate(datagen.chunks(**datagen_settings(config))):
+            chunk["transaction_amount"] += 1.0
+            chunk.to_csv(file, index=False, header=number == 0)
+
+
+# This returns the datagen arguments of the run's settings
+def datagen_settings(config: dict) -> dict:
+    return {name: config[name] for name in ("rows", "users", "skew", "days", "seed")}
+
+
+# This returns the date range of the summary requests, with partial days at both ends
+# so summaries read both the daily rollup and the transactions table
+def summary_range(config: dict) -> dict:
+    start = datagen.START + timedelta(days=config["days"] * 0.2, hours=13)
+    end = datagen.START + timedelta(days=config["days"] * 0.7, hours=6)
+    return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+
+
+# This loads a CSV file the way POST /upload/ does and returns the seconds it took and the rows updated
+def timed_ingest(path: Path) -> tuple:
+    import database
+    import ingest
+
+    db = database.session()
+    try:
+        started = time.perf_counter()
+        with path.open("rb") as source:
+            result = ingest.ingest_csv(db, source, filename=path.name)
+        db.commit()
+        return time.perf_counter() - started, result.updated
+    finally:
+        db.close()
+
+
+# This sends the requests one at a time and returns their latencies in seconds
+async def sequential(client, requests: list) -> list:
+    latencies = []
+    for method, url, options in requests:
+        started = time.perf_counter()
+        response = await client.request(method, url, **options)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+# This sends the requests from CONCURRENT_CLIENTS clients at once
+# It returns the latencies in seconds and the seconds the whole run took
+async def concurrent(client, requests: list) -> tuple:
+    queue = list(reversed(requests))
+
+    async def client_loop():
+        latencies = []
+        while queue:
+            method, url, options = queue.pop()
+            started = time.perf_counter()
+            response = await client.request(method, url, **options)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(client_loop() for _ in range(CONCURRENT_CLIENTS)))
+    return [latency for latencies in results for latency in latencies], time.perf_counter() - started
+
+
+# This sends the summary scenarios' requests to the API in this process and adds their metrics
+async def summary_scenarios(config: dict, metrics: dict) -> None:
+    import httpx
+    from main import app
+
+    dates = summary_range(config)
+    user_ids = np.random.default_rng(config["seed"]).integers(1, config["users"] + 1, CONCURRENT_REQUESTS).tolist()
+    single = [("GET", f"/summary/{user_id}", {"params": dates}) for user_id in user_ids]
+    batch = [("POST", "/summary/batch", {"json": {"all_users": True, **dates}})] * BATCH_REQUESTS
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=600) as client:
+        # One request first, so the first timed one does not pay for opening connections
+        await sequential(client, single[:1])
+
+        metrics["single_summary_p50_ms"], metrics["single_summary_p99_ms"] = percentiles(
+            await sequential(client, single[:SINGLE_REQUESTS]))
+        metrics["batch_summary_p50_ms"], metrics["batch_summary_p99_ms"] = percentiles(await sequential(client, batch))
+
+        latencies, elapsed = await concurrent(client, single)
+        metrics["concurrent_summary_requests_per_s"] = len(latencies) / elapsed
+        metrics["concurrent_summary_p50_ms"], metrics["concurrent_summary_p99_ms"] = percentiles(latencies)
+
+
+"""
+This function runs every scenario against a new database and returns the results.
+The database and the summary cache are set with environment variables
+before the API modules are first imported, so they must not be imported earlier in this process.
+"""
+def run(config: dict) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/benchmark.db"
+        os.environ.pop("DATABASE_READ_URL", None)
+        os.environ["SUMMARY_CACHE_ENTRIES"] = "0"
+
+        upload, changed = directory / "upload.csv", directory / "changed.csv"
+        datagen.write_csv(upload, **datagen_settings(config))
+        write_changed_csv(changed, config)
+
+        import database
+        import startup
+        startup.prepare_database()
+
+        metrics = {}
+        elapsed, _ = timed_ingest(upload)
+        metrics["cold_ingest_rows_per_s"] = config["rows"] / elapsed
+        elapsed, updated = timed_ingest(changed)
+        if updated != config["rows"]:
+            raise RuntimeError(f"The re-ingest updated {updated} of {config['rows']} rows.")
+        metrics["reingest_rows_per_s"] = config["rows"] / elapsed
+
+        repeats = []
+        for _ in range(SUMMARY_REPEATS):
+            repeats.append({})
+            asyncio.run(summary_scenarios(config, repeats[-1]))
+        metrics.update({name: float(np.median([repeat[name] for repeat in repeats])) for name in repeats[0]})
+
+        started = bench_startup.median_of_starts(dict(os.environ), 1, summary_range(config))
+        metrics.update({name: started[name] for name in ("import_main_ms", "cold_start_ms", "first_summary_ms")})
+
+        with database.dbengine.begin() as connection:
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        metrics["db_size_mb"] = (directory / "benchmark.db").stat().st_size / 1024 / 1024
+        metrics["peak_rss_mb"] = peak_rss_mb()
+        database.dbengine.dispose()
+        database.reader_engine.dispose()
+
+    return {
+        "config": config,
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "metrics": metrics,
+    }
+
+
+"""
+This function compares the results with the baseline and returns a line for every regression.
+Metrics ending in _per_s are better when higher, the others (_ms and _mb) when lower.
+A metric is a regression when it is worse by more than tolerance times the baseline value and
+by more than its NOISE_FLOOR. Metrics missing from either side are not compared.
+"""
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    if results["config"] != baseline["config"]:
+        return [f"The settings {results['config']} differ from the baseline's {baseline['config']}."]
+    regressions = []
+    for name, value in results["metrics"].items():
+        before = baseline["metrics"].get(name)
+        if before is None:
+            continue
+        worse = before - value if name.endswith("_per_s") else value - before
+        floor = next(floor for suffix, floor in NOISE_FLOOR.items() if name.endswith(suffix))
+        if worse > max(abs(before) * tolerance, floor):
+            regressions.append(f"{name}: {before:,.2f} -> {value:,.2f} ({worse / before:+.0%} worse)")
+    return regressions
+
+
+# This prints the metrics next to the baseline's
+def report(results: dict, baseline: dict = None) -> None:
+    for name, value in results["metrics"].items():
+        before = baseline["metrics"].get(name) if baseline else None
+        line = f"{name:36} {value:14,.2f}"
+        if before:
+            line += f"   baseline {before:14,.2f}  {value / before - 1:+7.1%}"
+        print(line)
+
+
+# This reads the command line and returns the run's settings and options
+def parse_arguments(arguments=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the benchmark suite and compare it with a baseline.")
+    parser.add_argument("--rows", type=int, default=200_000, help="transactions to generate")
+    parser.add_argument("--users", type=int, default=10_000, help="number of distinct user ids")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of transactions per user, 0 is even")
+    parser.add_argument("--days", type=int, default=365, help="number of days the transactions cover")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated data")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"), help="where to write the results")
+    parser.add_argument("--baseline", type=Path, default=BASELINE, help="the results to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed regression, 0.25 is 25%%")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the baseline instead of comparing")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    options = parse_arguments()
+    config = {
+        "rows": options.rows, "users": options.users, "skew": options.skew, "days": options.days, "seed": options.seed,
+        "summary_repeats": SUMMARY_REPEATS, "single_requests": SINGLE_REQUESTS, "batch_requests": BATCH_REQUESTS,
+        "concurrent_requests": CONCURRENT_REQUESTS, "concurrent_clients": CONCURRENT_CLIENTS,
+    }
+    results = run(config)
+    options.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    if options.save_baseline:
+        # Notes written by hand in the old baseline, e.g. why a metric changed, are kept
+        if options.baseline.exists():
+            results = dict(results, notes=json.loads(options.baseline.read_text()).get("notes", []))
+        options.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        report(results)
+        print(f"Saved the baseline to {options.baseline}")
+        sys.exit(0)
+    if not options.baseline.exists():
+        report(results)
+        print(f"No baseline at {options.baseline}, run with --save-baseline to store one")
+        sys.exit(0)
+
+    baseline = json.loads(options.baseline.read_text())
+    report(results, baseline)
+    regressions = compare(results, baseline, options.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
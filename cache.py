@@ -0,0 +1,183 @@
+"""
+This file contains an in-process cache for summary results.
+Results are kept per (user_id, start_date, end_date) with a least recently used limit on the
+number of entries and on their approximate memory, and an optional time to live.
+Uploads evict only the entries of the user_ids they touched.
+The cache lives in one server process, so with several workers each one has its own and
+other workers only see an upload once their entries expire.
+"""
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Iterable
+
+# Maximum number of cached summaries, 0 turns the cache off
+SUMMARY_CACHE_ENTRIES = int(os.environ.get("SUMMARY_CACHE_ENTRIES", "10000"))
+
+# Maximum approximate memory used by cached summaries, in bytes
+SUMMARY_CACHE_MAX_BYTES = int(os.environ.get("SUMMARY_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# How long a cached summary is used for, in seconds, 0 keeps entries until they are evicted
+SUMMARY_CACHE_TTL_SECONDS = float(os.environ.get("SUMMARY_CACHE_TTL_SECONDS", "300"))
+
+
+# This estimates the memory used by a cached key or value, including the dicts and lists nested in it
+# such as the series of a bucket summary
+def _entry_size(*values) -> int:
+    size = 0
+    for value in values:
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(_entry_size(item, nested) for item, nested in value.items())
+        elif isinstance(value, (list, tuple)):
+            size += _entry_size(*value)
+    return size
+
+
+"""
+This class is a thread safe LRU/TTL cache whose keys start with a user_id.
+Every invalidation increases a counter, and invalidated keeps the counter value at which each
+user was last invalidated. A value computed from a generation read before its user was
+invalidated, or before the cache was cleared, is not stored, so a slow reader cannot put
+stale data back. invalidated is emptied once it tracks more users than the cache has entries,
+and that counts as a clear for the values still being computed, so it does not keep growing.
+"""
+class SummaryCache:
+    def __init__(self, max_entries: int = SUMMARY_CACHE_ENTRIES, max_bytes: int = SUMMARY_CACHE_MAX_BYTES,
+                 ttl_seconds: float = SUMMARY_CACHE_TTL_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> (value, size, expires_at)
+        self.entries: OrderedDict = OrderedDict()
+        self.keys_by_user: dict[int, set] = {}
+        # The invalidation counter, the user_id -> counter of their last invalidation, and the counter of the last clear
+        self.current_generation = 0
+        self.invalidated: dict[int, int] = {}
+        self.cleared_generation = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    # This returns the cached value for the key, or None if it is missing or expired
+    def get(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= self.clock():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # This returns the current generation, read before computing a value to store
+    def generation(self) -> int:
+        with self.lock:
+            return self.current_generation
+
+    # This stores a value unless its user was invalidated, or the cache cleared, since generation was read
+    def put(self, key: tuple, value, generation: int) -> None:
+        user_id = key[0]
+        size = _entry_size(key, value)
+        with self.lock:
+            stale = generation < self.cleared_generation or self.invalidated.get(user_id, -1) > generation
+            if not self.enabled or size > self.max_bytes or stale:
+                return
+            if key in self.entries:
+                self._remove(key)
+            expires_at = self.clock() + self.ttl_seconds if self.ttl_seconds > 0 else None
+            self.entries[key] = (value, size, expires_at)
+            self.keys_by_user.setdefault(user_id, set()).add(key)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    # This returns the cached value for the key, or computes and stores it
+    def get_or_compute(self, key: tuple, compute: Callable[[], object]):
+        if not self.enabled:
+            return compute()
+        value = self.get(key)
+        if value is None:
+            generation = self.generation()
+            value = compute()
+            self.put(key, value, generation)
+        return value
+
+    # This is get_or_compute for an async compute function, used by the async summary endpoint
+    async def get_or_compute_async(self, key: tuple, compute: Callable[[], Awaitable[object]]):
+        if not self.enabled:
+            return await compute()
+        value = self.get(key)
+        if value is None:
+            generation = self.generation()
+            value = await compute()
+            self.put(key, value, generation)
+        return value
+
+    # This evicts every entry of the given users
+    def invalidate_users(self, user_ids: Iterable[int]) -> None:
+        with self.lock:
+            self.current_generation += 1
+            for user_id in user_ids:
+                self.invalidated[user_id] = self.current_generation
+                for key in self.keys_by_user.pop(user_id, ()):
+                    self._remove(key, forget_user=False)
+                    self.invalidations += 1
+            if len(self.invalidated) > self.max_entries:
+                self.invalidated.clear()
+                self.cleared_generation = self.current_generation
+
+    # This evicts every entry, values being computed for any user are not stored
+    def clear(self) -> None:
+        with self.lock:
+            self.current_generation += 1
+            self.cleared_generation = self.current_generation
+            self.invalidated.clear()
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.keys_by_user.clear()
+            self.bytes = 0
+
+    # This returns the cache counters and current size
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    # This removes one entry, the caller must hold the lock
+    def _remove(self, key: Hashable, forget_user: bool = True) -> None:
+        value, size, expires_at = self.entries.pop(key)
+        self.bytes -= size
+        if forget_user:
+            keys = self.keys_by_user.get(key[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_user[key[0]]
+
+
+# The summary cache shared by the application
+summary_cache = SummaryCache()
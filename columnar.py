@@ -0,0 +1,395 @@
+"""
+This file keeps a columnar copy of the transactions that the summary endpoints can read from.
+With SUMMARY_BACKEND=parquet every upload also rewrites the affected users' transactions in a
+Parquet dataset laid out as user_bucket=<user_id % COLUMNAR_USER_BUCKETS>/month=<YYYY-MM>/,
+and GET /summary/{user_id} and POST /summary/batch scan only the files of the requested users'
+buckets and months, with pyarrow filtering and aggregating whole columns at a time.
+The SQLite transactions table stays the source of truth, the dataset is rebuilt from it on
+startup if it is missing, and summaries with stats or bucket are still read from SQLite.
+pyarrow is only needed when the parquet backend is turned on.
+"""
+import importlib.util
+import logging
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+import database
+import partitions
+import storage
+import summary
+
+# pyarrow is imported by load_pyarrow when the dataset is first read or written, not with this
+# file, as pyarrow.dataset also imports pandas and the sqlite backend never needs either of them
+pa = pc = ds = pq = None
+
+logger = logging.getLogger(__name__)
+
+# Where summaries are read from, sqlite (the default) or parquet
+SUMMARY_BACKEND = os.environ.get("SUMMARY_BACKEND", "sqlite")
+
+# The directory of the Parquet dataset
+COLUMNAR_PATH = os.environ.get("COLUMNAR_PATH", "./transactions_parquet")
+
+# Number of user_id buckets, each upload rewrites only the buckets of the users it touched
+COLUMNAR_USER_BUCKETS = int(os.environ.get("COLUMNAR_USER_BUCKETS", "64"))
+
+# Rows per Parquet row group, the files are sorted by user_id so row groups of other users are skipped
+ROW_GROUP_ROWS = 64_000
+
+# Number of rows fetched from SQLite at a time when the users' transactions are read
+READ_ROWS = 100_000
+
+ENABLED = SUMMARY_BACKEND == "parquet"
+
+if SUMMARY_BACKEND not in ("sqlite", "parquet"):
+    raise RuntimeError(f"Unknown SUMMARY_BACKEND {SUMMARY_BACKEND!r}, use sqlite or parquet.")
+if ENABLED and importlib.util.find_spec("pyarrow") is None:
+    raise RuntimeError("SUMMARY_BACKEND=parquet needs pyarrow, install it with pip install pyarrow.")
+
+
+# This imports pyarrow into this file's globals the first time it is called
+# pa is set last, so a thread that sees it set also sees the other modules
+def load_pyarrow() -> None:
+    global pa, pc, ds, pq
+    if pa is None:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+        import pyarrow.parquet
+        pc, ds, pq = pyarrow.compute, pyarrow.dataset, pyarrow.parquet
+        pa = pyarrow
+
+
+"""
+This class is a lock that any number of readers can hold at once, or one writer on its own.
+A writer that is waiting keeps new readers out, so a steady stream of summaries cannot hold
+off an upload's swap for ever.
+"""
+class _ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writers_waiting = 0
+        self.writing = False
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writing and not self.writers_waiting)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            self.condition.wait_for(lambda: not self.writing and not self.readers)
+            self.writers_waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+# Scans hold this lock for reading, so summaries and batches read the dataset at the same time,
+# and months are swapped or dropped while it is held for writing, so a scan never sees a month
+# that is half replaced or has its files removed while it reads them
+_swap_lock = _ReadWriteLock()
+
+# Uploads rewrite the dataset one at a time: each holds this lock while it reads a bucket's
+# files and the users' rows and swaps the months, so two uploads that touch the same bucket
+# never both start from the old files and lose each other's rows. Dropping months holds it too.
+_sync_lock = threading.Lock()
+
+SELECT_USER_TRANSACTIONS = """
+SELECT user_id, timestamp, {amount} FROM {transactions}
+WHERE user_id IN ({placeholders})
+ORDER BY user_id, timestamp
+"""
+
+
+# This returns the bucket a user's transactions are stored in
+def user_bucket(user_id: int) -> int:
+    return user_id % COLUMNAR_USER_BUCKETS
+
+
+def _bucket_path(root, bucket: int) -> Path:
+    return Path(root) / f"user_bucket={bucket}"
+
+
+# This returns the name of a month's directory, e.g. month=2023-01
+def _month_name(value: datetime) -> str:
+    return f"month={value.year:04d}-{value.month:02d}"
+
+
+# This returns the Parquet files of the given buckets for the months in the range
+# Only the months a bucket has are listed, so a wide range costs no more than the months stored,
+# and buckets and months that are not requested are never opened
+def _partition_files(root, buckets, start_date: datetime, end_date: datetime) -> list:
+    files = []
+    first, last = _month_name(start_date), _month_name(end_date)
+    for bucket in sorted(buckets):
+        for month_path in sorted(_bucket_path(root, bucket).glob("month=*")):
+            if first <= month_path.name <= last:
+                files.extend(str(path) for path in month_path.glob("*.parquet"))
+    return files
+
+
+# Stored timestamps have no timezone, so a timezone on the range is dropped the way SQLite does
+def _naive(value: datetime) -> datetime:
+    return value.replace(tzinfo=None)
+
+
+# This reads the user_id and transaction_amount columns of the matching transactions
+# Any number of scans run at once, only a swap of the months waits for them to finish
+def _scan(root, buckets, user_filter, start_date: datetime, end_date: datetime):
+    condition = (
+        (pc.field("timestamp") >= pa.scalar(_naive(start_date), pa.timestamp("us")))
+        & (pc.field("timestamp") <= pa.scalar(_naive(end_date), pa.timestamp("us")))
+        & user_filter
+    )
+    with _swap_lock.read():
+        files = _partition_files(root, buckets, start_date, end_date)
+        if not files:
+            return None
+        return ds.dataset(files, format="parquet").to_table(
+            columns=["user_id", "transaction_amount"], filter=condition,
+        )
+
+
+# This aggregates one user's transactions between start_date and end_date inclusive
+def aggregate_range(user_id: int, start_date: datetime, end_date: datetime, root=COLUMNAR_PATH) -> summary.Aggregate:
+    load_pyarrow()
+    table = _scan(root, [user_bucket(user_id)], pc.field("user_id") == user_id, start_date, end_date)
+    if table is None or table.num_rows == 0:
+        return summary.Aggregate()
+    amounts = table["transaction_amount"]
+    bounds = pc.min_max(amounts)
+    return summary.Aggregate(
+        count=table.num_rows,
+        total=pc.sum(amounts).as_py(),
+        minimum=bounds["min"].as_py(),
+        maximum=bounds["max"].as_py(),
+        sum_of_squares=pc.sum(pc.multiply(amounts, amounts)).as_py(),
+    )
+
+
+"""
+This function aggregates the transactions of many users between start_date and end_date inclusive.
+user_ids=None means every user, which scans every bucket.
+It returns a dict of user_id to Aggregate for the users that have transactions, like
+summary.aggregate_users.
+"""
+def aggregate_users(user_ids, start_date: datetime, end_date: datetime, root=COLUMNAR_PATH) -> dict:
+    load_pyarrow()
+    if user_ids is None:
+        buckets = range(COLUMNAR_USER_BUCKETS)
+        user_filter = pc.scalar(True)
+    else:
+        buckets = {user_bucket(user_id) for user_id in user_ids}
+        user_filter = pc.field("user_id").isin(pa.array(user_ids, pa.int64()))
+    table = _scan(root, buckets, user_filter, start_date, end_date)
+    if table is None or table.num_rows == 0:
+        return {}
+    table = table.append_column("square", pc.multiply(table["transaction_amount"], table["transaction_amount"]))
+    grouped = table.group_by("user_id").aggregate([
+        ("transaction_amount", "count"),
+        ("transaction_amount", "sum"),
+        ("transaction_amount", "min"),
+        ("transaction_amount", "max"),
+        ("square", "sum"),
+    ]).to_pydict()
+    return {
+        user_id: summary.Aggregate(count, total, minimum, maximum, sum_of_squares)
+        for user_id, count, total, minimum, maximum, sum_of_squares in zip(
+            grouped["user_id"],
+            grouped["transaction_amount_count"],
+            grouped["transaction_amount_sum"],
+            grouped["transaction_amount_min"],
+            grouped["transaction_amount_max"],
+            grouped["square_sum"],
+        )
+    }
+
+
+# This returns the same summary as summary.get_CSV_summary, read from the Parquet dataset
+def get_CSV_summary(user_id: int, start_date: datetime, end_date: datetime, root=COLUMNAR_PATH) -> dict:
+    return summary.summary_from_aggregate(user_id, aggregate_range(user_id, start_date, end_date, root))
+
+
+# This returns the same summaries as summary.get_batch_summary, read from the Parquet dataset
+def get_batch_summary(user_ids, start_date: datetime, end_date: datetime, root=COLUMNAR_PATH) -> list:
+    aggregates = aggregate_users(user_ids, start_date, end_date, root)
+    ordered_ids = sorted(aggregates) if user_ids is None else user_ids
+    return [summary.summary_from_aggregate(user_id, aggregates.get(user_id, summary.Aggregate())) for user_id in ordered_ids]
+
+
+# This reads the committed transactions of the given users from SQLite as an Arrow table
+# The users are read in batches through the (user_id, timestamp, transaction_amount) index
+# with a raw cursor, READ_ROWS rows at a time, so no row objects are built and at most
+# READ_ROWS rows are held as Python tuples
+def _read_users(db: Session, user_ids: list):
+    batches = []
+    transactions = partitions.source(db)
+    cursor = db.connection().connection.dbapi_connection.cursor()
+    try:
+        for start in range(0, len(user_ids), summary.USER_ID_BATCH):
+            batch = user_ids[start:start + summary.USER_ID_BATCH]
+            placeholders = ", ".join([database.placeholder(db.get_bind())] * len(batch))
+            amount = storage.AMOUNT[storage.layout(db.get_bind())]
+            cursor.execute(SELECT_USER_TRANSACTIONS.format(
+                placeholders=placeholders, amount=amount, transactions=transactions), batch)
+            while rows := cursor.fetchmany(READ_ROWS):
+                user_column, timestamp_column, amount_column = zip(*rows)
+                batches.append(pa.table({
+                    "user_id": pa.array(user_column, pa.int64()),
+                    # SQLite returns the timestamps as text, PostgreSQL as datetimes and the compact layout as epoch microseconds
+                    "timestamp": pa.array(timestamp_column).cast(pa.timestamp("us")),
+                    "transaction_amount": pa.array(amount_column, pa.float64()),
+                }))
+    finally:
+        cursor.close()
+    return pa.concat_tables(batches) if batches else None
+
+
+# This returns the month names (e.g. month=2023-01) of a table's timestamps, one per row
+def _row_months(table):
+    return pc.strftime(table["timestamp"], format="month=%Y-%m")
+
+
+# This returns the months of a bucket that hold transactions of the given users
+# Only the timestamp column of the users' row groups is read, the files are sorted by user_id
+def _stored_months(root, bucket: int, users) -> set:
+    files = [str(path) for path in _bucket_path(root, bucket).glob("month=*/*.parquet")]
+    if not files:
+        return set()
+    table = ds.dataset(files, format="parquet").to_table(columns=["timestamp"], filter=pc.field("user_id").isin(users))
+    return set(pc.unique(_row_months(table)).to_pylist())
+
+
+# This reads the files of one month of a bucket, or returns None if the month has no files
+def _read_month(root, bucket: int, month: str):
+    files = [str(path) for path in (_bucket_path(root, bucket) / month).glob("*.parquet")]
+    if not files:
+        return None
+    return ds.dataset(files, format="parquet").to_table(columns=["user_id", "timestamp", "transaction_amount"])
+
+
+"""
+This function rewrites months of one bucket with the given users' current transactions.
+months are the names of the months an upload changed, or None for every month that holds the
+users' transactions before or after the sync. Other months of the bucket are left as they are,
+and the other users of a rewritten month are kept from its existing file. The new files are
+written next to the dataset and swapped in while the swap lock is held for writing, and a
+month left without transactions is removed.
+"""
+def _rewrite_bucket(root, bucket: int, user_ids: list, fresh, months=None) -> None:
+    users = pa.array(user_ids, pa.int64())
+    fresh_months = _row_months(fresh) if fresh is not None else None
+    if months is None:
+        months = _stored_months(root, bucket, users)
+        if fresh is not None:
+            months.update(pc.unique(fresh_months).to_pylist())
+
+    staging = Path(f"{root}.staging") / f"user_bucket={bucket}-{uuid.uuid4().hex}"
+    for month in sorted(months):
+        tables = []
+        existing = _read_month(root, bucket, month)
+        if existing is not None:
+            tables.append(existing.filter(pc.invert(pc.field("user_id").isin(users))))
+        if fresh is not None:
+            tables.append(fresh.filter(pc.equal(fresh_months, month)))
+        table = pa.concat_tables(tables) if tables else None
+        if table is not None and table.num_rows:
+            table = table.sort_by([("user_id", "ascending"), ("timestamp", "ascending")])
+            (staging / month).mkdir(parents=True)
+            pq.write_table(table, staging / month / "part-0.parquet", row_group_size=ROW_GROUP_ROWS)
+
+    target = _bucket_path(root, bucket)
+    retired = Path(f"{root}.staging") / f"retired-{bucket}-{uuid.uuid4().hex}"
+    retired.mkdir(parents=True)
+    with _swap_lock.write():
+        for month in months:
+            if (target / month).exists():
+                (target / month).rename(retired / month)
+            if (staging / month).exists():
+                target.mkdir(parents=True, exist_ok=True)
+                (staging / month).rename(target / month)
+    shutil.rmtree(retired, ignore_errors=True)
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+"""
+This function copies the committed transactions of the given users to the Parquet dataset.
+It must run after the upload is committed, and the users' cached summaries must be invalidated
+after it returns, as a summary cached while it runs may have read the old files. The users are
+read from SQLite while _sync_lock is held, so whichever upload syncs last writes the latest rows.
+user_ids should include the users a transaction was moved away from, and months (dates in the
+months to rewrite) the months it was moved away from, which the upload's IngestResult.user_ids
+and IngestResult.months do. Without months every month of the users is rewritten.
+"""
+def sync_users(db: Session, user_ids, root=COLUMNAR_PATH, months=None) -> None:
+    load_pyarrow()
+    by_bucket = {}
+    for user_id in sorted(user_ids):
+        by_bucket.setdefault(user_bucket(user_id), []).append(user_id)
+    month_names = None if months is None else {_month_name(month) for month in months}
+    Path(f"{root}.staging").mkdir(parents=True, exist_ok=True)
+    with _sync_lock:
+        for bucket, bucket_users in by_bucket.items():
+            fresh = _read_users(db, bucket_users)
+            _rewrite_bucket(root, bucket, bucket_users, fresh, month_names)
+
+
+# This runs sync_users for an upload that is already committed, which a failure must not fail
+# The failure is logged and False is returned, the users' files are left as they were until
+# the months are uploaded again or the dataset is rebuilt
+def try_sync_users(db: Session, user_ids, root=COLUMNAR_PATH, months=None) -> bool:
+    try:
+        sync_users(db, user_ids, root, months)
+        return True
+    except Exception:
+        logger.exception(f"Could not copy the transactions of {len(user_ids)} users to the Parquet dataset in {root}, "
+                         f"their summaries will be out of date until those months are uploaded again or {root} "
+                         f"is removed and rebuilt on startup")
+        return False
+
+
+# This rebuilds the whole dataset from the transactions table
+def rebuild(db: Session, root=COLUMNAR_PATH) -> None:
+    shutil.rmtree(root, ignore_errors=True)
+    user_ids = db.execute(text(f"SELECT DISTINCT user_id FROM {partitions.source(db)}")).scalars().all()
+    sync_users(db, user_ids, root)
+
+
+# This builds the dataset for a database that has transactions but no dataset yet
+# It returns True if the dataset had to be built
+def ensure_built(db: Session, root=COLUMNAR_PATH) -> bool:
+    if Path(root).exists() or not db.execute(text(f"SELECT 1 FROM {partitions.source(db)} LIMIT 1")).first():
+        return False
+    logger.info(f"Building the Parquet dataset in {root}")
+    rebuild(db, root)
+    return True
+
+
+# This removes the given months (as numbers, e.g. 202301) from every bucket, after they were dropped by partitions.drop_before
+def drop_months(months, root=COLUMNAR_PATH) -> None:
+    names = {f"month={partitions.first_day(month):%Y-%m}" for month in months}
+    with _sync_lock, _swap_lock.write():
+        for path in Path(root).glob("user_bucket=*/month=*"):
+            if path.name in names:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,142 @@
+"""
+This file parses large CSV files on several cores.
+The file is split into byte ranges that start and end on line boundaries, every range is
+parsed in a worker process (with the pyarrow CSV engine when pyarrow is installed) and the
+parsed frames are handed back in file order, so the single database writer sees the same
+rows, in the same order and with the same row offsets, as it would from pd.read_csv with
+chunksize. The chunks are not the same: each range is cut into chunks of at most chunk_rows
+rows, so a chunk also ends where its range ends.
+Only files opened from a path on disk are split, which are the files spooled for background
+uploads. Files sent in a request are spooled by the web server without a path, so they are
+parsed in the request's thread.
+Splitting on newlines assumes no quoted field contains a line break, which holds for
+transaction CSVs (ids, numbers and timestamps only).
+The workers do not import the database modules, so starting them stays cheap.
+"""
+import io
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterator
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+# Number of worker processes used to parse an upload, 1 parses in the calling thread as before
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(min(os.cpu_count() or 1, 8))))
+
+# Files smaller than this are parsed in the calling thread, starting workers would cost more
+PARALLEL_PARSE_MIN_BYTES = int(os.environ.get("PARALLEL_PARSE_MIN_BYTES", str(64 * 1024 * 1024)))
+
+# Size of each byte range handed to a worker, about 120k rows of a typical transaction CSV
+PARSE_RANGE_BYTES = 8 * 1024 * 1024
+
+# The timestamp format written by suade_generic_test.py, tried before leaving other formats to validation
+PARSE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# This returns the shared worker pool, started on first use
+# Workers are spawned rather than forked, because forking a process that runs threads can copy held locks
+def _parse_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+# This returns True if the source is a file on disk that is worth parsing in parallel
+# The workers open the file by its path, so sources without one are parsed in the calling thread
+def can_parse_in_parallel(source: BinaryIO) -> bool:
+    path = getattr(source, "name", None)
+    return (
+        PARSE_WORKERS > 1
+        and isinstance(path, str)
+        and os.path.isfile(path)
+        and os.path.getsize(path) >= PARALLEL_PARSE_MIN_BYTES
+    )
+
+
+# This splits the data part of a file into (start, end) byte ranges that end just after a newline
+def split_ranges(source: BinaryIO, data_start: int, size: int, range_bytes: int = None) -> list:
+    range_bytes = range_bytes or PARSE_RANGE_BYTES
+    ranges = []
+    start = data_start
+    while start < size:
+        end = min(start + range_bytes, size)
+        if end < size:
+            source.seek(end)
+            end += len(source.readline())
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+"""
+This function parses one byte range of the file in a worker process.
+The header line is put in front of the range so every range parses with the right columns.
+Timestamps the CSV engine left as text are converted with PARSE_TIMESTAMP_FORMAT when every
+value matches it, otherwise they are left as text for the validation to report.
+Parser errors are raised as pandas ParserError and undecodable bytes as UnicodeDecodeError,
+the same errors pd.read_csv raises in the calling thread.
+"""
+def parse_range(path: str, header: bytes, start: int, end: int) -> pd.DataFrame:
+    with open(path, "rb") as source:
+        source.seek(start)
+        data = header + source.read(end - start)
+    data.decode("utf-8")
+    try:
+        frame = pd.read_csv(io.BytesIO(data), engine=CSV_ENGINE)
+    except Exception as e:
+        raise pd.errors.ParserError(str(e))
+    if "timestamp" in frame.columns and not pd.api.types.is_datetime64_any_dtype(frame["timestamp"]):
+        timestamps = pd.to_datetime(frame["timestamp"], format=PARSE_TIMESTAMP_FORMAT, errors="coerce")
+        if timestamps.notna().sum() == frame["timestamp"].notna().sum():
+            frame["timestamp"] = timestamps
+    return frame
+
+
+"""
+This function parses a file on disk in the worker pool and yields its rows in file order.
+At most two ranges per worker are in flight, so memory stays bounded when the writer is slower.
+Every frame is numbered on from the previous one, so validation reports the same row offsets
+as a sequential read, and frames longer than chunk_rows are split.
+After each frame the source's position is moved to the end of its range, so callers that
+estimate the file's row count from source.tell() keep working.
+"""
+def parse_in_parallel(source: BinaryIO, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    path = source.name
+    source.seek(0)
+    header = source.readline()
+    size = os.path.getsize(path)
+    ranges = split_ranges(source, len(header), size)
+
+    pool = _parse_pool()
+    pending = deque()
+    next_range = 0
+    rows_before = 0
+    try:
+        while pending or next_range < len(ranges):
+            while next_range < len(ranges) and len(pending) < PARSE_WORKERS * 2:
+                start, end = ranges[next_range]
+                pending.append((end, pool.submit(parse_range, path, header, start, end)))
+                next_range += 1
+            end, future = pending.popleft()
+            frame = future.result()
+            frame.index = pd.RangeIndex(rows_before, rows_before + len(frame))
+            rows_before += len(frame)
+            source.seek(end)
+            for offset in range(0, len(frame), chunk_rows):
+                yield frame.iloc[offset:offset + chunk_rows]
+    finally:
+        for end, future in pending:
+            future.cancel()
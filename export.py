@@ -0,0 +1,163 @@
+"""
+This file streams stored transactions out of the API for downstream jobs.
+The transactions of one user, or of every user, in a date range are read through a streaming
+cursor EXPORT_BATCH_ROWS rows at a time, and each batch is written out as CSV, NDJSON or an
+Arrow IPC record batch (and optionally gzip compressed) before the next one is read. So memory
+use does not depend on the number of rows exported, and the first rows are sent as soon as the
+first batch is read instead of after the whole result.
+Rows are exported in timestamp order with the columns of an upload, so an exported CSV file can
+be uploaded again. With monthly partitions the months in the range are read one after another.
+Arrow needs the optional pyarrow package.
+"""
+import io
+import uuid
+import zlib
+from datetime import datetime
+from typing import Iterator, Optional
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, type_coerce
+from sqlalchemy.types import NullType
+import database
+import metrics
+import partitions
+import storage
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Number of rows fetched from the cursor and written out at a time
+EXPORT_BATCH_ROWS = 10_000
+
+# The zlib compression level of gzip exports, 6 is the gzip default
+EXPORT_GZIP_LEVEL = 6
+
+COLUMNS = ["transaction_id", "user_id", "product_id", "timestamp", "transaction_amount"]
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+# This returns the Arrow schema of an export, the timestamps are kept in microseconds like they are stored
+def arrow_schema():
+    return pa.schema([
+        ("transaction_id", pa.string()),
+        ("user_id", pa.int64()),
+        ("product_id", pa.int64()),
+        ("timestamp", pa.timestamp("us")),
+        ("transaction_amount", pa.float64()),
+    ])
+
+
+# This builds the query for the transactions of a table in the range, in timestamp order
+# The columns are read without their type's conversions, each batch is converted at once in _batch_frame
+def _query(table, user_id: Optional[int], start_date: datetime, end_date: datetime):
+    query = select(*(type_coerce(table.c[name], NullType()).label(name) for name in COLUMNS)).where(
+        table.c.timestamp >= start_date, table.c.timestamp <= end_date)
+    if user_id is not None:
+        query = query.where(table.c.user_id == user_id)
+    return query.order_by(table.c.timestamp)
+
+
+# This turns a batch of stored rows into a DataFrame of the exported values
+# The compact layout's 16 byte ids, epoch microseconds and cents are turned back into ids, times and amounts
+def _batch_frame(rows: list) -> pd.DataFrame:
+    ids, user_ids, product_ids, timestamps, amounts = zip(*rows)
+    if storage.COMPACT:
+        ids = [str(uuid.UUID(bytes=value)) if isinstance(value, bytes) else value for value in ids]
+        timestamps = np.array(timestamps, dtype="int64").astype("datetime64[us]")
+        amounts = np.array(amounts, dtype="float64") / storage.CENTS
+    else:
+        timestamps = np.array(timestamps, dtype="datetime64[us]")
+    return pd.DataFrame({
+        "transaction_id": list(ids),
+        "user_id": np.array(user_ids, dtype="int64"),
+        "product_id": np.array(product_ids, dtype="int64"),
+        "timestamp": timestamps,
+        "transaction_amount": np.array(amounts, dtype="float64"),
+    })
+
+
+"""
+This function reads the transactions of a user (or of every user when user_id is None) between
+start_date and end_date inclusive and yields them as DataFrames of up to EXPORT_BATCH_ROWS rows.
+It reads with its own read only session, so it can run after the endpoint has returned, and
+the session's read transaction keeps every batch consistent with the first.
+"""
+def batches(user_id: Optional[int], start_date: datetime, end_date: datetime) -> Iterator[pd.DataFrame]:
+    db = database.read_session()
+    try:
+        for table in partitions.tables(db, start_date, end_date):
+            connection = db.connection().execution_options(yield_per=EXPORT_BATCH_ROWS)
+            result = connection.execute(_query(table, user_id, start_date, end_date))
+            for rows in result.partitions():
+                yield _batch_frame(rows)
+    finally:
+        db.close()
+
+
+# This formats timestamps like an upload, 2023-01-01 12:00:00, with microseconds only when there are some
+def _timestamp_text(timestamps: pd.Series) -> np.ndarray:
+    text = np.datetime_as_string(timestamps.to_numpy(dtype="datetime64[us]"), unit="us")
+    return np.char.replace(np.char.replace(text, ".000000", ""), "T", " ")
+
+
+# This writes the batches as CSV with a header row, which is written even when there are no rows
+def _csv(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    yield (",".join(COLUMNS) + "\n").encode()
+    for frame in frames:
+        yield frame.assign(timestamp=_timestamp_text(frame["timestamp"])).to_csv(index=False, header=False).encode()
+
+
+# This writes the batches as one JSON object per line
+# pandas writes 10 decimals by default, so the amounts are written with 15 to read back as the stored values
+def _ndjson(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    for frame in frames:
+        yield frame.assign(timestamp=_timestamp_text(frame["timestamp"])).to_json(orient="records", lines=True, double_precision=15).encode()
+
+
+# This writes the batches as an Arrow IPC stream, one record batch per batch
+def _arrow(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    sink = io.BytesIO()
+    schema = arrow_schema()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for frame in frames:
+            writer.write_batch(pa.RecordBatch.from_pandas(frame, schema=schema, preserve_index=False))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+# This compresses a stream of bytes as one gzip member, sending each compressed part as soon as zlib gives it
+def _gzip(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# This counts the exported rows as they go past
+def _counted(frames: Iterator[pd.DataFrame], format: str) -> Iterator[pd.DataFrame]:
+    for frame in frames:
+        metrics.EXPORT_ROWS.inc(len(frame), format=format)
+        yield frame
+
+
+"""
+This function returns the bytes of an export of the transactions of a user (or of every user when
+user_id is None) between start_date and end_date inclusive, as an iterator for a StreamingResponse.
+format is csv, ndjson or arrow, and with compression="gzip" the output is gzip compressed.
+"""
+def stream(user_id: Optional[int], start_date: datetime, end_date: datetime, format: str = "csv",
+           compression: Optional[str] = None) -> Iterator[bytes]:
+    writer = {"csv": _csv, "ndjson": _ndjson, "arrow": _arrow}[format]
+    chunks = writer(_counted(batches(user_id, start_date, end_date), format))
+    return _gzip(chunks) if compression == "gzip" else chunks
@@ -0,0 +1,713 @@
+"""
+This file contains the bulk ingestion logic for uploaded transactions.
+Uploads are streamed from the file in bounded chunks, and every chunk is validated and
+written as soon as it is parsed, so memory use does not grow with the size of the file.
+Instead of building one ORM object and one INSERT statement per row, each chunk is turned
+into column arrays, written into a temporary staging table with executemany (COPY on
+PostgreSQL) and then merged into the transactions table with a single
+INSERT ... SELECT ... ON CONFLICT statement.
+Staged rows that are already stored with the same values are dropped before the merge, and
+an upload whose content digest matches an earlier upload (with nothing changed since) is not
+read again, so re-sending overlapping exports does not rewrite unchanged rows.
+Uploads can be plain .csv files or .csv.gz / .csv.zst files that are decompressed as they
+are read, and several files can be ingested together as one batch.
+With monthly partitions (see partitions.py) each staged row is merged into the table of its
+month, and a row moved to another month is deleted from the table it was in.
+"""
+import contextvars
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import zlib
+from datetime import date, datetime, timezone
+from typing import BinaryIO, Callable, Iterator, Optional
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+import csvparse
+import database
+import metrics
+import models
+import partitions
+import rollup
+import storage
+import validation
+from uploadresponse import FileResult, MergeCounts
+
+logger = logging.getLogger(__name__)
+
+# Number of CSV rows parsed, validated and written at a time when streaming an upload
+UPLOAD_CHUNK_ROWS = 100_000
+
+# Number of parsed chunks read ahead of the writer
+# The next chunks are decompressed and parsed in a background thread while the current one is written
+PREFETCH_CHUNKS = 2
+
+# The file name endings accepted for uploads, and the compression each one is read with
+UPLOAD_COMPRESSION = {".csv": None, ".csv.gz": "gzip", ".csv.zst": "zstd"}
+
+# The size of each read when working out the content digest of an upload
+DIGEST_READ_BYTES = 1024 * 1024
+
+# The size of each read from an upload while it is parsed
+READ_BUFFER_BYTES = 1024 * 1024
+
+# Number of rows written to the staging table per executemany call
+CHUNK_ROWS = 50_000
+
+# Uploads estimated to hold at least this many rows, and at least INDEX_REBUILD_RATIO times the
+# rows already stored, drop the secondary indexes while loading and rebuild them once at the end
+INDEX_REBUILD_MIN_ROWS = 500_000
+INDEX_REBUILD_RATIO = 0.5
+
+# SQLite pragmas used while a bulk load is running (other databases are left as they are)
+# A larger page cache (about 200MB) keeps the staging table and the index pages being updated in memory
+# Only pragmas that can be changed inside an open transaction are listed here
+LOAD_PRAGMAS = {
+    "cache_size": -200_000,
+}
+
+STAGING_TABLE = "_transactions_staging"
+
+# The staged columns have the types of the storage layout (see storage.py)
+CREATE_STAGING = f"""
+CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (
+    transaction_id {{id_type}},
+    user_id INTEGER,
+    product_id INTEGER,
+    timestamp {{timestamp_type}},
+    transaction_amount {{amount_type}}{{partition_columns}}
+)
+"""
+
+STAGING_TYPES = {
+    "standard": {"id_type": "VARCHAR", "timestamp_type": "TIMESTAMP", "amount_type": "FLOAT"},
+    "compact": {"id_type": "BLOB", "timestamp_type": "INTEGER", "amount_type": "INTEGER"},
+}
+
+# With monthly partitions every staged row also has the month it is stored in after the merge,
+# and the month it is stored in now (looked up in the transaction_months table after staging)
+PARTITION_COLUMNS = """,
+    month INTEGER,
+    stored_month INTEGER"""
+
+# The columns staged from an upload, month is only staged with partitions
+STAGED_COLUMNS = ["transaction_id", "user_id", "product_id", "timestamp", "transaction_amount", "month"]
+
+# The placeholder is ? for SQLite and %s for PostgreSQL, there is one for every staged column
+INSERT_STAGING = f"INSERT INTO {STAGING_TABLE} ({{columns}}) VALUES ({{placeholders}})"
+
+# PostgreSQL fills the staging table with COPY instead of executemany
+COPY_STAGING = f"COPY {STAGING_TABLE} FROM STDIN WITH (FORMAT csv)"
+
+# The rows stored so far, used to decide whether a load is large enough to rebuild the indexes
+# The compact table has no rowid, so its rows are counted
+STORED_ROWS = {
+    "sqlite": "SELECT MAX(rowid) FROM transactions",
+    "compact": "SELECT COUNT(*) FROM transactions",
+    # reltuples is -1 until the table has been analysed
+    "postgresql": "SELECT CAST(GREATEST(reltuples, 0) AS BIGINT) FROM pg_class WHERE relname = 'transactions'",
+}
+
+# Staged rows that are stored with exactly the same values are dropped before the merge,
+# so they do not rewrite the row, its index entries or the rollups and sketches of their day
+# Each row costs one lookup in the transaction_id index instead of a write
+# With partitions it runs once for each month's table, for the staged rows stored in it that stay in that month
+DROP_UNCHANGED = f"""
+DELETE FROM {STAGING_TABLE}
+WHERE {{staged}} AND EXISTS (
+    SELECT 1 FROM {{transactions}} t
+    WHERE t.transaction_id = {STAGING_TABLE}.transaction_id
+      AND t.user_id = {STAGING_TABLE}.user_id
+      AND t.product_id = {STAGING_TABLE}.product_id
+      AND t.timestamp = {STAGING_TABLE}.timestamp
+      AND t.transaction_amount = {STAGING_TABLE}.transaction_amount
+)
+"""
+
+# The staged rows that have a stored row with the same transaction_id
+COUNT_STORED = f"""
+SELECT COUNT(*) FROM {STAGING_TABLE} s JOIN transactions t ON t.transaction_id = s.transaction_id
+"""
+
+# This statement is valid on both SQLite and PostgreSQL
+# The WHERE clause (true without partitions) is needed so SQLite does not read ON CONFLICT as part of the SELECT's join
+# Rows are merged in transaction_id order so the unique index is updated mostly sequentially
+# With partitions it runs once for each month's table, for the staged rows of that month
+MERGE_STAGING = f"""
+INSERT INTO {{transactions}} (transaction_id, user_id, product_id, timestamp, transaction_amount)
+SELECT transaction_id, user_id, product_id, timestamp, transaction_amount
+FROM {STAGING_TABLE} WHERE {{staged}} ORDER BY transaction_id
+ON CONFLICT (transaction_id) DO UPDATE SET
+    user_id = excluded.user_id,
+    product_id = excluded.product_id,
+    timestamp = excluded.timestamp,
+    transaction_amount = excluded.transaction_amount
+"""
+
+# With partitions, the month each staged row is stored in now, one lookup in the id map per row
+FIND_STORED_MONTHS = f"""
+UPDATE {STAGING_TABLE} SET stored_month = (
+    SELECT m.month FROM transaction_months m WHERE m.transaction_id = {STAGING_TABLE}.transaction_id
+)
+"""
+
+# With partitions, staged rows moving to another month are deleted from the month's table they were in
+DELETE_MOVED = f"""
+DELETE FROM {{transactions}} WHERE transaction_id IN (
+    SELECT transaction_id FROM {STAGING_TABLE} WHERE stored_month = {{month}} AND month != {{month}}
+)
+"""
+
+# With partitions, the id map is updated for the staged rows that are new or moved to another month
+UPDATE_MONTHS = f"""
+INSERT INTO transaction_months (transaction_id, month)
+SELECT transaction_id, month FROM {STAGING_TABLE} WHERE stored_month IS NULL OR stored_month != month
+ON CONFLICT (transaction_id) DO UPDATE SET month = excluded.month
+"""
+
+
+# This converts the timestamp column into the same text format SQLAlchemy uses for DateTime on SQLite
+# e.g. 2023-01-01 12:00:00.000000, so bulk loaded rows compare correctly with the summary filters
+def _timestamps_to_text(column: pd.Series) -> list:
+    if getattr(column.dt, "tz", None) is not None:
+        column = column.dt.tz_localize(None)
+    text = np.datetime_as_string(column.to_numpy(dtype="datetime64[us]"), unit="us")
+    return np.char.replace(text, "T", " ").tolist()
+
+
+# This returns the staged columns of a DataFrame as whole column lists
+# The compact layout stages the values in the types it stores them in, and partitions add the month
+def _frame_columns(frame: pd.DataFrame) -> list:
+    if storage.COMPACT:
+        columns = [
+            storage.compact_ids(frame["transaction_id"]),
+            frame["user_id"].tolist(),
+            frame["product_id"].tolist(),
+            storage.epoch_micros(frame["timestamp"]),
+            storage.cents(frame["transaction_amount"]),
+        ]
+    else:
+        columns = [
+            frame["transaction_id"].astype(str).tolist(),
+            frame["user_id"].tolist(),
+            frame["product_id"].tolist(),
+            _timestamps_to_text(frame["timestamp"]),
+            frame["transaction_amount"].astype(float).tolist(),
+        ]
+    if storage.PARTITIONED:
+        columns.append(partitions.months_of(frame["timestamp"]))
+    return columns
+
+
+# This turns a DataFrame into a list of row tuples built from whole column arrays
+def _frame_to_rows(frame: pd.DataFrame) -> list:
+    return list(zip(*_frame_columns(frame)))
+
+
+# This writes a chunk into the staging table
+# psycopg2 cursors have copy_expert, so on PostgreSQL the chunk is sent as one CSV stream with COPY
+def _stage(db: Session, cursor, frame: pd.DataFrame) -> None:
+    if hasattr(cursor, "copy_expert"):
+        buffer = io.StringIO()
+        pd.DataFrame(dict(enumerate(_frame_columns(frame)))).to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(COPY_STAGING, buffer)
+    else:
+        columns = STAGED_COLUMNS if storage.PARTITIONED else STAGED_COLUMNS[:-1]
+        statement = INSERT_STAGING.format(
+            columns=", ".join(columns), placeholders=", ".join([database.placeholder(db.get_bind())] * len(columns)))
+        cursor.executemany(statement, _frame_to_rows(frame))
+
+
+# This applies the load pragmas and returns the previous values so they can be restored afterwards
+def _apply_pragmas(cursor, pragmas: dict) -> dict:
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = cursor.execute(f"PRAGMA {name}").fetchone()[0]
+        cursor.execute(f"PRAGMA {name} = {value}")
+    return previous
+
+
+# This clears the known upload digests, called whenever stored transactions change
+def forget_upload_digests(db: Session) -> None:
+    db.query(models.UploadDigest).delete(synchronize_session=False)
+
+
+# This merges the staged chunk into the transactions table and adds its rows to counts
+# The stored rows are counted first, so a chunk of only new rows skips looking for unchanged ones
+def _merge_staged(db: Session, cursor, staged_rows: int, counts: MergeCounts) -> None:
+    if storage.PARTITIONED:
+        _merge_partitioned(db, cursor, staged_rows, counts)
+        return
+    cursor.execute(COUNT_STORED)
+    stored = cursor.fetchone()[0]
+    unchanged = 0
+    if stored:
+        cursor.execute(DROP_UNCHANGED.format(staged="true", transactions="transactions"))
+        unchanged = cursor.rowcount
+    counts.unchanged += unchanged
+    counts.updated += stored - unchanged
+    counts.inserted += staged_rows - stored
+    if unchanged < staged_rows:
+        rollup.track_staged(db, STAGING_TABLE)
+        cursor.execute(MERGE_STAGING.format(staged="true", transactions="transactions"))
+
+
+"""
+This function merges the staged chunk into the months' tables when the transactions are partitioned.
+The month each staged row is stored in now is looked up in the id map first, so every other
+step only reads the tables of the months the chunk comes from and goes to: unchanged rows
+are dropped, rows moving to another month are deleted from their old month's table, each
+month's rows are merged into its table (created if needed) and the id map is updated.
+"""
+def _merge_partitioned(db: Session, cursor, staged_rows: int, counts: MergeCounts) -> None:
+    cursor.execute(FIND_STORED_MONTHS)
+    cursor.execute(f"SELECT DISTINCT stored_month FROM {STAGING_TABLE} WHERE stored_month IS NOT NULL")
+    stored_months = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f"SELECT COUNT(stored_month) FROM {STAGING_TABLE}")
+    stored = cursor.fetchone()[0]
+    unchanged = 0
+    for month in stored_months:
+        cursor.execute(DROP_UNCHANGED.format(
+            staged=f"stored_month = {month} AND month = {month}", transactions=partitions.table_name(month)))
+        unchanged += cursor.rowcount
+    counts.unchanged += unchanged
+    counts.updated += stored - unchanged
+    counts.inserted += staged_rows - stored
+    if unchanged == staged_rows:
+        return
+
+    cursor.execute(f"SELECT DISTINCT month FROM {STAGING_TABLE}")
+    months = [row[0] for row in cursor.fetchall()]
+    partitions.ensure(db, months)
+    rollup.track_staged(db, STAGING_TABLE, [(partitions.table_name(month), f"s.stored_month = {month}") for month in stored_months])
+    for month in stored_months:
+        cursor.execute(DELETE_MOVED.format(transactions=partitions.table_name(month), month=month))
+    for month in months:
+        cursor.execute(MERGE_STAGING.format(staged=f"month = {month}", transactions=partitions.table_name(month)))
+    cursor.execute(UPDATE_MONTHS)
+
+
+"""
+This function upserts every row of the DataFrame into the transactions table.
+Rows are loaded in chunks of CHUNK_ROWS through the staging table, rows with an
+existing transaction_id are updated with the new values, and rows already stored
+with the same values are left alone.
+The days touched are recorded for the daily rollup, which is refreshed at the end unless
+refresh_rollups is False (then the caller must call rollup.refresh before committing).
+If counts is given the inserted, updated and unchanged rows are added to it.
+The caller owns the transaction, so nothing is committed here.
+It returns the number of rows written.
+"""
+def bulk_upsert(db: Session, frame: pd.DataFrame, chunk_rows: int = CHUNK_ROWS, refresh_rollups: bool = True,
+                counts: MergeCounts = None) -> int:
+    if frame.empty:
+        return 0
+    counts = counts if counts is not None else MergeCounts()
+    changed_before = counts.inserted + counts.updated
+
+    # The raw DBAPI cursor is used so executemany runs without any per-row ORM overhead
+    cursor = db.connection().connection.dbapi_connection.cursor()
+    pragmas = LOAD_PRAGMAS if database.is_sqlite(db.get_bind()) else {}
+    previous = _apply_pragmas(cursor, pragmas)
+    try:
+        cursor.execute(CREATE_STAGING.format(
+            **STAGING_TYPES[storage.TRANSACTION_STORAGE], partition_columns=PARTITION_COLUMNS if storage.PARTITIONED else ""))
+        for start in range(0, len(frame), chunk_rows):
+            chunk = frame.iloc[start:start + chunk_rows]
+            cursor.execute(f"DELETE FROM {STAGING_TABLE}")
+            _stage(db, cursor, chunk)
+            _merge_staged(db, cursor, len(chunk), counts)
+        cursor.execute(f"DELETE FROM {STAGING_TABLE}")
+        if refresh_rollups:
+            rollup.refresh(db)
+    finally:
+        _apply_pragmas(cursor, previous)
+        cursor.close()
+
+    # Earlier uploads may no longer match what is stored
+    if counts.inserted + counts.updated > changed_before:
+        forget_upload_digests(db)
+
+    return len(frame)
+
+
+# The outcome of an ingested upload
+# user_ids holds every user whose stored transactions were changed, including users a row moved away from
+# months holds the first day of every month the upload touched, including the month a row moved away from
+# files holds the rows saved from each file when several files were uploaded together
+# already_uploaded is True when the upload matched the digest of an earlier one and was not read again
+class IngestResult(MergeCounts):
+    rows_written: int
+    user_ids: set[int] = set()
+    months: set[date] = set()
+    files: list[FileResult] = []
+    already_uploaded: bool = False
+
+
+# This error is raised when an upload cannot be ingested
+# The message is safe to show to the client, and report holds the validation report if there is one
+class UploadError(Exception):
+    def __init__(self, message: str, report: validation.ValidationReport = None):
+        super().__init__(message)
+        self.report = report
+
+
+# This returns the compression of an upload from its file name
+# It raises UploadError for file names that do not end in .csv, .csv.gz or .csv.zst
+def upload_compression(filename: str) -> Optional[str]:
+    for suffix, compression in UPLOAD_COMPRESSION.items():
+        if (filename or "").endswith(suffix):
+            return compression
+    raise UploadError("Please upload a CSV file.")
+
+
+# This wraps a compressed upload in a reader that decompresses it as it is read
+# zstd needs the optional zstandard package
+def _decompressed(source: BinaryIO, compression: Optional[str]) -> BinaryIO:
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=source, mode="rb")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise UploadError("Uploading .csv.zst files needs the zstandard package.")
+        return zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True)
+    return source
+
+
+# This wraps an upload so reading it is timed as the read phase and decompressing it as the decode phase
+# The reads are buffered, so the phases are timed once per READ_BUFFER_BYTES instead of for every small read
+def _metered(source: BinaryIO, compression: Optional[str]) -> BinaryIO:
+    stream = io.BufferedReader(metrics.MeteredReader(source, "read", metrics.UPLOAD_BYTES), READ_BUFFER_BYTES)
+    if compression is None:
+        return stream
+    decompressed = metrics.MeteredReader(_decompressed(stream, compression), "decode", metrics.UPLOAD_DECOMPRESSED_BYTES)
+    return io.BufferedReader(decompressed, READ_BUFFER_BYTES)
+
+
+# This returns the errors a decompressor raises for a corrupt or truncated file
+def _decompression_errors(compression: Optional[str]) -> tuple:
+    if compression == "gzip":
+        return (OSError, EOFError, zlib.error)
+    if compression == "zstd":
+        # Without zstandard nothing was decompressed, _decompressed raises its own UploadError
+        try:
+            import zstandard
+        except ImportError:
+            return ()
+        return (zstandard.ZstdError,)
+    return ()
+
+
+# This returns the size of a file in bytes, or None when the source cannot report it
+def _source_size(source: BinaryIO) -> Optional[int]:
+    try:
+        position = source.tell()
+        size = source.seek(0, os.SEEK_END)
+        source.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return size
+
+
+# This works out one digest over the bytes of every file of an upload, as they were uploaded
+# It returns None when a source cannot be read again from where it started
+def _upload_digest(sources: list) -> Optional[str]:
+    digest = hashlib.sha256()
+    try:
+        for source in sources:
+            start = source.tell()
+            size = 0
+            for block in iter(lambda: source.read(DIGEST_READ_BYTES), b""):
+                digest.update(block)
+                size += len(block)
+            # The size of each file is added so the same bytes split differently between files do not match
+            digest.update(f"\0{size}\0".encode())
+            source.seek(start)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return digest.hexdigest()
+
+
+# This returns the result of an earlier upload with the same digest, or None if there is none
+# Every row of a known upload is already stored with the same values, so all rows count as unchanged
+def _known_upload(db: Session, digest: Optional[str], files: list) -> Optional[IngestResult]:
+    known = db.get(models.UploadDigest, digest) if digest else None
+    if known is None:
+        return None
+    file_rows = json.loads(known.file_rows)
+    if len(file_rows) != len(files):
+        return None
+    for file, rows in zip(files, file_rows):
+        file.rows_written = file.unchanged = rows
+    rows = sum(file_rows)
+    return IngestResult(rows_written=rows, unchanged=rows, files=files, already_uploaded=True)
+
+
+# This returns the position reached in a file, or None when the source cannot report it
+def _source_position(source: BinaryIO) -> Optional[int]:
+    try:
+        return source.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+"""
+This function reads every file of an upload in turn and yields (file index, chunk, position).
+A (file index, None, None) marker is yielded before each file's chunks.
+position is how far into the (possibly compressed) file the reader had got after the chunk,
+which is used to estimate the size of the whole upload.
+Large plain files on disk are parsed by the csvparse worker pool, everything else by pandas.
+Reading the file, decompressing it and parsing it are timed as the read, decode and parse phases.
+"""
+def _read_chunks(uploads: list, chunk_rows: int) -> Iterator[tuple]:
+    for index, (filename, source, compression) in enumerate(uploads):
+        yield index, None, None
+        # The errors are looked up before reading, as an except clause is only evaluated once an error is raised
+        decompression_errors = _decompression_errors(compression)
+        try:
+            if compression is None and csvparse.can_parse_in_parallel(source):
+                metrics.UPLOAD_BYTES.inc(_source_size(source) or 0)
+                reader = csvparse.parse_in_parallel(source, chunk_rows)
+            else:
+                reader = pd.read_csv(_metered(source, compression), chunksize=chunk_rows)
+            try:
+                while True:
+                    with metrics.phase("parse"):
+                        chunk = next(reader, None)
+                    if chunk is None:
+                        break
+                    yield index, chunk, _source_position(source)
+            finally:
+                reader.close()
+        except decompression_errors:
+            raise UploadError("Uploaded file could not be decompressed.")
+
+
+"""
+This function runs an iterator in a background thread and yields its items in order.
+Up to PREFETCH_CHUNKS items are read ahead, so decompressing and parsing the next chunk
+overlaps with validating and writing the current one (zlib, the pandas parser and SQLite
+release the GIL for most of their work).
+An exception raised by the iterator is raised again here, and closing this generator stops the thread.
+"""
+def _prefetch(items: Iterator) -> Iterator:
+    ahead = queue.Queue(maxsize=PREFETCH_CHUNKS)
+    stopped = threading.Event()
+
+    # This waits for room in the queue, giving up once the consumer has stopped
+    def put(entry) -> bool:
+        while not stopped.is_set():
+            try:
+                ahead.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(("item", item)):
+                    return
+            put(("done", None))
+        except BaseException as e:
+            put(("error", e))
+        finally:
+            items.close()
+
+    # The thread runs in a copy of the caller's context, so its phases are added to the caller's request timings
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(produce,), name="upload-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = ahead.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                return
+            yield value
+    finally:
+        stopped.set()
+        thread.join()
+
+
+# This returns the non-unique indexes of the transactions table
+# The unique transaction_id index is always kept because the upsert needs it to find conflicts
+# With partitions the indexes are kept, each month's table is small and some are only created during the load
+# On PostgreSQL they are kept too, as DROP INDEX holds an ACCESS EXCLUSIVE lock on the table until
+# the upload commits, which would stop every summary from reading it for the whole load
+def _secondary_indexes(bind) -> list:
+    if storage.PARTITIONED or bind.dialect.name == "postgresql":
+        return []
+    return [index for index in models.Transaction.__table__.indexes if not index.unique]
+
+
+# This estimates the rows in the whole upload from how far the first chunk got through the first file
+# The other files of a batch are taken to be about the same size
+# It returns None when the source cannot report its size
+def _estimate_upload_rows(size: Optional[int], position: Optional[int], rows_read: int, files: int = 1):
+    if not size or not position:
+        return None
+    return int(rows_read * size / position) * files
+
+
+# This decides whether a load is large enough for dropping and rebuilding the secondary indexes to pay off
+def _should_rebuild_indexes(db: Session, estimated_rows: Optional[int]) -> bool:
+    if estimated_rows is None or estimated_rows < INDEX_REBUILD_MIN_ROWS:
+        return False
+    stored_rows = db.execute(text(STORED_ROWS[storage.layout(db.get_bind())])).scalar() or 0
+    return estimated_rows >= stored_rows * INDEX_REBUILD_RATIO
+
+
+"""
+This function streams a CSV upload into the transactions table.
+The file is parsed UPLOAD_CHUNK_ROWS rows at a time and every chunk is validated and
+upserted as it is read, so only a few chunks are held in memory.
+filename only picks the compression: a name ending in .csv.gz or .csv.zst is decompressed while reading.
+See ingest_files for the rest, this ingests a batch of one file.
+"""
+def ingest_csv(db: Session, source: BinaryIO, chunk_rows: int = None, progress: Callable[[int, int], None] = None,
+               rebuild_indexes: bool = None, filename: str = "upload.csv") -> IngestResult:
+    return ingest_files(db, [(filename, source)], chunk_rows, progress, rebuild_indexes)
+
+
+"""
+This function streams one or more uploaded files into the transactions table as one batch.
+uploads is a list of (filename, file) pairs, and each file is read as a plain, gzip or zstd
+CSV file from the ending of its name (.csv, .csv.gz or .csv.zst).
+The files are decompressed and parsed UPLOAD_CHUNK_ROWS rows at a time in a background
+thread, a couple of chunks ahead of the writer, and every chunk is validated and upserted
+as it arrives. Files on disk of at least csvparse.PARALLEL_PARSE_MIN_BYTES are parsed by a
+pool of worker processes instead, which hand back the chunks in file order.
+Each file is validated on its own (an id repeated in a later file updates the earlier row),
+and errors name the file they were found in when there is more than one.
+The digest of the files' bytes is worked out first, and an upload matching the digest of an
+earlier upload is answered with that upload's row counts without being read again.
+An upload is all or nothing: nothing is committed here, so if a later chunk or file fails
+validation the caller rolls back and the rows from earlier chunks are discarded too.
+If progress is given it is called with (rows_parsed, rows_written) after every chunk.
+For very large loads the secondary indexes are dropped after the first chunk and rebuilt
+at the end (rebuild_indexes forces this on or off instead of estimating), except on
+PostgreSQL and with partitions, see _secondary_indexes.
+It returns an IngestResult with the number of rows written, split into inserted, updated
+and unchanged rows, the same counts for each file and the user_ids changed.
+"""
+def ingest_files(db: Session, uploads: list, chunk_rows: int = None, progress: Callable[[int, int], None] = None,
+                 rebuild_indexes: bool = None) -> IngestResult:
+    # Every file name is checked before anything is read
+    opened = [(filename, source, upload_compression(filename)) for filename, source in uploads]
+    files = [FileResult(filename=filename) for filename, _, _ in opened]
+    first_size = _source_size(opened[0][1])
+
+    # A repeat of an upload saved since the transactions last changed would not change anything
+    with metrics.phase("digest"):
+        digest = _upload_digest([source for _, source, _ in opened])
+        known = _known_upload(db, digest, files)
+    if known is not None:
+        logger.info(f"Upload matches an earlier upload with digest {digest}, nothing to save")
+        metrics.UPLOAD_ROWS.inc(known.unchanged, outcome="unchanged")
+        return known
+
+    current = 0
+    parsed_rows = 0
+    saved_rows = 0
+    dropped_indexes = []
+    duplicates = None
+
+    # This names the file an error was found in when the upload has several
+    def in_file(message: str, index: int = None) -> str:
+        if len(files) == 1:
+            return message
+        return f"{files[current if index is None else index].filename}: {message}"
+
+    chunks = _prefetch(_read_chunks(opened, chunk_rows or UPLOAD_CHUNK_ROWS))
+    try:
+        for current, chunk, position in chunks:
+            # Each file is checked for repeated transaction_ids on its own
+            if chunk is None:
+                duplicates = validation.DuplicateTracker()
+                continue
+            parsed_rows += len(chunk)
+            if chunk.empty:
+                # A header only file still has to name the required columns
+                validation.validate_transactions(chunk)
+                continue
+            first_chunk = saved_rows == 0
+            with metrics.phase("validate"):
+                valid = validation.validate_transactions(chunk, duplicates)
+            with metrics.phase("write"):
+                written = bulk_upsert(db, valid, refresh_rollups=False, counts=files[current])
+            files[current].rows_written += written
+            saved_rows += written
+            if progress:
+                progress(parsed_rows, saved_rows)
+
+            # The first chunk has opened the upload's transaction, so dropping the indexes here
+            # is rolled back together with the rows if a later chunk fails
+            if first_chunk and (rebuild_indexes if rebuild_indexes is not None else _should_rebuild_indexes(
+                    db, _estimate_upload_rows(first_size, position, saved_rows, len(files)))):
+                dropped_indexes = _secondary_indexes(db.get_bind())
+                logger.info(f"Dropping {len(dropped_indexes)} secondary indexes for a large load")
+                with metrics.phase("write"):
+                    for index in dropped_indexes:
+                        index.drop(bind=db.connection())
+    except validation.ValidationError as e:
+        logger.error(f"Upload failed validation: {e.report.model_dump_json()}")
+        raise UploadError(in_file(str(e)), e.report)
+    except UploadError as e:
+        raise UploadError(in_file(str(e)), e.report)
+    except pd.errors.EmptyDataError:
+        raise UploadError(in_file("Uploaded CSV file is empty."))
+    except UnicodeDecodeError:
+        raise UploadError(in_file("Uploaded CSV file must be UTF-8 encoded."))
+    except pd.errors.ParserError as e:
+        logger.error(f"Error parsing CSV: {e}")
+        raise UploadError(in_file("Uploaded CSV file could not be parsed."))
+    finally:
+        chunks.close()
+
+    # A file with only a header row has no data to save
+    for index, file in enumerate(files):
+        if file.rows_written == 0:
+            raise UploadError(in_file("CSV file is empty.", index))
+
+    # The indexes are rebuilt before the rollup is refreshed, because the refresh reads through them
+    with metrics.phase("write"):
+        for index in dropped_indexes:
+            index.create(bind=db.connection())
+
+    # The daily rollup is refreshed once for every day touched by the whole batch
+    with metrics.phase("rollup"):
+        months = rollup.affected_months(db)
+        user_ids = rollup.refresh(db)
+
+    # The digest is remembered so the same upload can be recognised until the transactions change again
+    if digest is not None:
+        db.merge(models.UploadDigest(
+            digest=digest,
+            file_rows=json.dumps([file.rows_written for file in files]),
+            created_at=datetime.now(timezone.utc),
+        ))
+
+    result = IngestResult(
+        rows_written=saved_rows,
+        inserted=sum(file.inserted for file in files),
+        updated=sum(file.updated for file in files),
+        unchanged=sum(file.unchanged for file in files),
+        user_ids=user_ids,
+        months=months,
+        files=files,
+    )
+    metrics.UPLOAD_ROWS.inc(parsed_rows, outcome="parsed")
+    for outcome in ("inserted", "updated", "unchanged"):
+        metrics.UPLOAD_ROWS.inc(getattr(result, outcome), outcome=outcome)
+    return result
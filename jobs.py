@@ -0,0 +1,159 @@
+"""
+This file runs uploads as background ingestion jobs.
+The upload is spooled to files on disk and handed to a worker thread pool that is separate
+from the web server's event loop, so large files do not hold requests open or block readers.
+Each job records its progress so it can be reported by GET /upload/jobs/{job_id}.
+"""
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+from pydantic import BaseModel
+import cache
+import columnar
+import database
+import metrics
+import partitions
+import uploadresponse
+
+logger = logging.getLogger(__name__)
+
+# Number of uploads ingested at the same time
+# SQLite allows a single writer, so extra workers would only wait for each other's locks
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+
+# Directory the uploads are spooled to before they are ingested (defaults to the system temp directory)
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+
+# Number of finished jobs kept for status lookups, the oldest are forgotten first
+MAX_FINISHED_JOBS = 1000
+
+
+# The status of a background ingestion job
+# status is one of queued, running, succeeded or failed
+# warnings lists the steps that failed after a succeeded job's rows were saved
+class JobStatus(BaseModel):
+    job_id: str
+    filename: str
+    status: str = "queued"
+    rows_parsed: int = 0
+    rows_written: int = 0
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    files: list[uploadresponse.FileResult] = []
+    error: Optional[str] = None
+    errors: list[uploadresponse.ValidationIssue] = []
+    warnings: list[str] = []
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+
+"""
+This class keeps the status of every job and runs them on the worker pool.
+Job statuses are kept in memory, so they are only visible to the server process that
+accepted the upload.
+"""
+class JobManager:
+    def __init__(self, workers: int = INGEST_WORKERS):
+        self.jobs: dict[str, JobStatus] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+
+    # This registers a job for the spooled files of one upload and queues it on the worker pool
+    # spooled is a list of (spool path, uploaded filename) pairs, and filename lists the uploaded names
+    def submit(self, spooled: list[tuple[str, str]]) -> JobStatus:
+        job = JobStatus(
+            job_id=uuid.uuid4().hex,
+            filename=", ".join(filename for _, filename in spooled),
+            created_at=datetime.now(timezone.utc),
+        )
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self._forget_finished_jobs()
+        self.executor.submit(self._run, job.job_id, spooled)
+        return job.model_copy()
+
+    # This returns a copy of the job's status, or None if the job is unknown
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.model_copy() if job else None
+
+    # This updates the job's status fields under the lock
+    def _update(self, job_id: str, **fields) -> None:
+        with self.lock:
+            job = self.jobs[job_id]
+            for name, value in fields.items():
+                setattr(job, name, value)
+
+    # This drops the oldest finished jobs once there are more than MAX_FINISHED_JOBS
+    def _forget_finished_jobs(self) -> None:
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.job_id]
+
+    # This ingests the spooled files in a worker thread with its own database session
+    # The spooled files are always removed afterwards
+    # ingest (and pandas with it) is imported here, so it is only loaded once there is an upload
+    def _run(self, job_id: str, spooled: list[tuple[str, str]]) -> None:
+        import ingest
+
+        self._update(job_id, status="running")
+        db = database.session()
+        sources = []
+        try:
+            for path, filename in spooled:
+                sources.append((filename, open(path, "rb")))
+            result = ingest.ingest_files(
+                db, sources,
+                progress=lambda parsed, written: self._update(job_id, rows_parsed=parsed, rows_written=written),
+            )
+            with metrics.phase("commit"):
+                db.commit()
+        except ingest.UploadError as e:
+            db.rollback()
+            issues = e.report.issues if e.report else []
+            self._update(job_id, status="failed", error=str(e), errors=issues, rows_written=0, finished_at=datetime.now(timezone.utc))
+            logger.info(f"Upload job {job_id} failed: {e}")
+        except Exception:
+            db.rollback()
+            logger.exception(f"Upload job {job_id} failed")
+            self._update(job_id, status="failed", error="Internal error while saving the upload.", rows_written=0, finished_at=datetime.now(timezone.utc))
+        else:
+            # The upload is saved, so the steps after the commit only add warnings and never fail the job
+            warnings = self._after_commit(db, result)
+            self._update(
+                job_id, status="succeeded", rows_written=result.rows_written, inserted=result.inserted,
+                updated=result.updated, unchanged=result.unchanged, files=result.files, warnings=warnings,
+                finished_at=datetime.now(timezone.utc),
+            )
+            logger.info(f"Upload job {job_id} saved {result.rows_written} records.")
+        finally:
+            db.close()
+            for _, source in sources:
+                source.close()
+            for path, _ in spooled:
+                os.remove(path)
+
+    # This runs the steps that follow the commit of an upload, and returns a warning for each one that failed
+    # The users' cached summaries are always cleared first, the failures are logged by the steps themselves
+    def _after_commit(self, db, result) -> list[str]:
+        warnings = []
+        cache.summary_cache.invalidate_users(result.user_ids)
+        if columnar.ENABLED:
+            if columnar.try_sync_users(db, result.user_ids, months=result.months):
+                # Summaries cached while the files were rewritten may have read the old ones
+                cache.summary_cache.invalidate_users(result.user_ids)
+            else:
+                warnings.append("The upload was saved, but the Parquet copy of its users could not be updated.")
+        if not partitions.try_apply_retention(db):
+            warnings.append("The upload was saved, but the months older than the retention period could not be removed.")
+        return warnings
+
+
+# The job manager shared by the application
+manager = JobManager()
@@ -4,13 +4,22 @@ The summary statistics include minimum, maximum, and average transaction amounts
 It uses FastAPI for the web framework, SQLAlchemy for database interactions, and Pydantic for data validation.
 """
 from fastapi import FastAPI, HTTPException, Depends, Query, File, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import TypeAdapter
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
 from datetime import datetime
-from sqlalchemy.dialects.sqlite import insert
-import pandas as pd
-import io
+from typing import Optional
 import logging
-import models
+import shutil
+import tempfile
+import cache
+import columnar
+import jobs
+import metrics
+import partitions
+import startup
 import summary
 import database
 import summaryresponse
@@ -19,9 +28,29 @@ import summaryresponse
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-models.base.metadata.create_all(bind=database.dbengine)
+"""
+This function runs when the server starts, before it accepts any requests.
+It prepares the database (unless DATABASE_SETUP_ON_STARTUP=false) and, with DATABASE_PREWARM=true,
+warms up the read path, see startup.py. Importing this file does neither, so importing it is cheap.
+pandas is not imported here either, it is loaded by the first upload or export.
+"""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if startup.DATABASE_SETUP_ON_STARTUP:
+        await run_in_threadpool(startup.prepare_database)
+    if startup.DATABASE_PREWARM:
+        await run_in_threadpool(startup.prewarm)
+        if database.ASYNC_SUMMARIES:
+            await startup.prewarm_async()
+    yield
+
+app = FastAPI(title="Transaction Summary API", lifespan=lifespan)
 
-app = FastAPI(title="Transaction Summary API")
+# Times every request, for the Server-Timing header and GET /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
+# The size of each read when copying an upload to its spool file
+SPOOL_COPY_BYTES = 1024 * 1024
 
 # Creates a databse session for each request
 def get_database():
@@ -33,140 +62,323 @@ def get_database():
     finally:
         db.close()
 
+# Creates a read only database session for each summary request
+# It uses the reader engine, so summaries are not queued behind an upload holding the writer
+def get_read_database():
+    db = database.read_session()
+    
+    try:
+        yield db
+    finally:
+        db.close()
+
 """
 This function handles the file upload endpoint.
-It checks if the uploaded file is a CSV file, reads its content, and validates the required columns.
+It checks if the uploaded file is a CSV file, then streams its content in chunks and validates the required columns.
+Files ending in .csv.gz or .csv.zst are decompressed while they are streamed.
+Several files can be sent in one request (repeat the file field), they are saved together as one batch
+and the response gives the rows saved from each file.
 If valid, it saves the data to the database, handling any conflicts by updating existing records.
-Any data in the database gets replaced with the new data from the CSV file.
+Any data in the database gets replaced with the new data from the CSV file, rows that are
+already stored with the same values are not written again, and an upload that was already
+saved (with nothing changed since) is recognised from its content digest and not read again.
+The upload is saved in one transaction, so an invalid row anywhere in any file means nothing is saved.
+With background=true the files are spooled to disk and saved by a background job instead,
+and the response holds the job id to check with GET /upload/jobs/{job_id}.
+This is a normal (not async) function, so FastAPI runs it in a worker thread and the
+pandas and database work does not block the event loop for other requests.
+ingest (and pandas with it) is imported by the first upload, not when the server starts.
 """        
 @app.post("/upload/")
-async def upload_file(
-    file: UploadFile = File(...), 
+@metrics.profiled
+def upload_file(
+    file: list[UploadFile] = File(..., description="One or more .csv, .csv.gz or .csv.zst files"), 
+    background: bool = Query(False, description="Save the file in a background job and return its job id"),
     db: Session = Depends(get_database)
     ):
+    import ingest
     
-    # Check if the uploaded file is a CSV file
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="Please upload a CSV file.")
-    
-    # Read the CSV file content
-    # If the file is empty, it raises an HTTPException
-    csv_content = await file.read()
-    csv_read_content = csv_content.decode()
+    # Check if every uploaded file is a CSV file, plain or compressed
+    try:
+        for upload in file:
+            ingest.upload_compression(upload.filename)
+    except ingest.UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    if not csv_read_content.strip():
-        raise HTTPException(status_code=400, detail="Uploaded CSV file is empty.")
+    # In background mode the uploads are copied to spool files, still compressed, and queued as one job
+    if background:
+        spooled = []
+        for upload in file:
+            suffix = next(suffix for suffix in ingest.UPLOAD_COMPRESSION if upload.filename.endswith(suffix))
+            with tempfile.NamedTemporaryFile(suffix=suffix, dir=jobs.UPLOAD_SPOOL_DIR, delete=False) as spool:
+                shutil.copyfileobj(upload.file, spool, SPOOL_COPY_BYTES)
+            spooled.append((spool.name, upload.filename))
+        job = jobs.manager.submit(spooled)
+        logger.info(f"Upload {job.filename} queued as job {job.job_id}")
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job.job_id, "status_url": f"/upload/jobs/{job.job_id}"},
+        )
     
-    # It uses pandas to read the CSV file and checks for required columns
-    # If the CSV file is empty, it raises an HTTPException
+    # The CSV files are streamed from the upload in chunks
+    # Each chunk is validated and upserted while the next one is decompressed and parsed
+    # If any chunk is invalid, it raises an HTTPException and nothing from the upload is saved
     try:
-        reader = pd.read_csv(io.StringIO(csv_read_content))
-    except pd.errors.EmptyDataError:
-        raise HTTPException(status_code=400, detail="Uploaded CSV file is empty.")
-
-    # Check if the CSV file is empty
-    if reader.empty:
-        raise HTTPException(status_code=400, detail="CSV file is empty.")
-    
-    # Check if the CSV file contains the required columns
-    # The required columns are transaction_id, user_id, product_id, timestamp, and transaction_amount
-    required_columns = {'transaction_id', 'user_id', 'product_id', 'timestamp', 'transaction_amount'}
-    missing_columns = required_columns - set(reader.columns)
-    if missing_columns:
-        raise HTTPException(
-            status_code=400, detail=f"CSV file is missing required columns: {sorted(missing_columns)}"
-    )
+        result = ingest.ingest_files(db, [(upload.filename, upload.file) for upload in file])
+    except ingest.UploadError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # If the timestamp column is not present or cannot be converted, it raises an HTTPException
-    # Convert the timestamp column to datetime format
-    # The expected format is YYYY-MM-DD HH:MM:SS if not a HTTPException is raised
-    if 'timestamp' not in reader.columns:
-        raise HTTPException(status_code=400, detail="CSV file must contain a 'timestamp' column.")
-    try:
-        reader["timestamp"] = pd.to_datetime(reader["timestamp"])
-    except Exception as e:
-        logger.error(f"Error converting timestamp: {e}")
-        raise HTTPException(status_code=400, detail="Invalid Timestamp. Use YYYY-MM-DD")
-    
-    # The data is prepared for saving to the database 
-    # It creates a list of Transaction objects from the CSV data
-    # It loops through each row in the DataFrame
-    save_data = [models.Transaction(
-        transaction_id=row['transaction_id'],
-        user_id=row['user_id'],
-        product_id=row['product_id'],
-        timestamp=row['timestamp'],
-        transaction_amount=row['transaction_amount']
-    ) for index, row in reader.iterrows()] 
-    
-    # A loop to insert or update each transaction in the database
-    for obj in save_data:
-        
-        # Validates the product_id, and user_id making sure they are integers
-        if not isinstance(obj.product_id, int):
-            raise HTTPException(status_code=400, detail="product_id must be integers.")
-        if not isinstance(obj.user_id, int):
-            raise HTTPException(status_code=400, detail="user_id must be integers.")
-        
-        # Creates an insert statement for the Transaction model
-        # This is for inserting or updating the transaction data in the database
-        replace = insert(models.Transaction).values(
-            transaction_id=obj.transaction_id,
-            user_id=obj.user_id,
-            product_id=obj.product_id,
-            timestamp=obj.timestamp,
-            transaction_amount=obj.transaction_amount
-        )
-        
-        # If a transaction with the same transaction_id already exists, it updates the existing record
-        # It uses transaction_id as the unique identifier for conflicts
-        # Fields user_id, product_id, timestamp, and transaction_amount are updated
-        replace = replace.on_conflict_do_update(
-            index_elements=['transaction_id'],
-            set_={
-                'user_id': obj.user_id,
-                'product_id': obj.product_id,
-                'timestamp': obj.timestamp,
-                'transaction_amount': obj.transaction_amount
-            }
-        )
+    # Commits the changes to the database
+    with metrics.phase("commit"):
+        db.commit()
     
-    # Executes the insert statement and commits the changes to the database
-        db.execute(replace)
-        # Commits the changes to the database
-    db.commit()
+    # Cached summaries of the users in the file are now out of date
+    cache.summary_cache.invalidate_users(result.user_ids)
+    
+    # The Parquet copy of the users in the file is rewritten, the upload is already saved so a failure is only logged
+    # Summaries cached while the files were rewritten may have read the old ones, so they are cleared again
+    if columnar.ENABLED and columnar.try_sync_users(db, result.user_ids, months=result.months):
+        cache.summary_cache.invalidate_users(result.user_ids)
+    
+    # Months older than the retention period are removed once the upload is saved, a failure is only logged
+    partitions.try_apply_retention(db)
     
     # Logs the successful data saving
     logger.info("Data saved successfully.")
-    logger.info(f"Number of records saved: {len(save_data)}")
+    logger.info(f"Number of records saved: {result.rows_written} "
+                f"({result.inserted} inserted, {result.updated} updated, {result.unchanged} unchanged)")
     
-    # Returns a success message
-    return {"message": "Data saved succesfully."}
+    # Returns a success message with the rows inserted, updated and left unchanged, in total and from each file
+    # already_uploaded is true when the same upload was saved before and nothing has changed since
+    return {
+        "message": "Data saved succesfully.",
+        "rows_written": result.rows_written,
+        "inserted": result.inserted,
+        "updated": result.updated,
+        "unchanged": result.unchanged,
+        "already_uploaded": result.already_uploaded,
+        "files": [file_result.model_dump() for file_result in result.files],
+    }
+
+"""
+This function reports the progress of a background upload job.
+It returns the rows parsed and written so far, and any errors if the job failed.
+"""
+@app.get("/upload/jobs/{job_id}", response_model=jobs.JobStatus)
+def get_upload_job(job_id: str):
+    job = jobs.manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Upload job not found.")
+    return job
+
+# This validates the user_id, start_date, and end_date of a summary request
+def check_summary_request(user_id: int, start_date: datetime, end_date: datetime):
+    if not start_date:
+        raise HTTPException(status_code=400, detail="Start date is required.")
+    if not end_date:
+        raise HTTPException(status_code=400, detail="End date is required.")
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="Start date must be before end date.")
+    if not isinstance(user_id, int):
+        raise HTTPException(status_code=400, detail="user_id must be an integer.")
+
+# The response models of the summary endpoints, used to serialize their responses
+SUMMARY_RESPONSE = TypeAdapter(summaryresponse.summaryResponse)
+SUMMARY_LIST_RESPONSE = TypeAdapter(list[summaryresponse.summaryResponse])
+
+# This validates and serializes a response the same way response_model with response_model_exclude_none does
+# It is done in the endpoint so the time it takes is measured as the serialize phase
+def serialized(adapter: TypeAdapter, data) -> JSONResponse:
+    with metrics.phase("serialize"):
+        return JSONResponse(adapter.dump_python(adapter.validate_python(data), mode="json", exclude_none=True))
+
+# This works out a summary, timing the checkout of the session's connection (when it reads the database) and the query
+def timed_summary(db: Optional[Session], compute):
+    if db is not None:
+        with metrics.phase("session"):
+            db.connection()
+    with metrics.phase("query"):
+        return compute()
+
+# This is the async version of timed_summary
+async def timed_summary_async(db, compute):
+    if db is not None:
+        with metrics.phase("session"):
+            await db.connection()
+    with metrics.phase("query"):
+        return await compute()
 
 """
 This function handles the summary statistics endpoint.
 It retrieves the minimum, maximum, and average transaction amounts for a user within a specified date range.
 The user_id, start_date, and end_date are provided as query parameters.
+With stats=true it also returns the transaction count, total, standard deviation and approximate percentiles.
+With bucket=day, week or month it also returns a time series with the statistics of each bucket.
+With ASYNC_SUMMARIES turned on the async version below is registered instead.
 """
-@app.get("/summary/{user_id}", response_model=summaryresponse.summaryResponse)
 def get_CSV_summary(
     user_id: int,
     start_date: datetime = Query(..., description="Start date in YYYY-MM-DD format"),
     end_date: datetime = Query(..., description="End date in YYYY-MM-DD format"),
-    db: Session = Depends(get_database)
+    stats: bool = Query(False, description="Include count, total, standard deviation and p50/p95/p99"),
+    bucket: Optional[str] = Query(None, pattern="^(day|week|month)$", description="Include a time series by day, week or month"),
+    db: Session = Depends(get_read_database)
 ):
     # Validates the user_id, start_date, and end_date
-    if not start_date:
-        raise HTTPException(status_code=400, detail="Start date is required.")
-    if not end_date:
-        raise HTTPException(status_code=400, detail="End date is required.")
+    check_summary_request(user_id, start_date, end_date)
+    
+    # Calls the get_CSV_summary function to retrieve the summary statistics
+    # Repeated requests for the same user and dates are answered from the summary cache
+    # Plain summaries are read from the Parquet dataset when SUMMARY_BACKEND=parquet
+    if stats or bucket:
+        compute = lambda: summary.get_summary_statistics(db, user_id, start_date, end_date, stats, bucket)
+    elif columnar.ENABLED:
+        compute = lambda: columnar.get_CSV_summary(user_id, start_date, end_date)
+    else:
+        compute = lambda: summary.get_CSV_summary(db, user_id, start_date, end_date)
+    reads_database = bool(stats or bucket) or not columnar.ENABLED
+    summary_data = cache.summary_cache.get_or_compute(
+        (user_id, start_date, end_date, stats, bucket), lambda: timed_summary(db if reads_database else None, compute))
+    return serialized(SUMMARY_RESPONSE, summary_data)
+
+# Creates an async read only database session for each summary request
+async def get_async_read_database():
+    async with database.async_read_session() as db:
+        yield db
+
+"""
+This function is the async version of the summary statistics endpoint.
+It answers the same requests with an AsyncSession, so waiting on the database does not
+hold one of the threadpool workers that sync endpoints run in.
+Reads from the Parquet dataset are not async, so they are still run in the threadpool.
+"""
+async def get_CSV_summary_async(
+    user_id: int,
+    start_date: datetime = Query(..., description="Start date in YYYY-MM-DD format"),
+    end_date: datetime = Query(..., description="End date in YYYY-MM-DD format"),
+    stats: bool = Query(False, description="Include count, total, standard deviation and p50/p95/p99"),
+    bucket: Optional[str] = Query(None, pattern="^(day|week|month)$", description="Include a time series by day, week or month"),
+    db = Depends(get_async_read_database)
+):
+    check_summary_request(user_id, start_date, end_date)
+    
+    if stats or bucket:
+        compute = lambda: summary.get_summary_statistics_async(db, user_id, start_date, end_date, stats, bucket)
+    elif columnar.ENABLED:
+        compute = lambda: run_in_threadpool(columnar.get_CSV_summary, user_id, start_date, end_date)
+    else:
+        compute = lambda: summary.get_CSV_summary_async(db, user_id, start_date, end_date)
+    reads_database = bool(stats or bucket) or not columnar.ENABLED
+    summary_data = await cache.summary_cache.get_or_compute_async(
+        (user_id, start_date, end_date, stats, bucket), lambda: timed_summary_async(db if reads_database else None, compute))
+    return serialized(SUMMARY_RESPONSE, summary_data)
+
+# Only one of the two summary endpoints is registered
+app.get("/summary/{user_id}", response_model=summaryresponse.summaryResponse, response_model_exclude_none=True)(
+    metrics.profiled(get_CSV_summary_async if database.ASYNC_SUMMARIES else get_CSV_summary)
+)
+
+"""
+This function handles the batch summary endpoint.
+It returns the summaries of many users for one date range in a single request.
+The users are listed in user_ids, or all_users is set for every user with transactions in the range.
+The whole answer is worked out with queries grouped by user_id, then returned as a JSON list
+or, with format=ndjson, streamed back one summary per line.
+"""
+@app.post("/summary/batch", response_model=list[summaryresponse.summaryResponse], response_model_exclude_none=True)
+@metrics.profiled
+def get_batch_summary(
+    request: summaryresponse.summaryBatchRequest,
+    format: str = Query("json", pattern="^(json|ndjson)$", description="json or ndjson"),
+    db: Session = Depends(get_read_database)
+):
+    # Validates the users and the date range
+    if request.all_users and request.user_ids is not None:
+        raise HTTPException(status_code=400, detail="Use either user_ids or all_users, not both.")
+    if not request.all_users and request.user_ids is None:
+        raise HTTPException(status_code=400, detail="Provide user_ids or set all_users.")
+    if request.start_date > request.end_date:
+        raise HTTPException(status_code=400, detail="Start date must be before end date.")
+    
+    # Repeated user_ids are only summarised once, keeping the order they were requested in
+    user_ids = None if request.all_users else list(dict.fromkeys(request.user_ids))
+    if columnar.ENABLED:
+        summaries = timed_summary(None, lambda: columnar.get_batch_summary(user_ids, request.start_date, request.end_date))
+    else:
+        summaries = timed_summary(db, lambda: summary.get_batch_summary(db, user_ids, request.start_date, request.end_date))
+    
+    # Each line is serialised through the response model, so it holds the same values as the JSON list
+    if format == "ndjson":
+        return StreamingResponse(
+            (SUMMARY_RESPONSE.dump_json(SUMMARY_RESPONSE.validate_python(item), exclude_none=True) + b"\n" for item in summaries),
+            media_type="application/x-ndjson",
+        )
+    return serialized(SUMMARY_LIST_RESPONSE, summaries)
+
+# This returns the streaming response of an export, named after what was exported
+# export (and pandas with it) is imported by the first export, not when the server starts
+def export_response(user_id: Optional[int], start_date: datetime, end_date: datetime, format: str, compression: Optional[str]):
+    import export
+    
+    if format == "arrow" and export.pa is None:
+        raise HTTPException(status_code=400, detail="format=arrow needs pyarrow to be installed.")
+    filename = f"transactions_{'all' if user_id is None else user_id}_{start_date:%Y%m%d}_{end_date:%Y%m%d}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if compression == "gzip":
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        export.stream(user_id, start_date, end_date, format, compression),
+        media_type=export.MEDIA_TYPES[format],
+        headers=headers,
+    )
+
+"""
+This function handles the export endpoint for every user.
+It streams all the transactions between start_date and end_date, in timestamp order,
+as CSV, NDJSON or an Arrow IPC stream, optionally gzip compressed.
+Rows are read and sent in batches, so large exports start straight away and use little memory.
+"""
+@app.get("/transactions/export")
+def export_all_transactions(
+    start_date: datetime = Query(..., description="Start date in YYYY-MM-DD format"),
+    end_date: datetime = Query(..., description="End date in YYYY-MM-DD format"),
+    format: str = Query("csv", pattern="^(csv|ndjson|arrow)$", description="csv, ndjson or arrow"),
+    compression: Optional[str] = Query(None, pattern="^gzip$", description="gzip to compress the export"),
+):
     if start_date > end_date:
         raise HTTPException(status_code=400, detail="Start date must be before end date.")
-    if not isinstance(user_id, int):
-        raise HTTPException(status_code=400, detail="user_id must be an integer.")
+    return export_response(None, start_date, end_date, format, compression)
+
+"""
+This function handles the export endpoint for one user.
+It streams the user's transactions between start_date and end_date like the endpoint above.
+"""
+@app.get("/transactions/{user_id}/export")
+def export_user_transactions(
+    user_id: int,
+    start_date: datetime = Query(..., description="Start date in YYYY-MM-DD format"),
+    end_date: datetime = Query(..., description="End date in YYYY-MM-DD format"),
+    format: str = Query("csv", pattern="^(csv|ndjson|arrow)$", description="csv, ndjson or arrow"),
+    compression: Optional[str] = Query(None, pattern="^gzip$", description="gzip to compress the export"),
+):
+    check_summary_request(user_id, start_date, end_date)
+    return export_response(user_id, start_date, end_date, format, compression)
+
+"""
+This function reports the summary cache counters.
+It shows the hits, misses, evictions and invalidations so the cache limits can be sized.
+"""
+@app.get("/summary/cache/stats")
+def get_summary_cache_stats():
+    return cache.summary_cache.stats()
+
     
-    # Calls the get_CSV_summary function to retrieve the summary statistics
-    summary_data = summary.get_CSV_summary(db, user_id, start_date, end_date)
-    return summary_data
 
-    
\ No newline at end of file
+"""
+This function returns the request, phase and upload metrics in the Prometheus text format.
+Phases are timed without the phases nested in them, so e.g. parse does not include read.
+"""
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,304 @@
+"""
+This file collects timings and counters for the API and exposes them for Prometheus.
+Uploads and summaries are split into phases. An upload is read, decompressed, parsed,
+timestamp converted, validated, written, rolled up and committed. A summary gets a session,
+queries and serializes. Each phase is timed with phase(), added to a histogram and to the
+timings of the current request, which the middleware sends back in a Server-Timing header.
+A phase run inside another one is taken out of the outer phase's time, so each phase only
+counts its own work and nothing is counted twice.
+GET /metrics returns every metric in the Prometheus text format. The format is written here
+instead of with prometheus_client, so no extra package is needed.
+With PROFILE_DIR set, a request sent with the header X-Profile: 1 is run under cProfile and
+the report is written to that directory.
+"""
+import bisect
+import contextvars
+import cProfile
+import functools
+import inspect
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from starlette.datastructures import Headers, MutableHeaders
+
+# The directory profiling reports are written to, profiling is off when it is not set
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+# The number of functions listed in the text report of a profiled request
+PROFILE_REPORT_LINES = 40
+
+# Histogram bucket bounds in seconds, from a fast summary up to a large upload
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = []
+
+
+# This escapes a label value, the text format does not allow raw backslashes, quotes or newlines in one
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# This formats the labels of a sample, with any extra label already formatted
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# A value that only goes up, kept for every combination of label values
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name, self.documentation, self.labels = name, documentation, labels
+        # A counter without labels is shown as 0 before anything is counted
+        self.values = {} if labels else {(): 0}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+# A distribution of observed values in cumulative buckets, with their sum and count
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name, self.documentation, self.labels, self.buckets = name, documentation, labels, buckets
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self) -> list:
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, bucket)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+# This returns every metric in the Prometheus text format
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {'counter' if isinstance(metric, Counter) else 'histogram'}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+PHASE_SECONDS = Histogram(
+    "transactions_phase_seconds", "Time spent in each phase of uploads and summaries, without nested phases.", ("phase",))
+HTTP_REQUESTS = Counter("transactions_http_requests_total", "HTTP requests answered.", ("method", "route", "status"))
+HTTP_SECONDS = Histogram("transactions_http_request_seconds", "Time taken to answer HTTP requests.", ("method", "route"))
+UPLOAD_ROWS = Counter(
+    "transactions_upload_rows_total", "Uploaded rows parsed, and saved rows split into inserted, updated and unchanged.",
+    ("outcome",))
+UPLOAD_BYTES = Counter("transactions_upload_bytes_total", "Bytes of uploaded files read, as they were uploaded.")
+UPLOAD_DECOMPRESSED_BYTES = Counter(
+    "transactions_upload_decompressed_bytes_total", "Bytes of CSV text decompressed from .csv.gz and .csv.zst uploads.")
+EXPORT_ROWS = Counter("transactions_export_rows_total", "Transactions streamed by the export endpoints.", ("format",))
+
+
+"""
+This class holds the phase timings of one request.
+Phases run in the request's worker thread and in the upload's prefetch thread, so adding
+to them is guarded by a lock. profile is True when the request asked to be profiled, and
+profile_report is set to the report's file name once it is written.
+"""
+class RequestTimings:
+    def __init__(self, profile: bool = False):
+        self.durations = {}
+        self.lock = threading.Lock()
+        self.profile = profile
+        self.profile_report = None
+
+    def add(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    # This returns the Server-Timing header value, durations are in milliseconds
+    def header(self, total: float) -> str:
+        with self.lock:
+            durations = list(self.durations.items())
+        return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in durations + [("total", total)])
+
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+# The phase open in the current context, as [seconds spent in phases nested in it, the thread it runs in]
+# A context variable rather than a thread local, so async requests sharing the event loop thread keep their own
+_open_phase = contextvars.ContextVar("open_phase", default=None)
+
+
+"""
+This function times a block of code as the named phase.
+The time spent in phases opened inside the block (in the same thread) is taken out of it,
+and the rest is added to the phase histogram and to the current request's timings.
+"""
+@contextmanager
+def phase(name: str):
+    outer = _open_phase.get()
+    current = [0.0, threading.get_ident()]
+    token = _open_phase.set(current)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _open_phase.reset(token)
+        if outer is not None and outer[1] == current[1]:
+            outer[0] += elapsed
+        own = elapsed - current[0]
+        PHASE_SECONDS.observe(own, phase=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(name, own)
+
+
+"""
+This class wraps a file so that reading from it is timed as a phase and its bytes are counted.
+Uploads are wrapped in one for the read phase, and compressed uploads are wrapped in a second
+one around the decompressor for the decode phase (which then leaves out the reads it makes).
+"""
+class MeteredReader(io.RawIOBase):
+    def __init__(self, source, phase_name: str, counter: Counter):
+        self.source, self.phase_name, self.counter = source, phase_name, counter
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        with phase(self.phase_name):
+            data = self.source.read(len(buffer))
+        buffer[:len(data)] = data
+        self.counter.inc(len(data))
+        return len(data)
+
+
+# This writes the profile of a request as a .prof file (for pstats or snakeviz) and a text report
+# It returns the name of the text report
+def _write_profile(profiler: cProfile.Profile, name: str) -> str:
+    directory = Path(PROFILE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.perf_counter_ns() % 1_000_000:06d}-{name}"
+    profiler.dump_stats(directory / f"{stem}.prof")
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_REPORT_LINES)
+    (directory / f"{stem}.txt").write_text(report.getvalue())
+    return f"{stem}.txt"
+
+
+# This starts a profiler when the current request asked to be profiled
+# Only one profiler can run at a time on newer Pythons, so a request that cannot get one is not profiled
+def _start_profiler() -> Optional[cProfile.Profile]:
+    timings = _request_timings.get()
+    if timings is None or not timings.profile:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+
+# This stops the profiler and writes its report, if there is one
+def _finish_profiler(profiler: Optional[cProfile.Profile], name: str) -> None:
+    if profiler is None:
+        return
+    profiler.disable()
+    _request_timings.get().profile_report = _write_profile(profiler, name)
+
+
+"""
+This decorator profiles an endpoint when its request asked to be profiled.
+cProfile only sees the thread it runs in, so the endpoint is profiled where it runs (a
+threadpool worker for normal functions, the event loop for async ones). Work handed to other
+threads, like parsing an upload ahead of the writer, shows up as time spent waiting for it.
+"""
+def profiled(endpoint):
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            profiler = _start_profiler()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _finish_profiler(profiler, endpoint.__name__)
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profiler = _start_profiler()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            _finish_profiler(profiler, endpoint.__name__)
+    return wrapper
+
+
+"""
+This class is the ASGI middleware that times every HTTP request.
+It sets up the request's timings, adds them to the response as a Server-Timing header (with
+X-Profile-Report naming the report of a profiled request) and counts the request by method,
+route template and status, so user ids in paths do not create a metric each.
+It is plain ASGI rather than a BaseHTTPMiddleware, so it adds no extra task per request.
+"""
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = bool(PROFILE_DIR) and Headers(scope=scope).get("x-profile", "").lower() in ("1", "true", "yes")
+        timings = RequestTimings(profile=profile)
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.header(time.perf_counter() - started))
+                if timings.profile_report:
+                    headers.append("X-Profile-Report", timings.profile_report)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _request_timings.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=str(status))
+            HTTP_SECONDS.observe(time.perf_counter() - started, method=scope["method"], route=route)
@@ -0,0 +1,83 @@
+"""
+This file upgrades databases created by older versions of the application.
+create_all only creates missing tables, so indexes added to or removed from an existing
+table are handled here. Every step is safe to run more than once.
+"""
+import logging
+from sqlalchemy import Engine, inspect, text
+import models
+import partitions
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Indexes older versions created that are no longer needed
+# ix_transactions_user_id is covered by the composite index, and ix_transactions_id duplicated the primary key
+OBSOLETE_INDEXES = ["ix_transactions_user_id", "ix_transactions_id"]
+
+
+# This recreates a derived table whose columns have changed, it is filled again by rollup.ensure_built
+def _recreate_if_columns_changed(engine: Engine, table) -> None:
+    if not inspect(engine).has_table(table.name):
+        return
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    if {column.name for column in table.columns} - existing:
+        logger.info(f"Recreating table {table.name}")
+        with engine.begin() as connection:
+            table.drop(bind=connection)
+            table.create(bind=connection)
+
+
+# This stops a database created with one TRANSACTION_STORAGE from being opened with the other
+# Only the standard layout has the surrogate id column
+def _check_storage_layout(engine: Engine) -> None:
+    storage.check_database(engine)
+    if not inspect(engine).has_table(models.Transaction.__tablename__):
+        return
+    columns = {column["name"] for column in inspect(engine).get_columns(models.Transaction.__tablename__)}
+    created_as = "standard" if "id" in columns else "compact"
+    if created_as != storage.TRANSACTION_STORAGE:
+        raise RuntimeError(
+            f"The transactions table was created with TRANSACTION_STORAGE={created_as}, "
+            f"start the API with the same setting or with a new database."
+        )
+
+
+# This stops a database created with one TRANSACTION_PARTITIONS from being opened with the other
+# With partitions the transactions table stays empty, and without them there are no months' tables
+def _check_partitioning(engine: Engine) -> None:
+    if engine.dialect.name != "sqlite" or not inspect(engine).has_table(models.Transaction.__tablename__):
+        return
+    with engine.connect() as connection:
+        has_months = bool(partitions.stored_months(connection))
+        has_rows = connection.execute(text(f"SELECT 1 FROM {models.Transaction.__tablename__} LIMIT 1")).first() is not None
+    created_as = "monthly" if has_months else "none" if has_rows else storage.TRANSACTION_PARTITIONS
+    if created_as != storage.TRANSACTION_PARTITIONS:
+        raise RuntimeError(
+            f"The transactions were stored with TRANSACTION_PARTITIONS={created_as}, "
+            f"start the API with the same setting or with a new database."
+        )
+
+
+# This creates any missing indexes of the transactions table (and of every month's table) and drops the obsolete ones
+# It also recreates the rollup tables if they were made by a version without some of their columns
+def upgrade(engine: Engine) -> None:
+    _check_storage_layout(engine)
+    _check_partitioning(engine)
+    _recreate_if_columns_changed(engine, models.DailyRollup.__table__)
+    _recreate_if_columns_changed(engine, models.AmountSketch.__table__)
+    tables = [models.Transaction.__table__]
+    if partitions.ENABLED:
+        with engine.connect() as connection:
+            tables += [partitions.table(month) for month in partitions.stored_months(connection)]
+    for table in tables:
+        existing = {index["name"] for index in inspect(engine).get_indexes(table.name)}
+        with engine.begin() as connection:
+            for index in table.indexes:
+                if index.name not in existing:
+                    logger.info(f"Creating index {index.name}")
+                    index.create(bind=connection)
+            for name in OBSOLETE_INDEXES:
+                if name in existing:
+                    logger.info(f"Dropping index {name}")
+                    connection.exec_driver_sql(f"DROP INDEX {name}")
@@ -1,17 +1,88 @@
 """
-This file defines the table named 'transactions' in the database.
+This file defines the tables named 'transactions', 'daily_rollups', 'amount_sketches' and 'upload_digests' in the database,
+and 'transaction_months' when the transactions are partitioned by month.
 It uses SQLAlchemy to define the structure of the table using columns and their data types.
 """
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy import Column, Integer, String, Float, DateTime, Date, Index, LargeBinary
 from database import base
+import storage
 
 # This is the model for the transactions table
 # This table will store transaction data including transaction ID, user ID, product ID, timestamp, and transaction amount.
-class Transaction(base):
-    __tablename__ = 'transactions'
-    id = Column(Integer, primary_key=True, index=True)
-    transaction_id = Column(String, unique=True, index=True)
-    user_id = Column(Integer, index=True)
-    product_id = Column(Integer)
-    timestamp = Column(DateTime, index=True)
-    transaction_amount = Column(Float)
+# The (user_id, timestamp, transaction_amount) index covers the summary query, so it is answered from the index alone.
+# It also serves lookups by user_id, so user_id has no index of its own.
+if not storage.COMPACT:
+    class Transaction(base):
+        __tablename__ = 'transactions'
+        __table_args__ = (
+            Index("ix_transactions_user_id_timestamp_amount", "user_id", "timestamp", "transaction_amount"),
+        )
+        id = Column(Integer, primary_key=True)
+        transaction_id = Column(String, unique=True, index=True)
+        user_id = Column(Integer)
+        product_id = Column(Integer)
+        timestamp = Column(DateTime, index=True)
+        transaction_amount = Column(Float)
+
+# With TRANSACTION_STORAGE=compact the same columns are stored in the smaller types of storage.py.
+# The table has no rowid and is stored in (user_id, timestamp, transaction_id) order, so the summary
+# query reads one contiguous range of the table and the covering index is not needed.
+else:
+    class Transaction(base):
+        __tablename__ = 'transactions'
+        __table_args__ = {"sqlite_with_rowid": False}
+        user_id = Column(Integer, primary_key=True, autoincrement=False)
+        timestamp = Column(storage.EpochMicros, primary_key=True, index=True)
+        transaction_id = Column(storage.CompactId, primary_key=True, unique=True, index=True)
+        product_id = Column(Integer)
+        transaction_amount = Column(storage.Cents)
+
+
+# This is the model for the transaction_months table, only used with TRANSACTION_PARTITIONS=monthly
+# It maps every stored transaction_id to the month (e.g. 202301) of the partition it is stored in, see partitions.py.
+# The month index lets the rows of old months be removed together when their partitions are dropped.
+if storage.PARTITIONED:
+    class TransactionMonth(base):
+        __tablename__ = 'transaction_months'
+        __table_args__ = {"sqlite_with_rowid": False}
+        transaction_id = Column(storage.CompactId if storage.COMPACT else String, primary_key=True)
+        month = Column(Integer, nullable=False, index=True)
+
+
+# This is the model for the daily_rollups table
+# It stores one row per user per day with the count, total, sum of squares, minimum and maximum of that day's transactions.
+# It is kept up to date by the upload so summaries can combine whole days without reading every transaction.
+class DailyRollup(base):
+    __tablename__ = 'daily_rollups'
+    __table_args__ = {"sqlite_with_rowid": False}
+    user_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    transaction_count = Column(Integer, nullable=False)
+    total_amount = Column(Float, nullable=False)
+    sum_of_squares = Column(Float, nullable=False)
+    min_transaction_amount = Column(Float, nullable=False)
+    max_transaction_amount = Column(Float, nullable=False)
+
+
+# This is the model for the amount_sketches table
+# It stores the quantile sketch of each user's month as one row, with the sketch's bins and the number
+# of amounts in each bin packed into two blobs (see sketch.pack), so a month holds one row however
+# many bins its amounts fall in. month is the first day of the month.
+# Sketches are merged by adding up the counts of the same bin, see sketch.py.
+class AmountSketch(base):
+    __tablename__ = 'amount_sketches'
+    user_id = Column(Integer, primary_key=True)
+    month = Column(Date, primary_key=True)
+    bins = Column(LargeBinary, nullable=False)
+    counts = Column(LargeBinary, nullable=False)
+
+
+# This is the model for the upload_digests table
+# It stores the content digest of every upload saved since the transactions last changed, with the rows in each of its files.
+# An upload with a known digest would not change anything, so it is answered without being read again.
+# Any upload that inserts or updates a row clears the table, because older uploads may no longer match what is stored.
+class UploadDigest(base):
+    __tablename__ = 'upload_digests'
+    digest = Column(String, primary_key=True)
+    file_rows = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
@@ -0,0 +1,201 @@
+"""
+This file splits the stored transactions into one table per month when TRANSACTION_PARTITIONS=monthly.
+The transactions of a month are stored in a table named after it, e.g. transactions_202301,
+with the columns and indexes of the transactions table (which is then left empty and only
+used as their template). A month's table is created by the upload that first stores a
+transaction in that month.
+The transaction_months table maps every transaction_id to the month it is stored in, so an id
+stays unique across the months and an upload that moves a transaction to another month finds
+the old row without looking in every month's table.
+Queries only read the months they need: summaries the months their range overlaps (tables),
+and the rollup refresh the months of the days it recomputes (source). So the cost of a summary
+or an upload does not grow with the number of months stored.
+Old months are removed by dropping their tables (drop_before), which frees their rows and
+indexes at once instead of deleting them row by row. With TRANSACTION_RETENTION_MONTHS set
+this is done at startup and after every upload.
+Without partitions these functions return the transactions table, so callers do not need to check.
+"""
+import logging
+import os
+import threading
+from datetime import date
+from typing import TYPE_CHECKING
+from sqlalchemy import MetaData, text
+from sqlalchemy.orm import Session
+import cache
+import models
+import storage
+
+# pandas is only needed to stage uploads, so it is not imported for the annotations
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Months of transactions to keep, counting the current month, 0 keeps every month
+# Only used with partitions, as older months are removed by dropping their tables
+TRANSACTION_RETENTION_MONTHS = int(os.environ.get("TRANSACTION_RETENTION_MONTHS", "0"))
+
+ENABLED = storage.PARTITIONED
+
+# The transactions table, every month's table is a copy of it
+TEMPLATE = models.Transaction.__table__
+
+# The columns read from the months' tables in raw SQL, the same in both storage layouts
+COLUMNS = "transaction_id, user_id, product_id, timestamp, transaction_amount"
+
+# The months' tables, found by their names so the table list is read in the same transaction as the rows
+SELECT_MONTHS = """
+SELECT CAST(substr(name, 14) AS INTEGER) FROM sqlite_master
+WHERE type = 'table' AND name GLOB 'transactions_[0-9][0-9][0-9][0-9][0-9][0-9]'
+  AND name BETWEEN ? AND ?
+ORDER BY name
+"""
+
+# Each month's table object is built once and kept here, guarded by a lock as summaries run in many threads
+_metadata = MetaData()
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+# This returns the month of a date or datetime as a number, e.g. 202301 for January 2023
+def month_of(value) -> int:
+    return value.year * 100 + value.month
+
+
+# This returns the month of every timestamp in a column, as month_of does
+# Timezones are dropped like the stored timestamps, so the month of the wall clock time is used
+def months_of(column: "pd.Series") -> list:
+    return (column.dt.year * 100 + column.dt.month).tolist()
+
+
+# This returns the first day of a month, e.g. 2023-01-01 for 202301
+def first_day(month: int) -> date:
+    return date(month // 100, month % 100, 1)
+
+
+# This returns the month that is a number of months after another one (before it if negative)
+def add_months(month: int, months: int) -> int:
+    index = (month // 100) * 12 + month % 100 - 1 + months
+    return (index // 12) * 100 + index % 12 + 1
+
+
+# This returns the name of a month's table
+def table_name(month: int) -> str:
+    return f"{TEMPLATE.name}_{month:06d}"
+
+
+# This returns the table object of a month, with the transactions table's columns and indexes
+# The composite index has a fixed name, so every index is renamed after the month's table
+def table(month: int):
+    name = table_name(month)
+    with _tables_lock:
+        if name not in _tables:
+            partition = TEMPLATE.to_metadata(_metadata, name=name)
+            for index in partition.indexes:
+                if not index.name.startswith(f"ix_{name}_"):
+                    index.name = index.name.replace(f"ix_{TEMPLATE.name}_", f"ix_{name}_", 1)
+            _tables[name] = partition
+        return _tables[name]
+
+
+# This returns the months that have a table, from first to last inclusive when they are given
+# db can be a Session or a Connection. Every summary reads this list, so it is read with a raw
+# cursor, which takes a fraction of the time of a SQLAlchemy statement
+def stored_months(db, first: int = 0, last: int = 999999) -> list:
+    connection = db.connection() if isinstance(db, Session) else db
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(SELECT_MONTHS, (table_name(first), table_name(last)))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+# This returns the tables holding the transactions between lower and upper, for ORM queries
+# Only the months the range overlaps are returned, or the transactions table without partitions
+def tables(db: Session, lower, upper) -> list:
+    if not ENABLED:
+        return [TEMPLATE]
+    return [table(month) for month in stored_months(db, month_of(lower), month_of(upper))]
+
+
+"""
+This function returns what raw SQL should read the transactions from, in place of the transactions table.
+Without partitions that is the transactions table. With them it is a UNION ALL of the tables
+of the given months (every month when months is None) that exist, and SQLite applies the
+query's WHERE clause to each of them, so each one is still read through its own indexes.
+Without any such table the empty transactions table is returned, so the SQL stays valid.
+"""
+def source(db, months=None) -> str:
+    if not ENABLED:
+        return TEMPLATE.name
+    wanted = None if months is None else set(months)
+    names = [table_name(month) for month in stored_months(db) if wanted is None or month in wanted]
+    if not names:
+        return TEMPLATE.name
+    return "(" + " UNION ALL ".join(f"SELECT {COLUMNS} FROM {name}" for name in names) + ")"
+
+
+# This creates the tables of the given months that do not exist yet
+# It runs in the caller's transaction, so tables created by an upload that fails are rolled back with it
+def ensure(db: Session, months) -> None:
+    missing = set(months) - set(stored_months(db))
+    for month in sorted(missing):
+        table(month).create(bind=db.connection())
+
+
+"""
+This function removes every month before the given one (e.g. 202301 keeps January 2023 onwards).
+The months' tables are dropped with their indexes, and their ids, daily rollups and sketches
+are deleted. The known upload digests are cleared too, because an earlier upload may now have
+rows that are no longer stored.
+It commits the caller's transaction, then takes the months out of the Parquet dataset and clears
+the summary cache, as any user's cached summary may have included them. The cache is cleared
+even if the Parquet files could not be removed. It returns the months that were removed.
+"""
+def drop_before(db: Session, month: int) -> list:
+    # columnar imports this file, so it is imported when it is needed
+    import columnar
+
+    months = stored_months(db, last=add_months(month, -1))
+    if not months:
+        return []
+    for dropped in months:
+        db.execute(text(f"DROP TABLE {table_name(dropped)}"))
+    db.query(models.TransactionMonth).filter(models.TransactionMonth.month < month).delete(synchronize_session=False)
+    db.query(models.DailyRollup).filter(models.DailyRollup.day < first_day(month)).delete(synchronize_session=False)
+    db.query(models.AmountSketch).filter(models.AmountSketch.month < first_day(month)).delete(synchronize_session=False)
+    db.query(models.UploadDigest).delete(synchronize_session=False)
+    db.commit()
+    try:
+        if columnar.ENABLED:
+            columnar.drop_months(months)
+    finally:
+        cache.summary_cache.clear()
+    return months
+
+
+# This removes the months older than TRANSACTION_RETENTION_MONTHS, see drop_before
+# It runs after every upload, in a request or a job, and at startup, and returns the months that were removed
+def apply_retention(db: Session, today: date = None) -> list:
+    if not ENABLED or TRANSACTION_RETENTION_MONTHS <= 0:
+        return []
+    oldest = add_months(month_of(today or date.today()), 1 - TRANSACTION_RETENTION_MONTHS)
+    months = drop_before(db, oldest)
+    if months:
+        logger.info(f"Removed the transactions of months {months} older than the retention period")
+    return months
+
+
+# This runs apply_retention after an upload that is already saved, so a failure must not fail the upload
+# The failure is logged and the transaction rolled back, the months are removed by a later upload or at startup
+# It returns whether the retention was applied
+def try_apply_retention(db: Session) -> bool:
+    try:
+        apply_retention(db)
+        return True
+    except Exception:
+        db.rollback()
+        logger.exception("Could not remove the months older than the retention period")
+        return False
@@ -0,0 +1,252 @@
+"""
+This file maintains the daily_rollups and amount_sketches tables.
+Every upload records which (user_id, day) pairs it touches, including the day a row used to
+be on when an upsert changes or moves an existing transaction_id.
+Those days are then recomputed from the transactions table, so the rollup always matches it.
+Sketches are kept per user and month, so the months holding an affected day are recomputed,
+with the sketch bins worked out by numpy from the amounts. Each month's sketch is packed into
+one row (see sketch.pack), so a cold load writes one sketch row per user and month rather than
+one per bin, which would be almost one per transaction.
+With monthly partitions only the tables of the affected months are read, see partitions.py.
+"""
+from datetime import date
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+import database
+import partitions
+import sketch
+import storage
+
+AFFECTED_TABLE = "_rollup_affected"
+
+# Number of transactions read at a time when the sketches are recomputed
+SKETCH_READ_ROWS = 500_000
+
+# The day of a timestamp, and the month of a timestamp or a day as the first day of that month (e.g. 2023-01-01)
+# SQLite stores timestamps as text like 2023-01-01 12:00:00.000000, PostgreSQL has real dates
+# and the compact layout (see storage.py) stores epoch microseconds
+DAY_OF_TIMESTAMP = {
+    "sqlite": "substr({column}, 1, 10)",
+    "postgresql": "CAST({column} AS DATE)",
+    "compact": "date({column} / 1000000, 'unixepoch')",
+}
+MONTH_OF_TIMESTAMP = {
+    "sqlite": "substr({column}, 1, 7) || '-01'",
+    "postgresql": "CAST(date_trunc('month', {column}) AS DATE)",
+    "compact": "strftime('%Y-%m-01', {column} / 1000000, 'unixepoch')",
+}
+MONTH_OF_DAY = {
+    "sqlite": "substr({column}, 1, 7) || '-01'",
+    "postgresql": "CAST(date_trunc('month', {column}) AS DATE)",
+}
+
+# The total, sum of squares, minimum and maximum amount of a group of transactions
+# Compact amounts are integer cents, so the total is summed exactly before it is turned into currency units
+AMOUNT_AGGREGATES = {
+    "sqlite": "SUM(transaction_amount), SUM(transaction_amount * transaction_amount), "
+              "MIN(transaction_amount), MAX(transaction_amount)",
+    "postgresql": "SUM(transaction_amount), SUM(transaction_amount * transaction_amount), "
+                  "MIN(transaction_amount), MAX(transaction_amount)",
+    "compact": f"SUM(transaction_amount) / {storage.CENTS}.0, "
+               f"SUM(CAST(transaction_amount AS REAL) * transaction_amount) / {storage.CENTS ** 2}.0, "
+               f"MIN(transaction_amount) / {storage.CENTS}.0, MAX(transaction_amount) / {storage.CENTS}.0",
+}
+
+CREATE_AFFECTED = f"""
+CREATE TEMP TABLE IF NOT EXISTS {AFFECTED_TABLE} (
+    user_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    PRIMARY KEY (user_id, day)
+)
+"""
+
+# Both the new day of every staged row and the current day of any row it will overwrite are affected
+# The WHERE clause (true unless only some staged rows are stored in the table) is needed so SQLite
+# does not read ON CONFLICT as part of the join
+TRACK_STAGED = f"""
+INSERT INTO {AFFECTED_TABLE} (user_id, day)
+SELECT user_id, {{day_of_timestamp}} FROM {{staging}} WHERE true
+ON CONFLICT DO NOTHING
+"""
+
+TRACK_REPLACED = f"""
+INSERT INTO {AFFECTED_TABLE} (user_id, day)
+SELECT t.user_id, {{day_of_t_timestamp}}
+FROM {{staging}} s JOIN {{transactions}} t ON t.transaction_id = s.transaction_id WHERE {{staged}}
+ON CONFLICT DO NOTHING
+"""
+
+# The months that hold an affected day
+AFFECTED_MONTHS = f"SELECT DISTINCT {{month_of_day}} FROM {AFFECTED_TABLE}"
+
+# Only the transactions of affected users are read, and only their affected days are used
+AFFECTED_TRANSACTIONS = f"""
+FROM {{transactions}}
+WHERE user_id IN (SELECT user_id FROM {AFFECTED_TABLE})
+  AND (user_id, {{day_of_timestamp}}) IN (SELECT user_id, day FROM {AFFECTED_TABLE})
+"""
+
+DELETE_AFFECTED_ROLLUPS = f"""
+DELETE FROM daily_rollups
+WHERE (user_id, day) IN (SELECT user_id, day FROM {AFFECTED_TABLE})
+"""
+
+# Every transaction in a month that holds an affected day
+AFFECTED_MONTH_TRANSACTIONS = f"""
+FROM {{transactions}}
+WHERE user_id IN (SELECT user_id FROM {AFFECTED_TABLE})
+  AND (user_id, {{month_of_timestamp}}) IN
+      (SELECT DISTINCT user_id, {{month_of_day}} FROM {AFFECTED_TABLE})
+"""
+
+DELETE_AFFECTED_SKETCHES = f"""
+DELETE FROM amount_sketches
+WHERE (user_id, month) IN (SELECT DISTINCT user_id, {{month_of_day}} FROM {AFFECTED_TABLE})
+"""
+
+INSERT_ROLLUPS = """
+INSERT INTO daily_rollups (user_id, day, transaction_count, total_amount, sum_of_squares,
+                           min_transaction_amount, max_transaction_amount)
+SELECT user_id, {day_of_timestamp} AS day,
+       COUNT(*), {amount_aggregates}
+{source}
+GROUP BY user_id, day
+"""
+
+SELECT_AMOUNTS = """
+SELECT user_id, {month_of_timestamp} AS month, {amount} AS transaction_amount
+{source}
+"""
+
+INSERT_SKETCH = "INSERT INTO amount_sketches (user_id, month, bins, counts) VALUES ({p}, {p}, {p}, {p})"
+
+
+# This fills in the database's day, month and amount expressions and any other names in a statement
+# Timestamp and amount expressions depend on the storage layout, day expressions only on the database
+# Sources are filled in first, because they hold expressions too
+# transactions is what the transactions are read from (see partitions.source)
+def _sql(db: Session, statement: str, transactions: str = "transactions", **names) -> str:
+    dialect = db.get_bind().dialect
+    layout = storage.layout(db.get_bind())
+    expressions = {
+        "day_of_timestamp": DAY_OF_TIMESTAMP[layout].format(column="timestamp"),
+        "day_of_t_timestamp": DAY_OF_TIMESTAMP[layout].format(column="t.timestamp"),
+        "month_of_timestamp": MONTH_OF_TIMESTAMP[layout].format(column="timestamp"),
+        "month_of_day": MONTH_OF_DAY[dialect.name].format(column="day"),
+        "amount": storage.AMOUNT[layout],
+        "amount_aggregates": AMOUNT_AGGREGATES[layout],
+        "p": database.placeholder(db.get_bind()),
+        "transactions": transactions,
+    }
+    names = {name: value.format(**expressions) if name == "source" else value for name, value in names.items()}
+    return statement.format(**expressions, **names)
+
+
+# This records the days touched by the rows in the staging table
+# It must run before the staging table is merged, while the old rows are still in place
+# stored_in lists the tables the staged rows may be stored in now, each with the condition (on
+# the staging table s) of the rows stored in it, by default every row and the transactions table
+def track_staged(db: Session, staging_table: str, stored_in: list = None) -> None:
+    db.execute(text(CREATE_AFFECTED))
+    db.execute(text(_sql(db, TRACK_STAGED, staging=staging_table)))
+    for transactions, staged in stored_in if stored_in is not None else [("transactions", "true")]:
+        db.execute(text(_sql(db, TRACK_REPLACED, transactions, staging=staging_table, staged=staged)))
+
+
+# This returns the months that hold a day recorded by track_staged, as the first day of each month
+# SQLite returns them as text and PostgreSQL as dates
+def affected_months(db: Session) -> set[date]:
+    db.execute(text(CREATE_AFFECTED))
+    months = db.execute(text(_sql(db, AFFECTED_MONTHS))).scalars()
+    return {month if isinstance(month, date) else date.fromisoformat(month) for month in months}
+
+
+# This returns what the transactions of the affected days are read from
+# With partitions that is only the tables of the affected months
+def _affected_source(db: Session) -> str:
+    if not partitions.ENABLED:
+        return partitions.source(db)
+    return partitions.source(db, [partitions.month_of(month) for month in affected_months(db)])
+
+
+"""
+This function writes the sketch of every (user_id, month) in the selected transactions.
+The amounts are read with a raw cursor in bounded batches, binned with numpy and counted per
+(user_id, month, bin). One month's amounts can arrive in different reads, so the counts of every
+read are added up before each month's bins and counts are packed into its row. The rows are
+written in primary key order so the sketch table is filled sequentially.
+pandas is imported here as the sketches are only written by uploads and rebuilds, not by summaries.
+"""
+def _write_sketches(db: Session, source: str, transactions: str = "transactions") -> None:
+    import pandas as pd
+
+    connection = db.connection().connection.dbapi_connection
+    reader = connection.cursor()
+    writer = connection.cursor()
+    try:
+        reader.execute(_sql(db, SELECT_AMOUNTS, transactions, source=source))
+        read_counts = []
+        while rows := reader.fetchmany(SKETCH_READ_ROWS):
+            frame = pd.DataFrame.from_records(rows, columns=["user_id", "month", "transaction_amount"])
+            frame["bin"] = sketch.bins_of(frame["transaction_amount"].to_numpy())
+            read_counts.append(frame.groupby(["user_id", "month", "bin"]).size())
+        if not read_counts:
+            return
+        counts = pd.concat(read_counts).groupby(level=[0, 1, 2]).sum()
+        users = counts.index.get_level_values(0).to_numpy()
+        months = counts.index.get_level_values(1).to_numpy()
+        bins = counts.index.get_level_values(2).to_numpy()
+        totals = counts.to_numpy()
+        # Each sketch is the run of bins between one (user_id, month) and the next
+        starts = np.flatnonzero(np.r_[True, (users[1:] != users[:-1]) | (months[1:] != months[:-1])])
+        ends = np.r_[starts[1:], len(counts)]
+        writer.executemany(_sql(db, INSERT_SKETCH), (
+            (int(users[start]), months[start], *sketch.pack(bins[start:end], totals[start:end]))
+            for start, end in zip(starts.tolist(), ends.tolist())
+        ))
+    finally:
+        reader.close()
+        writer.close()
+
+
+"""
+This function recomputes the rollup and sketch rows of every day recorded by track_staged.
+Days that no longer have any transactions are removed.
+It runs in the caller's transaction, so the rollup is committed together with the rows.
+It returns the user_ids whose days were recomputed.
+"""
+def refresh(db: Session) -> set[int]:
+    db.execute(text(CREATE_AFFECTED))
+    user_ids = set(db.execute(text(f"SELECT DISTINCT user_id FROM {AFFECTED_TABLE}")).scalars())
+    if user_ids:
+        db.execute(text(DELETE_AFFECTED_ROLLUPS))
+        db.execute(text(_sql(db, DELETE_AFFECTED_SKETCHES)))
+        transactions = _affected_source(db)
+        db.execute(text(_sql(db, INSERT_ROLLUPS, transactions, source=AFFECTED_TRANSACTIONS)))
+        _write_sketches(db, AFFECTED_MONTH_TRANSACTIONS, transactions)
+        db.execute(text(f"DELETE FROM {AFFECTED_TABLE}"))
+    return user_ids
+
+
+# This rebuilds the whole rollup and sketch tables from the transactions table
+def rebuild(db: Session) -> None:
+    transactions = partitions.source(db)
+    db.execute(text("DELETE FROM daily_rollups"))
+    db.execute(text("DELETE FROM amount_sketches"))
+    db.execute(text(_sql(db, INSERT_ROLLUPS, transactions, source="FROM {transactions}")))
+    _write_sketches(db, "FROM {transactions}", transactions)
+
+
+# This builds the rollup for a database created before the rollup or sketch tables existed,
+# or whose sketch table was recreated by migrations.upgrade
+# It returns True if the rollup had to be built
+def ensure_built(db: Session) -> bool:
+    has_rollups = db.execute(text("SELECT 1 FROM daily_rollups LIMIT 1")).first()
+    has_sketches = db.execute(text("SELECT 1 FROM amount_sketches LIMIT 1")).first()
+    has_transactions = db.execute(text(f"SELECT 1 FROM {partitions.source(db)} LIMIT 1")).first()
+    if (has_rollups and has_sketches) or not has_transactions:
+        return False
+    rebuild(db)
+    db.commit()
+    return True
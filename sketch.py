@@ -0,0 +1,88 @@
+"""
+This file contains the quantile sketch used for approximate percentiles of transaction amounts.
+It is a DDSketch: every amount is counted in a logarithmic bin, so a percentile read back from
+the bins is within RELATIVE_ACCURACY of the true value.
+Sketches of different months or users are merged by adding up the counts of equal bins, which
+means they can be stored per user and month, packed into one row each, and combined with numpy.
+"""
+import math
+import numpy as np
+from sqlalchemy import Integer, case, cast, func
+
+# Percentiles are accurate to within 1% of the true amount
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+# Amounts of zero have no logarithm, so they are counted in a bin below every other bin
+ZERO_BIN = -(2**31)
+
+# The percentiles returned by the summary endpoint
+PERCENTILES = {"p50": 0.50, "p95": 0.95, "p99": 0.99}
+
+# Stored sketches pack their bins as 32 bit and their counts as 64 bit little endian integers
+BIN_TYPE = np.dtype("<i4")
+COUNT_TYPE = np.dtype("<i8")
+
+
+# This returns the bin of every amount in the array
+def bins_of(amounts: np.ndarray) -> np.ndarray:
+    amounts = np.asarray(amounts, dtype="float64")
+    bins = np.full(len(amounts), ZERO_BIN, dtype="int64")
+    positive = amounts > 0
+    bins[positive] = np.ceil(np.log(amounts[positive]) / LOG_GAMMA).astype("int64")
+    return bins
+
+
+# This returns the SQL expression for the bin of an amount expression, the bin bins_of works out
+# ln and ceil are built into SQLite (3.35 onwards) and PostgreSQL, so the rows can be counted per
+# bin by the database without being read
+def bin_of(amount):
+    return case((amount > 0, cast(func.ceil(func.ln(amount) / LOG_GAMMA), Integer)), else_=ZERO_BIN)
+
+
+# This returns the amount a bin stands for, the point with the same relative error to both of its edges
+def bin_value(bin_number: int) -> float:
+    if bin_number == ZERO_BIN:
+        return 0.0
+    return 2 * GAMMA**bin_number / (GAMMA + 1)
+
+
+# This packs the bins and counts of one sketch into the two blobs it is stored as
+def pack(bins: np.ndarray, counts: np.ndarray) -> tuple[bytes, bytes]:
+    return np.asarray(bins).astype(BIN_TYPE).tobytes(), np.asarray(counts).astype(COUNT_TYPE).tobytes()
+
+
+# This merges stored sketches, given as (bins, counts) blob pairs, into a dict of bin to count
+def unpack(rows) -> dict:
+    if not rows:
+        return {}
+    bins = np.concatenate([np.frombuffer(packed_bins, BIN_TYPE) for packed_bins, _ in rows])
+    counts = np.concatenate([np.frombuffer(packed_counts, COUNT_TYPE) for _, packed_counts in rows])
+    unique, positions = np.unique(bins, return_inverse=True)
+    totals = np.zeros(len(unique), dtype="int64")
+    np.add.at(totals, positions, counts)
+    return dict(zip(unique.tolist(), totals.tolist()))
+
+
+# This adds the counts of one sketch into another
+def merge(into: dict, other: dict) -> dict:
+    for bin_number, count in other.items():
+        into[bin_number] = into.get(bin_number, 0) + count
+    return into
+
+
+# This reads the requested quantiles out of a sketch
+# It returns None for every quantile if the sketch is empty
+def quantiles(sketch: dict, requested: dict = PERCENTILES) -> dict:
+    total = sum(sketch.values())
+    if not total:
+        return {name: None for name in requested}
+    ordered = sorted(sketch.items())
+    cumulative = np.cumsum([count for _, count in ordered])
+    result = {}
+    for name, quantile in requested.items():
+        # The rank of the quantile among the amounts, counted from 0
+        position = int(np.searchsorted(cumulative, quantile * (total - 1), side="right"))
+        result[name] = bin_value(ordered[min(position, len(ordered) - 1)][0])
+    return result
@@ -0,0 +1,114 @@
+"""
+This file prepares the database and warms up the application before it serves requests.
+prepare_database creates the tables, runs the migrations, builds the daily rollup (and the
+Parquet dataset when SUMMARY_BACKEND=parquet) of a database that does not have them yet and
+removes the months older than the retention period. Nothing is done when main.py is imported:
+the server runs it from its lifespan when it starts, or, with DATABASE_SETUP_ON_STARTUP=false,
+it is run once before the servers are started with python startup.py, so several workers
+do not all do it at the same time.
+With DATABASE_PREWARM=true the server also warms up before it accepts requests: the SQLite file
+is read into the operating system's page cache, the read pool's connections are opened and
+every summary query is run once on each of them for a user that has no transactions, so the
+queries are compiled and prepared before the first real summary asks for them.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from sqlalchemy.orm import Session
+import columnar
+import database
+import migrations
+import models
+import partitions
+import rollup
+import summary
+
+logger = logging.getLogger(__name__)
+
+# Prepare the database when the server starts, turn it off when it is prepared with python startup.py instead
+DATABASE_SETUP_ON_STARTUP = os.environ.get("DATABASE_SETUP_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+# Warm up the page cache, the connections and the summary queries before the server accepts requests
+DATABASE_PREWARM = os.environ.get("DATABASE_PREWARM", "false").lower() in ("1", "true", "yes")
+
+# The size of each read when the database file is read into the page cache
+PREWARM_READ_BYTES = 1024 * 1024
+
+# The warm up summaries are for this user, which never has transactions, over a range with
+# partial days at both ends and whole days and months between them, so every query is run
+PREWARM_USER_ID = -1
+PREWARM_RANGE = (datetime(2000, 1, 1, 12, 0), datetime(2000, 3, 15, 12, 0))
+
+
+# This creates and migrates the tables and builds what is derived from the transactions, then commits
+def prepare_database() -> None:
+    models.base.metadata.create_all(bind=database.dbengine)
+    migrations.upgrade(database.dbengine)
+    with database.session() as db:
+        # Builds the daily rollup for a database that was created before the rollup table existed
+        rollup.ensure_built(db)
+        # Builds the Parquet dataset when summaries are read from it and it does not exist yet
+        if columnar.ENABLED:
+            columnar.ensure_built(db)
+        # Removes the months older than TRANSACTION_RETENTION_MONTHS when the transactions are partitioned by month
+        partitions.apply_retention(db)
+
+
+# This reads a file from start to end, so its pages are in the operating system's page cache
+# The pages are shared by every connection, and by SQLite's memory mapped reads
+def _read_file(path: str) -> int:
+    size = 0
+    with open(path, "rb") as file:
+        while chunk := file.read(PREWARM_READ_BYTES):
+            size += len(chunk)
+    return size
+
+
+# This runs every kind of summary once on a session
+def _warm_summaries(db: Session) -> None:
+    summary.get_CSV_summary(db, PREWARM_USER_ID, *PREWARM_RANGE)
+    summary.get_summary_statistics(db, PREWARM_USER_ID, *PREWARM_RANGE, True, "month")
+    summary.get_batch_summary(db, [PREWARM_USER_ID], *PREWARM_RANGE)
+
+
+"""
+This function warms up the sync read path, see the top of this file.
+All of the read pool's connections are checked out at once, so each one is opened (and has its
+pragmas applied) now, and the summaries are run on each of them, as SQLite keeps prepared
+statements per connection. SQLAlchemy keeps the compiled queries for the whole engine.
+"""
+def prewarm() -> None:
+    started = time.perf_counter()
+    engine = database.reader_engine
+    cached = 0
+    if database.is_sqlite(engine) and engine.url.database and os.path.exists(engine.url.database):
+        cached = _read_file(engine.url.database)
+
+    connections = [engine.connect() for _ in range(database.DATABASE_POOL_SIZE)]
+    try:
+        for connection in connections:
+            with Session(bind=connection) as db:
+                _warm_summaries(db)
+            connection.rollback()
+    finally:
+        for connection in connections:
+            connection.close()
+
+    if columnar.ENABLED:
+        columnar.get_CSV_summary(PREWARM_USER_ID, *PREWARM_RANGE)
+    logger.info(f"Prewarmed {len(connections)} connections and {cached / 1024 / 1024:.1f}MB of the database "
+                f"in {time.perf_counter() - started:.2f}s")
+
+
+# This warms up the async read path used with ASYNC_SUMMARIES, its engine compiles its queries separately
+async def prewarm_async() -> None:
+    async with database.async_read_session() as db:
+        await summary.get_CSV_summary_async(db, PREWARM_USER_ID, *PREWARM_RANGE)
+        await summary.get_summary_statistics_async(db, PREWARM_USER_ID, *PREWARM_RANGE, True, "month")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    prepare_database()
+    logger.info("The database is ready.")
@@ -0,0 +1,169 @@
+"""
+This file defines how the values of the transactions table are stored.
+TRANSACTION_STORAGE=standard (the default) keeps transaction_id and timestamps as text and
+amounts as floats, next to a surrogate id primary key.
+TRANSACTION_STORAGE=compact (SQLite only) stores UUID shaped transaction_ids as 16 byte blobs
+(other ids stay text), timestamps as epoch microseconds and amounts as integer cents, in a
+WITHOUT ROWID table clustered on (user_id, timestamp, transaction_id), so a user's date range
+is one contiguous part of the table and no covering index is needed.
+The column names are the same in both layouts. ORM queries work unchanged through the column
+types below, and raw SQL statements take their layout dependent expressions from here.
+TRANSACTION_PARTITIONS=monthly (SQLite only) splits the table into one table per month, with
+either layout, see partitions.py.
+"""
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+import numpy as np
+from sqlalchemy import BigInteger, Float, Integer, cast, func, type_coerce
+from sqlalchemy.types import TypeDecorator, UserDefinedType
+
+# pandas is only needed to stage uploads, so it is not imported for the annotations
+if TYPE_CHECKING:
+    import pandas as pd
+
+# The storage layout of the transactions table, standard or compact
+TRANSACTION_STORAGE = os.environ.get("TRANSACTION_STORAGE", "standard")
+
+COMPACT = TRANSACTION_STORAGE == "compact"
+
+if TRANSACTION_STORAGE not in ("standard", "compact"):
+    raise RuntimeError(f"Unknown TRANSACTION_STORAGE {TRANSACTION_STORAGE!r}, use standard or compact.")
+
+# How the transactions are split into tables, none (one table) or monthly (one table per month)
+TRANSACTION_PARTITIONS = os.environ.get("TRANSACTION_PARTITIONS", "none")
+
+PARTITIONED = TRANSACTION_PARTITIONS == "monthly"
+
+if TRANSACTION_PARTITIONS not in ("none", "monthly"):
+    raise RuntimeError(f"Unknown TRANSACTION_PARTITIONS {TRANSACTION_PARTITIONS!r}, use none or monthly.")
+
+# Amounts are stored in cents, the minor unit of the currency
+CENTS = 100
+
+# Only the canonical lowercase form is stored as a blob, so every id reads back exactly as it was uploaded
+UUID_PATTERN = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+
+EPOCH = datetime(1970, 1, 1)
+
+# The amount of a transaction in currency units in raw SQL, for each layout
+AMOUNT = {
+    "sqlite": "transaction_amount",
+    "postgresql": "transaction_amount",
+    "compact": f"transaction_amount / {CENTS}.0",
+}
+
+
+# This returns the key of a layout dependent SQL expression: compact, or the database's dialect name
+def layout(bind) -> str:
+    return "compact" if COMPACT else bind.dialect.name
+
+
+# This checks that the compact layout is only used with SQLite, which it relies on for mixing blob and text ids
+# Monthly partitions are only used with SQLite too, as they find their tables in sqlite_master
+def check_database(bind) -> None:
+    if COMPACT and bind.dialect.name != "sqlite":
+        raise RuntimeError("TRANSACTION_STORAGE=compact is only supported on SQLite.")
+    if PARTITIONED and bind.dialect.name != "sqlite":
+        raise RuntimeError("TRANSACTION_PARTITIONS=monthly is only supported on SQLite.")
+
+
+# A BLOB column type that leaves its values to CompactId
+class _Blob(UserDefinedType):
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return "BLOB"
+
+
+# The compact transaction_id: UUIDs are stored as their 16 bytes, any other id as text
+# SQLite never finds a blob equal to text, so the two kinds of id cannot collide
+class CompactId(TypeDecorator):
+    impl = _Blob
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str) and re.fullmatch(UUID_PATTERN, value):
+            return uuid.UUID(value).bytes
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return str(uuid.UUID(bytes=value))
+        return value
+
+
+# The compact timestamp: microseconds since 1970-01-01
+# Timezones are dropped like the standard layout does, so the wall clock time is stored
+class EpochMicros(TypeDecorator):
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            return (value.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+        return value
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else EPOCH + timedelta(microseconds=value)
+
+
+# The compact amount: integer cents, rounded to the nearest cent
+# SUM, MIN and MAX keep this type, so their results are turned back into currency units too
+# AVG does not, so averages are worked out as the SUM over the COUNT
+class Cents(TypeDecorator):
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else round(value * CENTS)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else value / CENTS
+
+
+# This returns the staged values of a transaction_id column, as CompactId stores them
+def compact_ids(column: "pd.Series") -> list:
+    ids = column.astype(str)
+    values = ids.tolist()
+    is_uuid = ids.str.fullmatch(UUID_PATTERN).to_numpy(dtype=bool)
+    for position, digits in zip(np.flatnonzero(is_uuid), ids[is_uuid].str.replace("-", "", regex=False)):
+        values[position] = bytes.fromhex(digits)
+    return values
+
+
+# This returns the staged values of a timestamp column as epoch microseconds
+def epoch_micros(column: "pd.Series") -> list:
+    if getattr(column.dt, "tz", None) is not None:
+        column = column.dt.tz_localize(None)
+    return column.to_numpy(dtype="datetime64[us]").astype("int64").tolist()
+
+
+# This returns the staged values of an amount column as integer cents
+def cents(column: "pd.Series") -> list:
+    return np.round(column.to_numpy(dtype="float64") * CENTS).astype("int64").tolist()
+
+
+# This returns the square of the amount column in currency units, for sums of squares in ORM queries
+# Cents would only be scaled back once by the column type, so compact squares are worked out explicitly
+def squared(column):
+    if COMPACT:
+        return cast(column, Float) * cast(column, Float) / (CENTS * CENTS)
+    return column * column
+
+
+# This returns the amount column in currency units for SQL functions such as ln, whose results
+# the column type does not convert back
+def amount_value(column):
+    if COMPACT:
+        return cast(column, Float) / CENTS
+    return column
+
+
+# This returns the day of the timestamp column, as text on SQLite and as a date on PostgreSQL
+def day_of(column):
+    if COMPACT:
+        return func.date(type_coerce(column, BigInteger) // 1_000_000, "unixepoch")
+    return func.date(column)
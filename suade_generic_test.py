@@ -1,22 +1,16 @@
+"""
+This file writes dummy_transactions.csv, a million dummy transactions to try the upload with.
+The rows are made by benchmarks/datagen.py, which builds whole columns at once instead of one
+row at a time, so the file is written in seconds. The same file is written on every run.
+"""
+import sys
+from pathlib import Path
 
-import csv 
-import random 
-from pathlib import Path 
-from faker import Faker 
+sys.path.insert(0, str(Path(__file__).resolve().parent / "benchmarks"))
 
-TRANSACTIONS = 1_000_000 
-HEADERS = ["transaction_id", "user_id", "product_id", "timestamp", "transaction_amount"] 
-# Initialize Faker 
-fake = Faker() 
-# Open the CSV file for writing 
-with Path("dummy_transactions.csv").open(mode="w", newline="") as file:     
-    writer = csv.DictWriter(file, fieldnames=HEADERS)   
-    writer.writeheader()
-    # Generate dummy data 
-    for _ in range(TRANSACTIONS):         
-        writer.writerow(             
-            { "transaction_id": fake.uuid4(), "user_id": fake.random_int(min=1, max=1000), "product_id": fake.random_int(min=1, max=500),
-             "timestamp": fake.date_time_between(start_date="-1y", end_date="now"), 
-             "transaction_amount": round(random.uniform(5.0, 500.0), 2), 
-            }         
-        ) 
\ No newline at end of file
+import datagen
+
+TRANSACTIONS = 1_000_000
+
+if __name__ == "__main__":
+    datagen.write_csv(Path("dummy_transactions.csv"), TRANSACTIONS, users=1000)
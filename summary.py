@@ -1,34 +1,423 @@
 """
 This file contains the logic to generate a summary of transaction data for a user.
-It queries the database for the min, max, and average transaction amounts
-within a specified date range and returns the results in a structured format.
+It returns the min, max, and average transaction amounts within a specified date range
+in a structured format.
+Whole days inside the range are read from the daily_rollups table, and only the partial
+days at each end of the range are read from the transactions table, so the cost depends
+on the number of days in the range and not on the number of transactions.
+With monthly partitions the raw reads only query the tables of the months they overlap.
 """
+import math
+from datetime import date, datetime, time, timedelta
 from sqlalchemy.orm import Session
 from sqlalchemy import func
-from datetime import datetime
-from models import Transaction
+from models import Transaction, DailyRollup, AmountSketch
+import partitions
+import sketch
+import storage
 
-# This function queries the database to get summary statistics for a user's transactions6
-# It calculates the minimum, maximum, and average transaction amounts within a specified date range.
-def get_CSV_summary(db: Session, user_id: int, start_date: datetime, end_date: datetime):
-    
+# The most user_ids put in one IN (...) clause, well below SQLite's limit on bound parameters
+USER_ID_BATCH = 10_000
+
+# The square of a transaction's amount, built once because the compact layout's version has several parts
+AMOUNT_SQUARED = storage.squared(Transaction.transaction_amount)
+
+
+# This returns the square of the amount column of a table, AMOUNT_SQUARED for the transactions table
+def _amount_squared(table):
+    return AMOUNT_SQUARED if table is Transaction.__table__ else storage.squared(table.c.transaction_amount)
+
+
+# This returns the filter on a table's timestamp column for the range from lower to upper
+# upper is inclusive unless include_upper is False
+def _in_range(table, lower: datetime, upper: datetime, include_upper: bool):
+    timestamp = table.c.timestamp
+    return timestamp >= lower, timestamp <= upper if include_upper else timestamp < upper
+
+
+# This class holds the count, total, sum of squares, minimum and maximum of a set of transactions
+# Parts of a range are combined with merge and the average and standard deviation are worked out at the end
+class Aggregate:
+    def __init__(self, count=0, total=0.0, minimum=None, maximum=None, sum_of_squares=0.0):
+        self.count = count or 0
+        self.total = total or 0.0
+        self.sum_of_squares = sum_of_squares or 0.0
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def merge(self, other: "Aggregate") -> "Aggregate":
+        if not other.count:
+            return self
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.count += other.count
+        self.total += other.total
+        self.sum_of_squares += other.sum_of_squares
+        return self
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else None
+
+    # The population standard deviation, rounding can make the variance slightly negative so it is clamped at 0
+    @property
+    def std(self):
+        if not self.count:
+            return None
+        return math.sqrt(max(self.sum_of_squares / self.count - self.average**2, 0.0))
+
+
+# What whole_days and whole_months return for a range without any whole day or month
+NO_WHOLE_DAYS = (date.max, date.min)
+
+
+# This works out the first and last day that are fully inside the range
+# The end of the range is inclusive, so a day is whole only if the range reaches its last microsecond
+# The days are counted as ordinals, so ranges that start or end on the first or last day a date can
+# hold do not overflow, and date.max is always read as a partial day, so the day after the whole
+# days always exists
+def whole_days(start_date: datetime, end_date: datetime):
+    first = start_date.toordinal() + (start_date.time() != time.min)
+    last = min(end_date.toordinal() - (end_date.time() != time.max), date.max.toordinal() - 1)
+    if first > last:
+        return NO_WHOLE_DAYS
+    return date.fromordinal(first), date.fromordinal(last)
+
+
+# This returns midnight at the start of a day, keeping the range's timezone if it has one
+def _midnight(day, like: datetime) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=like.tzinfo)
+
+
+# This builds the query that aggregates the raw transactions of a user between lower and upper
+# upper is inclusive unless include_upper is False
+# The query only reads columns in the (user_id, timestamp, transaction_amount) index, so it never visits the table
+# (with the compact layout it reads one range of the table, which is stored in (user_id, timestamp) order)
+# table is the transactions table unless a month's table is given (see partitions.py)
+def raw_aggregate_query(db: Session, user_id: int, lower: datetime, upper: datetime, include_upper: bool = True,
+                        table=Transaction.__table__):
+    return db.query(
+        func.count(table.c.transaction_amount),
+        func.sum(table.c.transaction_amount),
+        func.min(table.c.transaction_amount),
+        func.max(table.c.transaction_amount),
+        func.sum(_amount_squared(table)),
+    ).filter(table.c.user_id == user_id, *_in_range(table, lower, upper, include_upper))
+
+
+# This aggregates the raw transactions of a user between lower and upper
+# With partitions each month's table in the range is aggregated and the results are merged
+def _raw_aggregate(db: Session, user_id: int, lower: datetime, upper: datetime, include_upper: bool = True) -> Aggregate:
+    aggregate = Aggregate()
+    for table in partitions.tables(db, lower, upper):
+        aggregate.merge(Aggregate(*raw_aggregate_query(db, user_id, lower, upper, include_upper, table).first()))
+    return aggregate
+
+
+# This aggregates the rollup rows of a user from first_day to last_day inclusive
+def _rollup_aggregate(db: Session, user_id: int, first_day, last_day) -> Aggregate:
     result = db.query(
-        func.min(Transaction.transaction_amount).label("min_transaction_amount"),
-        func.max(Transaction.transaction_amount).label("max_transaction_amount"),
-        func.avg(Transaction.transaction_amount).label("average_transaction_amount"),
-        
-    # Filters transactions by user_id and within the specified date range
+        func.sum(DailyRollup.transaction_count),
+        func.sum(DailyRollup.total_amount),
+        func.min(DailyRollup.min_transaction_amount),
+        func.max(DailyRollup.max_transaction_amount),
+        func.sum(DailyRollup.sum_of_squares),
     ).filter(
-        Transaction.user_id == user_id,
-        Transaction.timestamp >= start_date,
-        Transaction.timestamp <= end_date
+        DailyRollup.user_id == user_id,
+        DailyRollup.day >= first_day,
+        DailyRollup.day <= last_day,
     ).first()
-    
-    # Returns the summary statistics
-    # If no transactions are found, default values are returned
-    return{
+    return Aggregate(*result)
+
+
+"""
+This function aggregates a user's transactions between start_date and end_date inclusive.
+It combines the rollup for the whole days with raw reads for the partial days at each end.
+"""
+def aggregate_range(db: Session, user_id: int, start_date: datetime, end_date: datetime) -> Aggregate:
+    first_day, last_day = whole_days(start_date, end_date)
+    if first_day > last_day:
+        return _raw_aggregate(db, user_id, start_date, end_date)
+
+    aggregate = _rollup_aggregate(db, user_id, first_day, last_day)
+    aggregate.merge(_raw_aggregate(db, user_id, start_date, _midnight(first_day, start_date), include_upper=False))
+    aggregate.merge(_raw_aggregate(db, user_id, _midnight(last_day + timedelta(days=1), end_date), end_date))
+    return aggregate
+
+
+# This splits a list of user_ids into groups small enough for one IN (...) clause
+def _user_id_batches(user_ids):
+    if user_ids is None:
+        yield None
+        return
+    for start in range(0, len(user_ids), USER_ID_BATCH):
+        yield user_ids[start:start + USER_ID_BATCH]
+
+
+# This adds grouped aggregate rows to the per user aggregates
+def _merge_grouped(aggregates: dict, rows) -> None:
+    for user_id, *values in rows:
+        aggregates.setdefault(user_id, Aggregate()).merge(Aggregate(*values))
+
+
+# This aggregates the raw transactions between lower and upper for many users with one GROUP BY query
+# (one per month's table in the range with partitions)
+def _grouped_raw(db: Session, aggregates: dict, user_ids, lower: datetime, upper: datetime, include_upper: bool = True) -> None:
+    for table in partitions.tables(db, lower, upper):
+        for batch in _user_id_batches(user_ids):
+            query = db.query(
+                table.c.user_id,
+                func.count(table.c.transaction_amount),
+                func.sum(table.c.transaction_amount),
+                func.min(table.c.transaction_amount),
+                func.max(table.c.transaction_amount),
+                func.sum(_amount_squared(table)),
+            ).filter(*_in_range(table, lower, upper, include_upper))
+            if batch is not None:
+                query = query.filter(table.c.user_id.in_(batch))
+            _merge_grouped(aggregates, query.group_by(table.c.user_id).all())
+
+
+# This aggregates the rollup rows from first_day to last_day for many users with one GROUP BY query
+def _grouped_rollup(db: Session, aggregates: dict, user_ids, first_day, last_day) -> None:
+    for batch in _user_id_batches(user_ids):
+        query = db.query(
+            DailyRollup.user_id,
+            func.sum(DailyRollup.transaction_count),
+            func.sum(DailyRollup.total_amount),
+            func.min(DailyRollup.min_transaction_amount),
+            func.max(DailyRollup.max_transaction_amount),
+            func.sum(DailyRollup.sum_of_squares),
+        ).filter(
+            DailyRollup.day >= first_day,
+            DailyRollup.day <= last_day,
+        )
+        if batch is not None:
+            query = query.filter(DailyRollup.user_id.in_(batch))
+        _merge_grouped(aggregates, query.group_by(DailyRollup.user_id).all())
+
+
+"""
+This function aggregates the transactions of many users between start_date and end_date inclusive.
+user_ids=None means every user with transactions in the range.
+It runs the same rollup and partial day reads as aggregate_range, but each one is a single
+query grouped by user_id, so the number of queries does not grow with the number of users.
+It returns a dict of user_id to Aggregate for the users that have transactions.
+"""
+def aggregate_users(db: Session, user_ids, start_date: datetime, end_date: datetime) -> dict:
+    aggregates = {}
+    first_day, last_day = whole_days(start_date, end_date)
+    if first_day > last_day:
+        _grouped_raw(db, aggregates, user_ids, start_date, end_date)
+        return aggregates
+
+    _grouped_rollup(db, aggregates, user_ids, first_day, last_day)
+    _grouped_raw(db, aggregates, user_ids, start_date, _midnight(first_day, start_date), include_upper=False)
+    _grouped_raw(db, aggregates, user_ids, _midnight(last_day + timedelta(days=1), end_date), end_date)
+    return aggregates
+
+
+# This turns an Aggregate into the summary response fields
+# If no transactions are found, default values are returned
+def summary_from_aggregate(user_id: int, result: Aggregate) -> dict:
+    return {
         "user_id": user_id,
-        "min_transaction_amount": result.min_transaction_amount or 0,
-        "max_transaction_amount": result.max_transaction_amount or 0,
-        "average_transaction_amount": result.average_transaction_amount or 0
-    }
\ No newline at end of file
+        "min_transaction_amount": result.minimum or 0,
+        "max_transaction_amount": result.maximum or 0,
+        "average_transaction_amount": result.average or 0
+    }
+
+
+# This function returns the summaries of many users in one pass
+# Requested users without transactions get the default values, in the order they were requested
+# With user_ids=None only the users that have transactions in the range are returned, ordered by user_id
+def get_batch_summary(db: Session, user_ids, start_date: datetime, end_date: datetime) -> list:
+    aggregates = aggregate_users(db, user_ids, start_date, end_date)
+    ordered_ids = sorted(aggregates) if user_ids is None else user_ids
+    return [summary_from_aggregate(user_id, aggregates.get(user_id, Aggregate())) for user_id in ordered_ids]
+
+
+# This function queries the database to get summary statistics for a user's transactions
+# It calculates the minimum, maximum, and average transaction amounts within a specified date range.
+def get_CSV_summary(db: Session, user_id: int, start_date: datetime, end_date: datetime):
+
+    result = aggregate_range(db, user_id, start_date, end_date)
+
+    # Returns the summary statistics
+    return summary_from_aggregate(user_id, result)
+
+
+
+# This returns the raw aggregates of a user between lower and upper grouped by day
+# date() gives the day as text on SQLite and as a date on PostgreSQL
+# A day is only ever in one month's table, so the days of each table are simply collected
+def _raw_days(db: Session, user_id: int, lower: datetime, upper: datetime, include_upper: bool = True) -> dict:
+    days = {}
+    for table in partitions.tables(db, lower, upper):
+        day = storage.day_of(table.c.timestamp)
+        rows = db.query(
+            day,
+            func.count(table.c.transaction_amount),
+            func.sum(table.c.transaction_amount),
+            func.min(table.c.transaction_amount),
+            func.max(table.c.transaction_amount),
+            func.sum(_amount_squared(table)),
+        ).filter(table.c.user_id == user_id, *_in_range(table, lower, upper, include_upper)).group_by(day).all()
+        days.update({row[0] if isinstance(row[0], date) else date.fromisoformat(row[0]): Aggregate(*row[1:]) for row in rows})
+    return days
+
+
+# This returns the quantile sketch of a user's raw transactions between lower and upper
+# The amounts are binned and counted with GROUP BY in the database, so only one row per bin is read
+def _raw_sketch(db: Session, user_id: int, lower: datetime, upper: datetime, include_upper: bool = True) -> dict:
+    merged = {}
+    for table in partitions.tables(db, lower, upper):
+        bin_number = sketch.bin_of(storage.amount_value(table.c.transaction_amount))
+        rows = db.query(bin_number, func.count()).filter(
+            table.c.user_id == user_id, *_in_range(table, lower, upper, include_upper)).group_by(bin_number).all()
+        sketch.merge(merged, dict(rows))
+    return merged
+
+
+# This returns the partial ranges at each end of a range that are not covered by whole days
+# Each one is (lower, upper, include_upper)
+def _partial_ranges(start_date: datetime, end_date: datetime, first_day, last_day) -> list:
+    if first_day > last_day:
+        return [(start_date, end_date, True)]
+    return [
+        (start_date, _midnight(first_day, start_date), False),
+        (_midnight(last_day + timedelta(days=1), end_date), end_date, True),
+    ]
+
+
+# This returns the aggregate of every day in the range that has transactions
+# Whole days come from the rollup, the partial days at each end from the raw transactions
+def daily_aggregates(db: Session, user_id: int, start_date: datetime, end_date: datetime) -> dict:
+    first_day, last_day = whole_days(start_date, end_date)
+    days = {}
+    if first_day <= last_day:
+        rows = db.query(
+            DailyRollup.day,
+            DailyRollup.transaction_count,
+            DailyRollup.total_amount,
+            DailyRollup.min_transaction_amount,
+            DailyRollup.max_transaction_amount,
+            DailyRollup.sum_of_squares,
+        ).filter(
+            DailyRollup.user_id == user_id,
+            DailyRollup.day >= first_day,
+            DailyRollup.day <= last_day,
+        ).all()
+        days = {row[0]: Aggregate(*row[1:]) for row in rows}
+    for lower, upper, include_upper in _partial_ranges(start_date, end_date, first_day, last_day):
+        for day, aggregate in _raw_days(db, user_id, lower, upper, include_upper).items():
+            days[day] = days.get(day, Aggregate()).merge(aggregate)
+    return days
+
+
+# This works out the first and last month that are fully inside the range, as the first day of each month
+# The months are counted from January of year 1, so the month before it or after December 9999 can be
+# worked out and compared without building a date for it
+def whole_months(start_date: datetime, end_date: datetime):
+    first_day, last_day = whole_days(start_date, end_date)
+    first = _month_number(first_day) + (first_day.day != 1)
+    last = _month_number(last_day + timedelta(days=1)) - 1
+    if first > last:
+        return NO_WHOLE_DAYS
+    return _month_start(first), _month_start(last)
+
+
+def _month_number(day) -> int:
+    return day.year * 12 + day.month - 13
+
+
+def _month_start(number: int):
+    return date(number // 12 + 1, number % 12 + 1, 1)
+
+
+def _next_month(day):
+    return _month_start(_month_number(day) + 1)
+
+
+# This returns the merged quantile sketch of a user's transactions in the range
+# Whole months are read from the stored sketches, one row per month, and merged with numpy, the
+# partial months at each end are binned and counted from the raw transactions in the database
+def range_sketch(db: Session, user_id: int, start_date: datetime, end_date: datetime) -> dict:
+    first_month, last_month = whole_months(start_date, end_date)
+    merged = {}
+    if first_month <= last_month:
+        rows = db.query(AmountSketch.bins, AmountSketch.counts).filter(
+            AmountSketch.user_id == user_id,
+            AmountSketch.month >= first_month,
+            AmountSketch.month <= last_month,
+        ).all()
+        merged = sketch.unpack(rows)
+        partial_ranges = [
+            (start_date, _midnight(first_month, start_date), False),
+            (_midnight(_next_month(last_month), end_date), end_date, True),
+        ]
+    else:
+        partial_ranges = [(start_date, end_date, True)]
+    for lower, upper, include_upper in partial_ranges:
+        sketch.merge(merged, _raw_sketch(db, user_id, lower, upper, include_upper))
+    return merged
+
+
+# This returns the first day of the bucket a day falls in
+def bucket_start(day, bucket: str):
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+
+# This turns an Aggregate into the extra statistics fields
+def _statistics(result: Aggregate) -> dict:
+    return {
+        "transaction_count": result.count,
+        "total_transaction_amount": result.total,
+        "std_transaction_amount": result.std if result.count else 0,
+    }
+
+
+"""
+This function returns a user's summary with extra statistics.
+With stats it adds the transaction count, total, standard deviation and the approximate
+p50, p95 and p99 amounts from the quantile sketches.
+With bucket (day, week or month) it adds a series with the statistics of every bucket
+in the range that has transactions.
+Everything is read from the rollup and sketch tables, plus the partial days (or for the
+percentiles, the partial months) at each end.
+"""
+def get_summary_statistics(db: Session, user_id: int, start_date: datetime, end_date: datetime,
+                           stats: bool = False, bucket: str = None) -> dict:
+    result = aggregate_range(db, user_id, start_date, end_date)
+    response = summary_from_aggregate(user_id, result)
+    if stats:
+        response.update(_statistics(result))
+        for name, value in sketch.quantiles(range_sketch(db, user_id, start_date, end_date)).items():
+            response[f"{name}_transaction_amount"] = value if value is not None else 0
+    if bucket:
+        buckets = {}
+        for day, aggregate in daily_aggregates(db, user_id, start_date, end_date).items():
+            buckets.setdefault(bucket_start(day, bucket), Aggregate()).merge(aggregate)
+        response["series"] = [
+            {"bucket_start": start, **summary_from_aggregate(user_id, aggregate), **_statistics(aggregate)}
+            for start, aggregate in sorted(buckets.items())
+        ]
+    return response
+
+
+"""
+These are the async versions of get_CSV_summary and get_summary_statistics.
+They run the same queries through an AsyncSession with run_sync, so while the driver waits
+for the database the event loop serves other requests and no threadpool worker is held.
+"""
+async def get_CSV_summary_async(db, user_id: int, start_date: datetime, end_date: datetime):
+    return await db.run_sync(get_CSV_summary, user_id, start_date, end_date)
+
+
+async def get_summary_statistics_async(db, user_id: int, start_date: datetime, end_date: datetime,
+                                       stats: bool = False, bucket: str = None) -> dict:
+    return await db.run_sync(get_summary_statistics, user_id, start_date, end_date, stats, bucket)
@@ -1,11 +1,39 @@
 """
-This file defines a Pydantic model for input validation.
+This file defines Pydantic models for input validation.
 """
-from pydantic import BaseModel
+from datetime import date, datetime
+from typing import Optional
+from pydantic import BaseModel, Field
+
+# Response Model for the statistics of one time bucket of a summary
+class summaryBucket(BaseModel):
+    bucket_start: date
+    transaction_count: int
+    total_transaction_amount: float
+    min_transaction_amount: float
+    max_transaction_amount: float
+    average_transaction_amount: float
+    std_transaction_amount: float
 
 # Response Model for summary statistics 
+# The optional fields are only filled in when extra statistics or a time series are requested
 class summaryResponse(BaseModel):
     user_id: int
     min_transaction_amount: float
     max_transaction_amount: float
-    average_transaction_amount: float
\ No newline at end of file
+    average_transaction_amount: float
+    transaction_count: Optional[int] = None
+    total_transaction_amount: Optional[float] = None
+    std_transaction_amount: Optional[float] = None
+    p50_transaction_amount: Optional[float] = None
+    p95_transaction_amount: Optional[float] = None
+    p99_transaction_amount: Optional[float] = None
+    series: Optional[list[summaryBucket]] = None
+
+# Request Model for summaries of many users
+# Either list the user_ids or set all_users to get every user with transactions in the range
+class summaryBatchRequest(BaseModel):
+    user_ids: Optional[list[int]] = Field(None, max_length=100_000)
+    all_users: bool = False
+    start_date: datetime
+    end_date: datetime
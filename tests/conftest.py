@@ -0,0 +1,10 @@
+"""
+This file prepares the test database once, before any test runs.
+The application only creates its tables when the server starts (see startup.py), and the
+test clients are not started as servers, so the tables are created here instead.
+"""
+import startup
+
+# This creates and migrates the tables of the test database before the tests are collected
+def pytest_sessionstart(session):
+    startup.prepare_database()
@@ -0,0 +1,58 @@
+"""
+This file contains the test cases for the benchmark data generator and the baseline comparison.
+It tests that the generated transactions only depend on the settings and pass the upload
+validation, that skew puts more transactions on a few users, and that the suite reports
+metrics that got worse than the baseline.
+"""
+import sys
+import uuid
+from pathlib import Path
+import pandas as pd
+import validation
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import datagen
+import suite
+
+# This test checks that the generator gives the same transactions for the same settings
+# expected: equal frames for the same seed, different ones for another seed, and rows that pass validation
+def test_generated_transactions_are_reproducible(monkeypatch):
+    monkeypatch.setattr(datagen, "CHUNK_ROWS", 300)
+    first = datagen.generate(1000, users=50, days=30, seed=7)
+    again = datagen.generate(1000, users=50, days=30, seed=7)
+
+    assert first.equals(again)
+    assert not first.equals(datagen.generate(1000, users=50, days=30, seed=8))
+    assert len(first) == 1000 and first.index.is_unique
+    assert all(uuid.UUID(value).version == 4 and str(uuid.UUID(value)) == value for value in first["transaction_id"])
+    assert first["user_id"].between(1, 50).all()
+    assert first["timestamp"].between(pd.Timestamp(datagen.START), pd.Timestamp(datagen.START) + pd.Timedelta(days=30)).all()
+    assert len(validation.validate_transactions(first.assign(timestamp=first["timestamp"].astype(str)))) == 1000
+
+# This test checks that the skew setting concentrates transactions on a few users
+# expected: the busiest tenth of users has far more transactions with skew than without
+def test_skew_concentrates_transactions():
+    def busiest_share(skew):
+        counts = datagen.generate(20_000, users=100, skew=skew)["user_id"].value_counts()
+        return counts.nlargest(10).sum() / counts.sum()
+
+    assert busiest_share(0.0) < 0.15
+    assert busiest_share(1.2) > 0.5
+
+# This test checks that the comparison with the baseline finds the metrics that got worse
+# expected: slower throughput and higher latency beyond the tolerance are reported, improvements and noise are not
+def test_compare_reports_regressions():
+    config = {"rows": 1000, "users": 10, "skew": 0.0, "days": 30, "seed": 0}
+    baseline = {"config": config, "metrics": {
+        "cold_ingest_rows_per_s": 1000.0, "single_summary_p50_ms": 10.0, "single_summary_p99_ms": 1.0, "db_size_mb": 50.0,
+    }}
+    results = {"config": config, "metrics": {
+        "cold_ingest_rows_per_s": 700.0, "single_summary_p50_ms": 5.0, "single_summary_p99_ms": 1.4, "db_size_mb": 70.0,
+        "peak_rss_mb": 500.0,
+    }}
+
+    regressions = suite.compare(results, baseline, tolerance=0.25)
+
+    assert [regression.split(":")[0] for regression in regressions] == ["cold_ingest_rows_per_s", "db_size_mb"]
+    assert suite.compare(results, {**baseline, "config": {**config, "rows": 2000}}, tolerance=0.25)[0].startswith("The settings")
@@ -0,0 +1,139 @@
+"""
+This file contains the test cases for the summary cache.
+It tests the LRU, memory and time limits, that uploads only evict the users they touched,
+and that the summary endpoint never serves a result older than the last upload.
+"""
+import io
+import uuid
+from datetime import datetime
+from fastapi.testclient import TestClient
+from cache import SummaryCache
+import cache
+from main import app
+
+# This sets up a test client for the FastAPI application
+client = TestClient(app)
+
+# This is a clock the tests can move forward by hand
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+
+# This builds a cache key for a user
+def key(user_id):
+    return (user_id, datetime(2023, 1, 1), datetime(2023, 12, 31))
+
+# This test checks that the least recently used entry is evicted first
+# expected: the entry that was not read is evicted
+def test_lru_eviction():
+    summaries = SummaryCache(max_entries=2, max_bytes=10**6, ttl_seconds=0)
+    summaries.put(key(1), {"user_id": 1}, 0)
+    summaries.put(key(2), {"user_id": 2}, 0)
+    summaries.get(key(1))
+    summaries.put(key(3), {"user_id": 3}, 0)
+    
+    assert summaries.get(key(2)) is None
+    assert summaries.get(key(1)) == {"user_id": 1}
+    assert summaries.stats()["evictions"] == 1
+
+# This test checks that entries expire after their time to live
+# expected: a miss once the clock passes the time to live
+def test_ttl_expiry():
+    clock = FakeClock()
+    summaries = SummaryCache(max_entries=10, max_bytes=10**6, ttl_seconds=5, clock=clock)
+    summaries.put(key(1), {"user_id": 1}, 0)
+    clock.now = 4
+    assert summaries.get(key(1)) == {"user_id": 1}
+    clock.now = 5
+    assert summaries.get(key(1)) is None
+
+# This test checks that the memory limit is respected
+# expected: the cache never holds more bytes than its limit
+def test_memory_limit():
+    summaries = SummaryCache(max_entries=1000, max_bytes=2000, ttl_seconds=0)
+    for user_id in range(50):
+        summaries.put(key(user_id), {"user_id": user_id, "min_transaction_amount": 1.0}, 0)
+    stats = summaries.stats()
+    assert 0 < stats["bytes"] <= 2000
+    assert stats["entries"] < 50
+
+# This test checks that invalidating a user only evicts that user's entries
+# expected: the other user's entry is still cached
+def test_invalidate_only_touched_users():
+    summaries = SummaryCache(max_entries=10, max_bytes=10**6, ttl_seconds=0)
+    summaries.put(key(1), {"user_id": 1}, 0)
+    summaries.put(key(2), {"user_id": 2}, 0)
+    summaries.invalidate_users({1})
+    
+    assert summaries.get(key(1)) is None
+    assert summaries.get(key(2)) == {"user_id": 2}
+
+# This test checks that a result computed before an invalidation is not stored
+# expected: the value computed during the upload is dropped
+def test_stale_result_not_stored():
+    summaries = SummaryCache(max_entries=10, max_bytes=10**6, ttl_seconds=0)
+    
+    def compute_during_upload():
+        summaries.invalidate_users({1})
+        return {"user_id": 1}
+    
+    summaries.get_or_compute(key(1), compute_during_upload)
+    assert summaries.get(key(1)) is None
+
+# This test checks that a result computed while the whole cache is cleared is not stored
+# expected: the value of a user the cache knew nothing about is dropped too
+def test_result_computed_during_clear_not_stored():
+    summaries = SummaryCache(max_entries=10, max_bytes=10**6, ttl_seconds=0)
+    
+    def compute_during_retention():
+        summaries.clear()
+        return {"user_id": 1}
+    
+    summaries.get_or_compute(key(1), compute_during_retention)
+    assert summaries.get(key(1)) is None
+
+# This test checks that the users' invalidations are not remembered forever
+# expected: at most max_entries users tracked, and a result computed before the reset is still not stored
+def test_invalidated_users_are_pruned():
+    summaries = SummaryCache(max_entries=10, max_bytes=10**6, ttl_seconds=0)
+    generation = summaries.generation()
+    for user_id in range(100):
+        summaries.invalidate_users({user_id})
+    
+    assert len(summaries.invalidated) <= 10
+    summaries.put(key(1), {"user_id": 1}, generation)
+    assert summaries.get(key(1)) is None
+
+# This test checks that the memory estimate includes the series of a bucket summary
+# expected: a summary with a long series is estimated as much larger than one without
+def test_memory_counts_bucket_series():
+    plain = {"user_id": 1, "min_transaction_amount": 1.0}
+    bucketed = {**plain, "series": [{"bucket_start": f"2023-01-{day:02d}", "transaction_count": day} for day in range(1, 29)]}
+    assert cache._entry_size(key(1), bucketed) > cache._entry_size(key(1), plain) + 28 * 200
+
+# This test checks that the summary endpoint reflects an upload straight away
+# expected: a cache hit before the upload and the new amount after it
+def test_summary_endpoint_invalidated_by_upload():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    params = {"start_date": "2023-01-01", "end_date": "2023-12-31"}
+    header = "transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+    transaction_id = uuid.uuid4()
+    
+    client.post("/upload/", files={"file": ("a.csv", io.BytesIO(f"{header}{transaction_id},{user_id},1,2023-06-01 10:00:00,10.0\n".encode()), "text/csv")})
+    first = client.get(f"/summary/{user_id}", params=params).json()
+    hits = cache.summary_cache.stats()["hits"]
+    assert client.get(f"/summary/{user_id}", params=params).json() == first
+    assert cache.summary_cache.stats()["hits"] == hits + 1
+    
+    client.post("/upload/", files={"file": ("b.csv", io.BytesIO(f"{header}{transaction_id},{user_id},1,2023-06-01 10:00:00,30.0\n".encode()), "text/csv")})
+    assert client.get(f"/summary/{user_id}", params=params).json()["max_transaction_amount"] == 30.0
+
+# This test checks that the cache counters are exposed
+# expected: HTTP 200 status code with the hit, miss and eviction counters
+def test_cache_stats_endpoint():
+    response = client.get("/summary/cache/stats")
+    assert response.status_code == 200
+    assert {"hits", "misses", "evictions", "invalidations", "entries", "bytes"} <= set(response.json())
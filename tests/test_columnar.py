@@ -0,0 +1,187 @@
+"""
+This file contains the parity tests for the Parquet summary backend.
+It loads transactions into SQLite, copies them to a Parquet dataset in a temporary directory
+and checks that the summaries read from the dataset match the SQLite summaries.
+The tests are skipped when pyarrow is not installed.
+"""
+import io
+import threading
+import time
+import uuid
+from datetime import date, datetime
+import pandas as pd
+import pytest
+from database import session
+import ingest
+import summary
+
+pytest.importorskip("pyarrow")
+import columnar
+
+RANGES = [
+    (datetime(2022, 1, 1), datetime(2022, 12, 31)),
+    (datetime(2022, 3, 2), datetime(2022, 3, 4)),
+    (datetime(2022, 3, 2, 6, 0), datetime(2022, 4, 4, 12, 0)),
+    (datetime(2022, 3, 3), datetime(2022, 3, 3, 23, 59, 59, 999999)),
+    (datetime(2022, 3, 4, 0, 0), datetime(2022, 3, 4, 0, 0)),
+    (datetime(2023, 1, 1), datetime(2023, 2, 1)),
+]
+
+# This builds a DataFrame of transactions
+def make_frame(ids, user_ids, timestamps, amounts):
+    return pd.DataFrame({
+        "transaction_id": ids,
+        "user_id": user_ids,
+        "product_id": [1] * len(ids),
+        "timestamp": pd.to_datetime(timestamps),
+        "transaction_amount": amounts,
+    })
+
+# This loads transactions for two fresh users spread over two months and copies them to the dataset
+@pytest.fixture
+def loaded(tmp_path):
+    db = session()
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    user_ids = [user_id, user_id + 1]
+    timestamps = ["2022-03-02 08:00:00", "2022-03-02 18:30:00", "2022-03-03 00:00:00",
+                  "2022-03-03 23:59:59", "2022-03-04 00:00:00", "2022-04-04 15:00:00"]
+    ids = [str(uuid.uuid4()) for _ in range(12)]
+    ingest.bulk_upsert(db, make_frame(
+        ids, [user_ids[0]] * 6 + [user_ids[1]] * 6, timestamps * 2,
+        [10.0, 2.5, 7.25, 100.0, 0.5, 42.0, 1.1, 2.2, 3.3, 4.4, 5.5, 6.6],
+    ))
+    db.commit()
+    columnar.sync_users(db, user_ids, root=tmp_path / "dataset")
+    yield db, user_ids, ids, tmp_path / "dataset"
+    db.close()
+
+# This compares two summaries, the averages are sums added up in a different order so they
+# are compared to within rounding
+def assert_same_summary(columnar_summary, sqlite_summary):
+    assert columnar_summary == {**sqlite_summary, "average_transaction_amount": pytest.approx(sqlite_summary["average_transaction_amount"], rel=1e-12)}
+
+# This test checks that single user summaries from the dataset match the SQLite summaries
+# expected: the same summary for every range, including ranges with no transactions
+@pytest.mark.parametrize("start_date,end_date", RANGES)
+def test_columnar_summary_matches_sqlite(loaded, start_date, end_date):
+    db, user_ids, ids, root = loaded
+    for user_id in user_ids:
+        assert_same_summary(
+            columnar.get_CSV_summary(user_id, start_date, end_date, root=root),
+            summary.get_CSV_summary(db, user_id, start_date, end_date),
+        )
+
+# This test checks that batch summaries from the dataset match the SQLite batch summaries
+# expected: the same summaries in the same order, with defaults for the unknown user
+def test_columnar_batch_matches_sqlite(loaded):
+    db, user_ids, ids, root = loaded
+    requested = [user_ids[1], 12345678901, user_ids[0]]
+    start_date, end_date = datetime(2022, 3, 2, 12, 0), datetime(2022, 12, 31)
+    columnar_summaries = columnar.get_batch_summary(requested, start_date, end_date, root=root)
+    sqlite_summaries = summary.get_batch_summary(db, requested, start_date, end_date)
+    assert [item["user_id"] for item in columnar_summaries] == requested
+    for columnar_summary, sqlite_summary in zip(columnar_summaries, sqlite_summaries):
+        assert_same_summary(columnar_summary, sqlite_summary)
+
+# This test checks that a sync after an upsert which moves a transaction to the other user
+# rewrites both users' rows
+# expected: both users' summaries still match SQLite
+def test_columnar_follows_moved_transactions(loaded):
+    db, user_ids, ids, root = loaded
+    ingest.bulk_upsert(db, make_frame(ids[:1], [user_ids[1]], ["2022-03-10 10:00:00"], [999.0]))
+    db.commit()
+    columnar.sync_users(db, user_ids, root=root)
+    start_date, end_date = datetime(2022, 1, 1), datetime(2022, 12, 31)
+    for user_id in user_ids:
+        assert_same_summary(
+            columnar.get_CSV_summary(user_id, start_date, end_date, root=root),
+            summary.get_CSV_summary(db, user_id, start_date, end_date),
+        )
+    assert columnar.get_CSV_summary(user_ids[1], start_date, end_date, root=root)["max_transaction_amount"] == 999.0
+
+# This test checks that the dataset only has the partitions of the months with transactions
+# expected: one directory per month under the user's bucket
+def test_columnar_partitions_by_bucket_and_month(loaded):
+    db, user_ids, ids, root = loaded
+    bucket = root / f"user_bucket={columnar.user_bucket(user_ids[0])}"
+    assert sorted(path.name for path in bucket.iterdir()) == ["month=2022-03", "month=2022-04"]
+
+# This test checks two uploads of different users in the same bucket that sync at the same time
+# Reading a bucket is slowed down so that, without the sync lock, both would start from the old files
+# expected: the bucket keeps the transactions of both users
+def test_columnar_concurrent_syncs_keep_both_users(tmp_path, monkeypatch):
+    root = tmp_path / "dataset"
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    user_ids = [user_id, user_id + columnar.COLUMNAR_USER_BUCKETS]
+    read_month = columnar._read_month
+    def slow_read_month(*args):
+        table = read_month(*args)
+        time.sleep(0.2)
+        return table
+    monkeypatch.setattr(columnar, "_read_month", slow_read_month)
+
+    db = session()
+    ingest.bulk_upsert(db, make_frame([str(uuid.uuid4()), str(uuid.uuid4())], user_ids, ["2022-05-01 10:00:00"] * 2, [5.0, 7.0]))
+    db.commit()
+    db.close()
+
+    # Each upload syncs its own user with its own session, as the upload endpoint does
+    def sync(user_id):
+        db = session()
+        try:
+            columnar.sync_users(db, [user_id], root=root)
+        finally:
+            db.close()
+    threads = [threading.Thread(target=sync, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summaries = columnar.get_batch_summary(user_ids, datetime(2022, 1, 1), datetime(2022, 12, 31), root=root)
+    assert [item["max_transaction_amount"] for item in summaries] == [5.0, 7.0]
+
+# This test checks that a sync only rewrites the months an upload changed
+# expected: a month the user moved away from is removed, the new month is written and the
+# user's other month's file is left in place
+def test_columnar_sync_rewrites_only_changed_months(loaded):
+    db, user_ids, ids, root = loaded
+    bucket = root / f"user_bucket={columnar.user_bucket(user_ids[0])}"
+    march = (bucket / "month=2022-03" / "part-0.parquet").stat()
+    # The user's only April transaction moves to May
+    content = f"transaction_id,user_id,product_id,timestamp,transaction_amount\n{ids[5]},{user_ids[0]},1,2022-05-04 15:00:00,42.0\n"
+    result = ingest.ingest_files(db, [("move.csv", io.BytesIO(content.encode()))])
+    db.commit()
+    assert result.months == {date(2022, 4, 1), date(2022, 5, 1)}
+    columnar.sync_users(db, result.user_ids, root=root, months=result.months)
+
+    assert sorted(path.name for path in bucket.iterdir()) == ["month=2022-03", "month=2022-05"]
+    assert (bucket / "month=2022-03" / "part-0.parquet").stat().st_mtime_ns == march.st_mtime_ns
+    assert_same_summary(
+        columnar.get_CSV_summary(user_ids[0], datetime(2022, 1, 1), datetime(2022, 12, 31), root=root),
+        summary.get_CSV_summary(db, user_ids[0], datetime(2022, 1, 1), datetime(2022, 12, 31)),
+    )
+
+# This test checks that scans of the dataset do not wait for each other
+# expected: two scans are inside the dataset at the same time
+def test_columnar_scans_run_at_the_same_time(loaded, monkeypatch):
+    db, user_ids, ids, root = loaded
+    both_scanning = threading.Barrier(2, timeout=5)
+    partition_files = columnar._partition_files
+    def waiting_partition_files(*args):
+        both_scanning.wait()
+        return partition_files(*args)
+    monkeypatch.setattr(columnar, "_partition_files", waiting_partition_files)
+
+    results = {}
+    def scan(user_id):
+        results[user_id] = columnar.get_CSV_summary(user_id, datetime(2022, 1, 1), datetime(2022, 12, 31), root=root)
+    threads = [threading.Thread(target=scan, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not both_scanning.broken
+    assert [results[user_id]["max_transaction_amount"] for user_id in user_ids] == [100.0, 6.6]
+
@@ -3,9 +3,18 @@ Thi file contains the test cases for the database summary functionality.
 It tests the logic to generate a summary of transaction data for a user,
 ensuring that it correctly queries the database and returns the expected results.
 """
-from database import session
+import uuid
+from datetime import datetime
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import OperationalError
+from database import session, read_session, dbengine
 from models import Transaction
-from summary import get_CSV_summary
+from summary import get_CSV_summary, raw_aggregate_query
+import ingest
+import migrations
+import storage
 from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
 from fastapi.testclient import TestClient
 from main import app
@@ -50,3 +59,82 @@ def test_get_user_summary_invalid_user():
     # Checks if the response status code is 422
     assert response.status_code == 422
     db.close()
+
+# This test checks that the summary query is answered from the covering index
+# expected: the query plan searches ix_transactions_user_id_timestamp_amount as a covering index,
+# or the primary key the compact table is stored in
+def test_summary_query_uses_covering_index():
+    db = session()
+    query = raw_aggregate_query(db, 1, datetime(2023, 1, 1), datetime(2023, 12, 31))
+    compiled = query.statement.compile(dialect=db.bind.dialect)
+    params = tuple(str(compiled.params[name]) for name in compiled.positiontup)
+    
+    plan = db.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + compiled.string, params).fetchall()
+    details = " ".join(row[-1] for row in plan)
+    
+    if storage.COMPACT:
+        assert "USING PRIMARY KEY (user_id=? AND timestamp>" in details
+    else:
+        assert "USING COVERING INDEX ix_transactions_user_id_timestamp_amount" in details
+    db.close()
+
+# This test checks that an old database gets the new indexes and loses the obsolete ones
+# expected: the composite index exists and ix_transactions_user_id and ix_transactions_id are gone
+@pytest.mark.skipif(storage.COMPACT, reason="old databases always have the standard layout")
+def test_migration_upgrades_old_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE transactions (id INTEGER PRIMARY KEY, transaction_id VARCHAR, user_id INTEGER, "
+            "product_id INTEGER, timestamp DATETIME, transaction_amount FLOAT)"
+        )
+        connection.exec_driver_sql("CREATE UNIQUE INDEX ix_transactions_transaction_id ON transactions (transaction_id)")
+        connection.exec_driver_sql("CREATE INDEX ix_transactions_id ON transactions (id)")
+        connection.exec_driver_sql("CREATE INDEX ix_transactions_user_id ON transactions (user_id)")
+        connection.exec_driver_sql("CREATE INDEX ix_transactions_timestamp ON transactions (timestamp)")
+    
+    migrations.upgrade(engine)
+    migrations.upgrade(engine)
+    
+    indexes = {index["name"] for index in inspect(engine).get_indexes("transactions")}
+    assert indexes == {"ix_transactions_transaction_id", "ix_transactions_timestamp", "ix_transactions_user_id_timestamp_amount"}
+    engine.dispose()
+
+# This test checks that new SQLite connections get the configured pragmas
+# expected: WAL journaling, NORMAL synchronous and the busy timeout
+def test_sqlite_pragmas_applied_on_connect():
+    with dbengine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 30000
+
+# This test checks that the reader sessions cannot change data
+# expected: writing through a read session fails
+def test_read_session_is_read_only():
+    db = read_session()
+    with pytest.raises(OperationalError):
+        db.execute(text("DELETE FROM transactions WHERE user_id = -1"))
+    db.close()
+
+# This test checks that summaries are answered while an upload's transaction is still open
+# expected: the reader sees the committed state straight away, and the new rows once they are committed
+def test_reader_not_blocked_by_open_upload():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    writer = session()
+    ingest.bulk_upsert(writer, pd.DataFrame({
+        "transaction_id": [str(uuid.uuid4())],
+        "user_id": [user_id],
+        "product_id": [1],
+        "timestamp": pd.to_datetime(["2023-05-01 10:00:00"]),
+        "transaction_amount": [25.0],
+    }))
+    
+    reader = read_session()
+    assert get_CSV_summary(reader, user_id, datetime(2023, 1, 1), datetime(2023, 12, 31))["max_transaction_amount"] == 0
+    reader.close()
+    
+    writer.commit()
+    writer.close()
+    reader = read_session()
+    assert get_CSV_summary(reader, user_id, datetime(2023, 1, 1), datetime(2023, 12, 31))["max_transaction_amount"] == 25.0
+    reader.close()
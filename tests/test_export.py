@@ -0,0 +1,129 @@
+"""
+This file contains the test cases for the transaction export endpoints.
+It tests that a user's transactions in a date range are streamed back as CSV (which can be
+uploaded again), NDJSON and Arrow, gzip compressed when asked, in batches, and that every
+user's transactions are exported by the all users endpoint.
+"""
+import gzip
+import io
+import json
+import uuid
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+import export
+import storage
+from main import app
+
+# This sets up a test client for the FastAPI application
+client = TestClient(app)
+
+# This uploads three transactions for a new user in 1995 and returns the user_id and the uploaded rows
+def upload_user():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    rows = [
+        (str(uuid.uuid4()), user_id, 200, "1995-01-10 10:00:00", 10.5),
+        (str(uuid.uuid4()), user_id, 201, "1995-02-10 11:30:00", 20.25),
+        (str(uuid.uuid4()), user_id, 202, "1995-06-01 09:00:00", 99.0),
+    ]
+    lines = "".join(",".join(str(value) for value in row) + "\n" for row in rows)
+    csv_content = ",".join(export.COLUMNS) + "\n" + lines
+    response = client.post("/upload/", files={"file": ("test.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+    assert response.status_code == 200
+    return user_id, rows
+
+# This test checks that a user's transactions in a date range are exported as CSV
+# expected: the transactions in the range in timestamp order, formatted like the upload
+def test_export_csv():
+    user_id, rows = upload_user()
+
+    response = client.get(f"/transactions/{user_id}/export", params={"start_date": "1995-01-01", "end_date": "1995-03-01"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert f"transactions_{user_id}_19950101_19950301.csv" in response.headers["content-disposition"]
+    lines = response.text.splitlines()
+    assert lines[0] == ",".join(export.COLUMNS)
+    assert lines[1:] == [",".join(str(value) for value in row) for row in rows[:2]]
+
+# This test checks that an exported CSV file can be uploaded again
+# expected: every row is recognised as already stored with the same values
+def test_exported_csv_uploads_unchanged():
+    user_id, rows = upload_user()
+    exported = client.get(f"/transactions/{user_id}/export", params={"start_date": "1995-01-01", "end_date": "1995-12-31"}).content
+
+    response = client.post("/upload/", files={"file": ("export.csv", io.BytesIO(exported), "text/csv")})
+
+    assert response.status_code == 200
+    assert response.json()["unchanged"] == len(rows)
+
+# This test checks the NDJSON export, gzip compressed
+# expected: a gzip body with Content-Encoding gzip that holds one JSON object per transaction
+def test_export_ndjson_gzip():
+    user_id, rows = upload_user()
+
+    response = client.get(f"/transactions/{user_id}/export", params={
+        "start_date": "1995-01-01", "end_date": "1995-12-31", "format": "ndjson", "compression": "gzip",
+    })
+
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    # The test client decompresses the body, so it is also checked as written by export.stream
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert records == [dict(zip(export.COLUMNS, row)) for row in rows]
+    compressed = b"".join(export.stream(user_id, pd.Timestamp("1995-01-01"), pd.Timestamp("1995-12-31"), "ndjson", "gzip"))
+    assert gzip.decompress(compressed).decode() == response.text
+
+# This test checks that large and high precision amounts keep every digit in the NDJSON export
+# expected: the exported amounts equal the stored ones, which are the uploaded ones unless they are stored as cents
+def test_export_ndjson_amount_precision():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    amounts = [123456789.123, 123.456789012345678]
+    lines = "".join(f"{uuid.uuid4()},{user_id},200,1995-01-1{day} 10:00:00,{amount!r}\n" for day, amount in enumerate(amounts))
+    csv_content = ",".join(export.COLUMNS) + "\n" + lines
+    assert client.post("/upload/", files={"file": ("test.csv", io.BytesIO(csv_content.encode()), "text/csv")}).status_code == 200
+
+    response = client.get(f"/transactions/{user_id}/export", params={"start_date": "1995-01-01", "end_date": "1995-12-31", "format": "ndjson"})
+
+    exported = [record["transaction_amount"] for record in map(json.loads, response.text.splitlines())]
+    stored = pd.concat(export.batches(user_id, pd.Timestamp("1995-01-01"), pd.Timestamp("1995-12-31")))
+    assert exported == stored["transaction_amount"].tolist()
+    if not storage.COMPACT:
+        assert exported == amounts
+
+# This test checks that the export is read and written in batches
+# expected: the same rows with one row per batch as with the default batch size
+def test_export_in_batches(monkeypatch):
+    user_id, rows = upload_user()
+    monkeypatch.setattr(export, "EXPORT_BATCH_ROWS", 1)
+
+    frames = list(export.batches(user_id, pd.Timestamp("1995-01-01"), pd.Timestamp("1995-12-31")))
+
+    assert [len(frame) for frame in frames] == [1, 1, 1]
+    assert pd.concat(frames)["transaction_id"].tolist() == [row[0] for row in rows]
+
+# This test checks the Arrow IPC export
+# expected: a stream with the export schema and the user's rows
+def test_export_arrow():
+    pa = pytest.importorskip("pyarrow")
+    user_id, rows = upload_user()
+
+    response = client.get(f"/transactions/{user_id}/export", params={"start_date": "1995-01-01", "end_date": "1995-12-31", "format": "arrow"})
+
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.schema == export.arrow_schema()
+    assert table.column("transaction_amount").to_pylist() == [row[4] for row in rows]
+    assert str(table.column("timestamp")[2].as_py()) == rows[2][3]
+
+# This test checks that every user's transactions are exported by the all users endpoint
+# expected: the rows of both users, and a 400 error for a reversed date range
+def test_export_all_users():
+    first, first_rows = upload_user()
+    second, second_rows = upload_user()
+
+    response = client.get("/transactions/export", params={"start_date": "1995-01-01", "end_date": "1995-12-31", "format": "ndjson"})
+
+    exported = {record["transaction_id"] for record in map(json.loads, response.text.splitlines())}
+    assert {row[0] for row in first_rows + second_rows} <= exported
+    assert client.get("/transactions/export", params={"start_date": "1995-12-31", "end_date": "1995-01-01"}).status_code == 400
@@ -0,0 +1,107 @@
+"""
+This file contains the test cases for background upload jobs.
+It tests that an upload can be queued, that its progress and final counts are reported,
+and that validation errors are reported on the job instead of the upload request, while
+failures after the rows are saved only add warnings to a succeeded job.
+"""
+import gzip
+import io
+import time
+import uuid
+from fastapi.testclient import TestClient
+from main import app
+import columnar
+import partitions
+
+# This sets up a test client for the FastAPI application
+client = TestClient(app)
+
+# This waits for a job to finish and returns its final status
+def wait_for_job(job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f"/upload/jobs/{job_id}").json()
+        if status["status"] in ("succeeded", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError("Upload job did not finish in time")
+
+# This test checks that a background upload returns a job id and saves the rows
+# expected: HTTP 202 status code, then a succeeded job with every row written
+def test_background_upload_succeeds():
+    rows = "".join(f"{uuid.uuid4()},600001,200,2023-01-01 12:00:00,{i}.0\n" for i in range(3))
+    csv_content = "transaction_id,user_id,product_id,timestamp,transaction_amount\n" + rows
+    
+    response = client.post("/upload/", params={"background": "true"},
+                           files={"file": ("job.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+    
+    assert response.status_code == 202
+    status = wait_for_job(response.json()["job_id"])
+    assert status["status"] == "succeeded"
+    assert status["rows_parsed"] == 3
+    assert status["rows_written"] == 3
+    assert status["error"] is None
+
+# This test checks that validation errors are reported on the job
+# expected: a failed job with the error message and row offsets
+def test_background_upload_reports_errors():
+    csv_content = ("transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+                   f"{uuid.uuid4()},non_integer,200,2023-01-01 12:00:00,50.0\n")
+    
+    response = client.post("/upload/", params={"background": "true"},
+                           files={"file": ("bad_job.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+    
+    status = wait_for_job(response.json()["job_id"])
+    assert status["status"] == "failed"
+    assert status["error"] == "user_id must be integers."
+    assert status["errors"][0]["rows"] == [0]
+    assert status["rows_written"] == 0
+
+# This test checks that several compressed files are saved by one background job
+# expected: a succeeded job with the rows written from each file
+def test_background_upload_several_files():
+    header = "transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+    first = header + "".join(f"{uuid.uuid4()},600002,200,2023-01-01 12:00:00,{i}.0\n" for i in range(2))
+    second = header + "".join(f"{uuid.uuid4()},600002,200,2023-01-02 12:00:00,{i}.0\n" for i in range(3))
+    
+    response = client.post("/upload/", params={"background": "true"}, files=[
+        ("file", ("day1.csv.gz", io.BytesIO(gzip.compress(first.encode())), "application/gzip")),
+        ("file", ("day2.csv.gz", io.BytesIO(gzip.compress(second.encode())), "application/gzip")),
+    ])
+    
+    status = wait_for_job(response.json()["job_id"])
+    assert status["status"] == "succeeded"
+    assert status["filename"] == "day1.csv.gz, day2.csv.gz"
+    assert status["rows_written"] == 5
+    assert [file["rows_written"] for file in status["files"]] == [2, 3]
+
+# This test checks a job whose Parquet copy and retention fail after its rows were committed
+# expected: a succeeded job with every row written and a warning for each failed step, and the user's cached summary cleared
+def test_background_upload_warns_after_commit(monkeypatch):
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    params = {"start_date": "2023-01-01", "end_date": "2023-01-31", "stats": "true"}
+    assert client.get(f"/summary/{user_id}", params=params).json()["transaction_count"] == 0
+    def failing_step(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(columnar, "ENABLED", True)
+    monkeypatch.setattr(columnar, "sync_users", failing_step)
+    monkeypatch.setattr(partitions, "apply_retention", failing_step)
+    rows = "".join(f"{uuid.uuid4()},{user_id},200,2023-01-01 12:00:00,{i}.0\n" for i in range(3))
+    csv_content = "transaction_id,user_id,product_id,timestamp,transaction_amount\n" + rows
+    
+    response = client.post("/upload/", params={"background": "true"},
+                           files={"file": ("job.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+    
+    status = wait_for_job(response.json()["job_id"])
+    assert status["status"] == "succeeded"
+    assert status["rows_written"] == 3
+    assert status["error"] is None
+    assert len(status["warnings"]) == 2
+    assert client.get(f"/summary/{user_id}", params=params).json()["transaction_count"] == 3
+
+# This test checks that an unknown job id is reported as not found
+# expected: HTTP 404 status code
+def test_unknown_job():
+    response = client.get("/upload/jobs/does-not-exist")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Upload job not found."}
@@ -0,0 +1,82 @@
+"""
+This file contains the test cases for the request timings and the /metrics endpoint.
+It tests that uploads and summaries report their phases in a Server-Timing header, that
+nested phases only count their own time, that GET /metrics returns the counters in the
+Prometheus text format, and that a request can ask to be profiled.
+"""
+import gzip
+import io
+import re
+import time
+import uuid
+from fastapi.testclient import TestClient
+import columnar
+import metrics
+from main import app
+
+# This sets up a test client for the FastAPI application
+client = TestClient(app)
+
+# This returns the phases of a Server-Timing header and their durations in milliseconds
+def server_timing(response):
+    return {name: float(duration) for name, duration in re.findall(r"(\w+);dur=([\d.]+)", response.headers["server-timing"])}
+
+# This returns the value of a sample in the text of GET /metrics, 0 if it has not been recorded yet
+def sample(text, name):
+    match = re.search(rf"^{re.escape(name)} (\S+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+# This test checks that an upload and a summary of it report the time spent in each phase
+# expected: the upload and summary phases in the Server-Timing headers, and the upload counted in /metrics
+# A summary read from the Parquet dataset opens no database session, so it has no session phase
+def test_upload_and_summary_report_phases():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    rows = "".join(f"{uuid.uuid4()},{user_id},200,2023-01-0{day} 12:00:00,{day}.0\n" for day in range(1, 4))
+    csv_content = ("transaction_id,user_id,product_id,timestamp,transaction_amount\n" + rows).encode()
+    before = client.get("/metrics").text
+
+    upload = client.post("/upload/", files={"file": ("metrics.csv.gz", io.BytesIO(gzip.compress(csv_content)), "application/gzip")})
+    summary = client.get(f"/summary/{user_id}", params={"start_date": "2023-01-01", "end_date": "2023-01-31"})
+    after = client.get("/metrics").text
+
+    assert upload.status_code == 200
+    assert {"read", "decode", "parse", "timestamps", "validate", "write", "rollup", "commit", "total"} <= set(server_timing(upload))
+    summary_phases = {"query", "serialize", "total"} if columnar.ENABLED else {"session", "query", "serialize", "total"}
+    assert summary_phases <= set(server_timing(summary))
+    assert summary.json()["average_transaction_amount"] == 2.0
+    assert sample(after, 'transactions_upload_rows_total{outcome="inserted"}') - sample(before, 'transactions_upload_rows_total{outcome="inserted"}') == 3
+    assert sample(after, "transactions_upload_decompressed_bytes_total") - sample(before, "transactions_upload_decompressed_bytes_total") == len(csv_content)
+    assert 'transactions_http_requests_total{method="GET",route="/summary/{user_id}",status="200"}' in after
+    assert 'transactions_phase_seconds_bucket{phase="parse",le="+Inf"}' in after
+
+# This test checks that a phase inside another one is taken out of the outer phase's time
+# expected: the outer phase only counts the time spent outside the inner one
+def test_nested_phase_counts_own_time():
+    timings = metrics.RequestTimings()
+    token = metrics._request_timings.set(timings)
+    try:
+        with metrics.phase("outer"):
+            time.sleep(0.02)
+            with metrics.phase("inner"):
+                time.sleep(0.05)
+    finally:
+        metrics._request_timings.reset(token)
+
+    assert 0.05 <= timings.durations["inner"] < 0.09
+    assert 0.02 <= timings.durations["outer"] < 0.045
+
+# This test checks that a request sent with X-Profile is profiled when PROFILE_DIR is set
+# expected: the report is named in the X-Profile-Report header and written to PROFILE_DIR, other requests are not profiled
+def test_profiled_request_writes_report(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "PROFILE_DIR", str(tmp_path))
+    params = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+    profiled = client.get("/summary/1", params=params, headers={"X-Profile": "1"})
+    plain = client.get("/summary/1", params=params)
+
+    assert profiled.status_code == 200
+    report = tmp_path / profiled.headers["x-profile-report"]
+    assert "get_CSV_summary" in report.read_text()
+    assert report.with_suffix(".prof").exists()
+    assert "x-profile-report" not in plain.headers
+    assert len(list(tmp_path.glob("*.txt"))) == 1
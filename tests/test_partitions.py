@@ -0,0 +1,150 @@
+"""
+This file contains the test cases for the monthly partitions of the transactions.
+It tests the month arithmetic, that a database stored with partitions is not opened without
+them, and, with TRANSACTION_PARTITIONS=monthly, that uploads are stored in the table of their
+month, that summaries only read the months in their range, that a transaction moved to another
+month leaves its old table, and that old months are removed by dropping their tables.
+The partitioned tests run in a separate pytest process, together with the summary, ingest and upload tests.
+"""
+import io
+import os
+import subprocess
+import sys
+import uuid
+from datetime import date, datetime
+from pathlib import Path
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from database import session
+from main import app
+import migrations
+import models
+import partitions
+import storage
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# This sets up a test client for the FastAPI application
+client = TestClient(app)
+
+partitioned = pytest.mark.skipif(not partitions.ENABLED, reason="needs TRANSACTION_PARTITIONS=monthly")
+
+# This uploads rows of (transaction_id, user_id, timestamp, amount) and returns the response
+def upload(rows):
+    lines = "".join(f"{transaction_id},{user_id},200,{timestamp},{amount}\n" for transaction_id, user_id, timestamp, amount in rows)
+    csv_content = "transaction_id,user_id,product_id,timestamp,transaction_amount\n" + lines
+    return client.post("/upload/", files={"file": ("test.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+
+# This returns the summary of a user between two dates
+def summary(user_id, start_date, end_date):
+    response = client.get(f"/summary/{user_id}", params={"start_date": start_date, "end_date": end_date})
+    assert response.status_code == 200
+    return response.json()
+
+# This test checks the month numbers used to name the months' tables
+# expected: months counted across year ends in both directions, and six digit table names
+def test_month_arithmetic():
+    assert partitions.month_of(datetime(2023, 1, 31, 23, 59)) == 202301
+    assert partitions.add_months(202301, -1) == 202212
+    assert partitions.add_months(202312, 1) == 202401
+    assert partitions.add_months(202306, -18) == 202112
+    assert partitions.first_day(202302) == date(2023, 2, 1)
+    assert partitions.table_name(202301) == "transactions_202301"
+
+# This test checks that a database stored with monthly partitions is not opened without them
+# expected: a RuntimeError naming the setting the database was stored with
+@pytest.mark.skipif(partitions.ENABLED, reason="the suite is running with partitions")
+@pytest.mark.skipif(storage.COMPACT, reason="the compact layout refuses the standard tables made here before their partitions")
+def test_other_partitioning_is_refused(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/partitioned.db")
+    with engine.begin() as connection:
+        for name in ("transactions", "transactions_202301"):
+            connection.exec_driver_sql(f"CREATE TABLE {name} (id INTEGER PRIMARY KEY, transaction_id VARCHAR)")
+
+    with pytest.raises(RuntimeError, match="TRANSACTION_PARTITIONS=monthly"):
+        migrations.upgrade(engine)
+    engine.dispose()
+
+# This test checks that an upload is stored in the tables of its months and summaries read only their range's months
+# expected: one table per month, only the overlapping months routed to, and the same summary as without partitions
+@partitioned
+def test_upload_is_stored_by_month():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    response = upload([
+        (uuid.uuid4(), user_id, "1990-01-20 10:00:00", 10.0),
+        (uuid.uuid4(), user_id, "1990-02-10 10:00:00", 20.0),
+        (uuid.uuid4(), user_id, "1990-03-05 10:00:00", 60.0),
+    ])
+
+    assert response.status_code == 200
+    with session() as db:
+        assert {199001, 199002, 199003} <= set(partitions.stored_months(db))
+        routed = partitions.tables(db, datetime(1990, 1, 15), datetime(1990, 2, 15))
+        assert [table.name for table in routed] == ["transactions_199001", "transactions_199002"]
+        assert db.execute(text("SELECT COUNT(*) FROM transactions")).scalar() == 0
+    assert summary(user_id, "1990-01-15T12:00:00", "1990-02-15T12:00:00")["average_transaction_amount"] == 15.0
+    assert summary(user_id, "1990-01-01", "1990-12-31")["max_transaction_amount"] == 60.0
+
+# This test checks that re-uploading a transaction with a timestamp in another month moves it there
+# expected: the row only in the new month's table, the id map updated and the summaries following it
+@partitioned
+def test_moved_transaction_leaves_its_month():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    transaction_id = str(uuid.uuid4())
+    upload([(transaction_id, user_id, "1991-01-10 10:00:00", 30.0), (uuid.uuid4(), user_id, "1991-01-11 10:00:00", 10.0)])
+
+    response = upload([(transaction_id, user_id, "1991-03-10 10:00:00", 50.0)])
+
+    assert response.json()["updated"] == 1
+    with session() as db:
+        months = {month: db.execute(text(f"SELECT COUNT(*) FROM {partitions.table_name(month)} WHERE user_id = {user_id}")).scalar()
+                  for month in (199101, 199103)}
+        stored_in = db.get(models.TransactionMonth, transaction_id).month
+    assert months == {199101: 1, 199103: 1}
+    assert stored_in == 199103
+    assert summary(user_id, "1991-01-01", "1991-01-31")["average_transaction_amount"] == 10.0
+    assert summary(user_id, "1991-03-01", "1991-03-31")["average_transaction_amount"] == 50.0
+
+# This test checks that old months are removed by dropping their tables, directly and by the retention setting
+# expected: the tables, ids and rollups of the dropped months are gone, later months are kept, and the same
+# upload is stored again afterwards instead of being recognised as already uploaded
+@partitioned
+def test_old_months_are_dropped(monkeypatch):
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    rows = [
+        (uuid.uuid4(), user_id, "1980-01-15 10:00:00", 10.0),
+        (uuid.uuid4(), user_id, "1980-02-15 10:00:00", 20.0),
+        (uuid.uuid4(), user_id, "1980-03-15 10:00:00", 40.0),
+    ]
+    upload(rows)
+
+    with session() as db:
+        assert partitions.drop_before(db, 198003) == [198001, 198002]
+        assert partitions.stored_months(db, last=198012) == [198003]
+        assert db.execute(text("SELECT COUNT(*) FROM transaction_months WHERE month < 198003")).scalar() == 0
+    assert summary(user_id, "1980-01-01", "1980-02-29")["average_transaction_amount"] == 0
+    assert summary(user_id, "1980-01-01", "1980-12-31")["average_transaction_amount"] == 40.0
+
+    again = upload(rows)
+    assert again.json()["already_uploaded"] is False
+    assert again.json()["inserted"] == 2
+
+    monkeypatch.setattr(partitions, "TRANSACTION_RETENTION_MONTHS", 1)
+    with session() as db:
+        assert partitions.apply_retention(db, today=date(1980, 4, 20)) == [198001, 198002, 198003]
+        assert partitions.stored_months(db, last=198012) == []
+
+# This test runs the partition, summary, export, ingest, rollup and upload tests with TRANSACTION_PARTITIONS=monthly in a new database
+# Partitioning is chosen when storage.py is imported, so they run in a separate pytest process
+# expected: every test passes
+@pytest.mark.skipif(partitions.ENABLED, reason="the whole suite is already running with partitions")
+def test_partitions_pass_summary_tests(tmp_path):
+    env = dict(os.environ, TRANSACTION_PARTITIONS="monthly", DATABASE_URL=f"sqlite:///{tmp_path}/partitioned.db")
+    result = subprocess.run(
+        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider",
+         "tests/test_partitions.py", "tests/test_summary.py", "tests/test_columnar.py", "tests/test_jobs.py", "tests/test_export.py",
+         "tests/test_ingest.py", "tests/test_rollup.py", "tests/test_upload.py"],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stdout[-3000:]
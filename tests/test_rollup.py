@@ -0,0 +1,117 @@
+"""
+This file contains the test cases for the daily rollup table.
+It tests that summaries built from the rollup and the partial days at each end of the range
+match a summary built directly from the transactions table, including after an upsert
+moves an existing transaction to another day or another user.
+"""
+import uuid
+from datetime import datetime
+import pandas as pd
+import pytest
+from sqlalchemy import func, select
+from database import session
+from models import AmountSketch, DailyRollup
+from summary import get_CSV_summary
+import ingest
+import partitions
+import sketch
+
+# This works out the summary straight from the transactions table, the way it used to be done
+# With monthly partitions each month's table in the range is read and their results are added up
+# The average is the sum over the count, because AVG of compact amounts would be in cents
+def raw_summary(db, user_id, start_date, end_date):
+    results = [db.execute(select(
+        func.min(table.c.transaction_amount),
+        func.max(table.c.transaction_amount),
+        func.sum(table.c.transaction_amount),
+        func.count(table.c.transaction_amount),
+    ).where(
+        table.c.user_id == user_id,
+        table.c.timestamp >= start_date,
+        table.c.timestamp <= end_date,
+    )).first() for table in partitions.tables(db, start_date, end_date)]
+    results = [result for result in results if result[3]]
+    total = sum(result[2] for result in results)
+    count = sum(result[3] for result in results)
+    return {
+        "user_id": user_id,
+        "min_transaction_amount": min((result[0] for result in results), default=0),
+        "max_transaction_amount": max((result[1] for result in results), default=0),
+        "average_transaction_amount": total / count if count else 0,
+    }
+
+# This builds a DataFrame of transactions for one user
+def make_frame(ids, user_ids, timestamps, amounts):
+    return pd.DataFrame({
+        "transaction_id": ids,
+        "user_id": user_ids,
+        "product_id": [1] * len(ids),
+        "timestamp": pd.to_datetime(timestamps),
+        "transaction_amount": amounts,
+    })
+
+RANGES = [
+    (datetime(2022, 3, 1), datetime(2022, 3, 31)),
+    (datetime(2022, 3, 2), datetime(2022, 3, 4)),
+    (datetime(2022, 3, 2, 6, 0), datetime(2022, 3, 4, 12, 0)),
+    (datetime(2022, 3, 2, 9, 0), datetime(2022, 3, 2, 23, 0)),
+    (datetime(2022, 3, 3), datetime(2022, 3, 3, 23, 59, 59, 999999)),
+    (datetime(2022, 3, 4, 0, 0), datetime(2022, 3, 4, 0, 0)),
+]
+
+# This test checks that rollup based summaries equal raw summaries for whole and partial days
+# expected: identical results for every range
+@pytest.mark.parametrize("start_date,end_date", RANGES)
+def test_rollup_matches_raw_query(start_date, end_date):
+    db = session()
+    user_id = 800000 + RANGES.index((start_date, end_date))
+    timestamps = ["2022-03-02 08:00:00", "2022-03-02 18:30:00", "2022-03-03 00:00:00",
+                  "2022-03-03 23:59:59", "2022-03-04 00:00:00", "2022-03-04 15:00:00"]
+    ids = [str(uuid.uuid4()) for _ in timestamps]
+    ingest.bulk_upsert(db, make_frame(ids, [user_id] * 6, timestamps, [10.0, 2.5, 7.25, 100.0, 0.5, 42.0]))
+    db.commit()
+    
+    assert get_CSV_summary(db, user_id, start_date, end_date) == raw_summary(db, user_id, start_date, end_date)
+    db.close()
+
+# This test checks that an upsert which moves a transaction updates both the old and new day
+# expected: the old day's rollup loses the row and the new user's day gains it
+def test_rollup_follows_moved_transactions():
+    db = session()
+    # Fresh user ids are used so rows left by earlier test runs do not change the rollup
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    other_user_id = user_id + 1
+    ids = [str(uuid.uuid4()) for _ in range(2)]
+    ingest.bulk_upsert(db, make_frame(ids, [user_id] * 2, ["2022-04-01 10:00:00", "2022-04-01 11:00:00"], [5.0, 15.0]))
+    ingest.bulk_upsert(db, make_frame(ids[1:], [other_user_id], ["2022-04-05 10:00:00"], [20.0]))
+    db.commit()
+    
+    rollups = db.query(DailyRollup).filter(DailyRollup.user_id.in_([user_id, other_user_id])).all()
+    assert sorted((r.user_id, r.day.isoformat(), r.transaction_count, r.total_amount) for r in rollups) == [
+        (user_id, "2022-04-01", 1, 5.0),
+        (other_user_id, "2022-04-05", 1, 20.0),
+    ]
+    
+    start_date, end_date = datetime(2022, 4, 1), datetime(2022, 4, 30)
+    for uid in (user_id, other_user_id):
+        assert get_CSV_summary(db, uid, start_date, end_date) == raw_summary(db, uid, start_date, end_date)
+    db.close()
+
+# This test checks that each user's month is stored as one packed sketch, across uploads to the same month
+# expected: one row per month whose bins and counts match the amounts binned by numpy
+def test_sketch_is_one_row_per_month():
+    db = session()
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    amounts = [1.0, 1.0, 2.5, 99.99, 0.0, 1000.0]
+    timestamps = ["2022-05-01 10:00:00", "2022-05-02 10:00:00", "2022-05-31 23:00:00",
+                  "2022-06-01 00:00:00", "2022-05-15 12:00:00", "2022-05-20 08:00:00"]
+    ingest.bulk_upsert(db, make_frame([str(uuid.uuid4()) for _ in amounts[:3]], [user_id] * 3, timestamps[:3], amounts[:3]))
+    ingest.bulk_upsert(db, make_frame([str(uuid.uuid4()) for _ in amounts[3:]], [user_id] * 3, timestamps[3:], amounts[3:]))
+    db.commit()
+    
+    rows = db.query(AmountSketch).filter(AmountSketch.user_id == user_id).order_by(AmountSketch.month).all()
+    assert [row.month.isoformat() for row in rows] == ["2022-05-01", "2022-06-01"]
+    may = [amount for amount, timestamp in zip(amounts, timestamps) if timestamp.startswith("2022-05")]
+    assert sketch.unpack([(rows[0].bins, rows[0].counts)]) == pd.Series(sketch.bins_of(may)).value_counts().to_dict()
+    assert sketch.unpack([(row.bins, row.counts) for row in rows])[sketch.bins_of([99.99])[0]] == 1
+    db.close()
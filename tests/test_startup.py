@@ -0,0 +1,57 @@
+"""
+This file contains the test cases for the application startup.
+It tests that importing main.py neither creates the tables nor imports pandas, that the
+server's lifespan prepares a new database, that pandas is only loaded by the first upload
+(or the first summary with SUMMARY_BACKEND=parquet),
+and that the optional prewarm opens the read pool's connections.
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+import database
+import startup
+import summary
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# The steps of a cold start, run in a new process as main.py is only imported once per process
+COLD_START = """
+import io, sys
+from sqlalchemy import inspect
+import main
+from fastapi.testclient import TestClient
+
+assert inspect(main.database.dbengine).get_table_names() == [], "tables created on import"
+assert "pandas" not in sys.modules and "pyarrow" not in sys.modules, "pandas imported with main"
+with TestClient(main.app) as client:
+    assert "transactions" in inspect(main.database.dbengine).get_table_names(), "tables not created at startup"
+    response = client.get("/summary/1", params={"start_date": "2023-01-01", "end_date": "2023-12-31"})
+    assert response.status_code == 200, response.text
+    # pyarrow.dataset imports pandas, so a summary read from the Parquet dataset loads both
+    assert ("pandas" in sys.modules) == main.columnar.ENABLED, "pandas imported by a summary"
+    csv_content = "transaction_id,user_id,product_id,timestamp,transaction_amount\\nabc,1,2,2023-02-01 10:00:00,5.0\\n"
+    response = client.post("/upload/", files={"file": ("test.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+    assert response.status_code == 200, response.text
+    assert "pandas" in sys.modules
+print("ok")
+"""
+
+# This test checks a cold start in a new process with a new database
+# expected: no tables and no pandas after importing main, the tables created when the server starts,
+# summaries answered without pandas (unless they are read from Parquet), and pandas loaded by the first upload
+def test_cold_start_is_lazy(tmp_path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path}/cold.db")
+    env.pop("DATABASE_READ_URL", None)
+    result = subprocess.run([sys.executable, "-c", COLD_START], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert result.stdout.strip().endswith("ok")
+
+# This test checks the prewarm of the read path
+# expected: the read pool's connections are opened and left in the pool, and summaries still work afterwards
+def test_prewarm_opens_read_connections():
+    startup.prewarm()
+
+    assert database.reader_engine.pool.checkedin() >= database.DATABASE_POOL_SIZE
+    with database.read_session() as db:
+        assert summary.get_CSV_summary(db, startup.PREWARM_USER_ID, *startup.PREWARM_RANGE)["average_transaction_amount"] == 0
@@ -0,0 +1,74 @@
+"""
+This file contains the test cases for the storage layouts of the transactions table.
+It tests that the compact column types and the staging helpers store the same values and read
+them back unchanged, that a database cannot be opened with the other layout, and that the
+ingest, rollup and summary tests also pass with the compact layout.
+"""
+import os
+import subprocess
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+import migrations
+import storage
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# This test checks that compact ids are staged the way the column type binds them and read back as uploaded
+# expected: canonical UUIDs become 16 bytes, other ids stay text, and every id reads back unchanged
+def test_compact_ids_round_trip():
+    canonical = str(uuid.uuid4())
+    ids = [canonical, canonical.upper(), "12345", "not-a-uuid"]
+    column_type = storage.CompactId()
+
+    staged = storage.compact_ids(pd.Series(ids))
+
+    assert staged == [column_type.process_bind_param(value, None) for value in ids]
+    assert staged[0] == uuid.UUID(canonical).bytes
+    assert staged[1:] == ids[1:]
+    assert [column_type.process_result_value(value, None) for value in staged] == ids
+
+# This test checks that timestamps and amounts are staged the way the column types bind them
+# expected: epoch microseconds and cents that read back as the original values
+def test_compact_timestamps_and_amounts_round_trip():
+    timestamps = [datetime(2023, 1, 1, 12, 0, 0), datetime(1999, 12, 31, 23, 59, 59, 999999)]
+    amounts = [50.0, 0.1, 19.99, 1234567.89]
+    timestamp_type, amount_type = storage.EpochMicros(), storage.Cents()
+
+    staged_timestamps = storage.epoch_micros(pd.Series(pd.to_datetime(timestamps)))
+    staged_amounts = storage.cents(pd.Series(amounts))
+
+    assert staged_timestamps == [timestamp_type.process_bind_param(value, None) for value in timestamps]
+    assert [timestamp_type.process_result_value(value, None) for value in staged_timestamps] == timestamps
+    assert staged_amounts == [5000, 10, 1999, 123456789]
+    assert [amount_type.process_result_value(value, None) for value in staged_amounts] == amounts
+
+# This test checks that a database made with the standard layout is not opened with the compact one
+# expected: a RuntimeError naming the layout the database was created with
+def test_other_layout_is_refused(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/standard.db")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE transactions (id INTEGER PRIMARY KEY, transaction_id VARCHAR)")
+    monkeypatch.setattr(storage, "TRANSACTION_STORAGE", "compact")
+    monkeypatch.setattr(storage, "COMPACT", True)
+
+    with pytest.raises(RuntimeError, match="TRANSACTION_STORAGE=standard"):
+        migrations.upgrade(engine)
+    engine.dispose()
+
+# This test runs the ingest, rollup, summary and export tests again with the compact layout in a new database
+# The layout is chosen when models.py is imported, so they run in a separate pytest process
+# expected: every test passes
+@pytest.mark.skipif(storage.COMPACT, reason="the whole suite is already running with the compact layout")
+def test_compact_layout_passes_summary_tests(tmp_path):
+    env = dict(os.environ, TRANSACTION_STORAGE="compact", DATABASE_URL=f"sqlite:///{tmp_path}/compact.db")
+    result = subprocess.run(
+        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider",
+         "tests/test_ingest.py", "tests/test_rollup.py", "tests/test_summary.py", "tests/test_export.py"],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stdout[-3000:]
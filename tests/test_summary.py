@@ -3,7 +3,18 @@ This file contains tests for the summary endpoint of the FastAPI application.
 It tests the functionality of the summary endpoint, ensuring that it correctly
 returns transaction summaries for a user within a specified date range.
 """
+import asyncio
+import io
+import json
+import uuid
+import numpy as np
+import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
+import cache
+import database
+import main
+import summaryresponse
 from main import app
 
 # This sets up a test client for the FastAPI application
@@ -75,4 +86,164 @@ def test_summary_valid_request():
         "end_date": "2023-12-31"
     })
     # It checks if the response status code is 200 (OK)
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+# This test checks that the batch summary returns every requested user in order
+# expected: HTTP 200 status code, one summary per user, and zeros for users without transactions
+def test_batch_summary_matches_single_summaries():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    header = "transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+    rows = (f"{uuid.uuid4()},{user_id},1,2023-03-01 10:00:00,10.0\n"
+            f"{uuid.uuid4()},{user_id},1,2023-03-05 23:00:00,20.0\n"
+            f"{uuid.uuid4()},{user_id + 1},1,2023-03-03 12:00:00,5.0\n")
+    client.post("/upload/", files={"file": ("batch.csv", io.BytesIO((header + rows).encode()), "text/csv")})
+    params = {"start_date": "2023-03-01T06:00:00", "end_date": "2023-03-05"}
+    user_ids = [user_id + 2, user_id, user_id + 1, user_id]
+    
+    response = client.post("/summary/batch", json={"user_ids": user_ids, **params})
+    
+    assert response.status_code == 200
+    expected = [client.get(f"/summary/{uid}", params=params).json() for uid in [user_id + 2, user_id, user_id + 1]]
+    assert response.json() == expected
+    assert response.json()[0]["average_transaction_amount"] == 0
+
+# This test checks that the batch summary can be streamed as NDJSON
+# expected: one JSON summary per line, with the same values and types as the JSON list
+def test_batch_summary_ndjson():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    request = {"user_ids": [1, 2, user_id], "start_date": "2023-01-01", "end_date": "2023-12-31"}
+    response = client.post("/summary/batch", params={"format": "ndjson"}, json=request)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["user_id"] for line in lines] == [1, 2, user_id]
+    assert lines == client.post("/summary/batch", json=request).json()
+    assert all(isinstance(line["average_transaction_amount"], float) for line in lines)
+
+# This test checks that the batch summary needs either user_ids or all_users
+# expected: HTTP 400 status code and an error message
+def test_batch_summary_requires_users():
+    response = client.post("/summary/batch", json={"start_date": "2023-01-01", "end_date": "2023-12-31"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Provide user_ids or set all_users."}
+
+# This test checks that all_users returns only users with transactions in the range
+# expected: HTTP 200 status code and summaries sorted by user_id
+def test_batch_summary_all_users():
+    response = client.post("/summary/batch", json={"all_users": True, "start_date": "2023-01-01", "end_date": "2023-12-31"})
+    assert response.status_code == 200
+    user_ids = [item["user_id"] for item in response.json()]
+    assert user_ids == sorted(user_ids)
+
+# This test checks the extra statistics and the percentiles from the quantile sketches
+# expected: exact count, total and standard deviation, and percentiles within 1% of the true values
+def test_summary_extra_statistics():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    amounts = [float(value) for value in range(1, 201)]
+    header = "transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+    rows = "".join(f"{uuid.uuid4()},{user_id},1,2023-0{1 + i % 3}-{1 + i % 28:02d} 10:00:00,{amount}\n" for i, amount in enumerate(amounts))
+    client.post("/upload/", files={"file": ("stats.csv", io.BytesIO((header + rows).encode()), "text/csv")})
+    
+    response = client.get(f"/summary/{user_id}", params={"start_date": "2023-01-01T05:00:00", "end_date": "2023-12-31", "stats": "true"})
+    
+    assert response.status_code == 200
+    body = response.json()
+    assert body["transaction_count"] == 200
+    assert body["total_transaction_amount"] == sum(amounts)
+    assert body["std_transaction_amount"] == pytest.approx(np.std(amounts))
+    for name, quantile in {"p50": 0.5, "p95": 0.95, "p99": 0.99}.items():
+        expected = np.quantile(amounts, quantile, method="lower")
+        assert body[f"{name}_transaction_amount"] == pytest.approx(expected, rel=0.01)
+
+# This test checks the time series returned with a bucket
+# expected: one entry per month with that month's count and total
+def test_summary_monthly_series():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    header = "transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+    rows = (f"{uuid.uuid4()},{user_id},1,2023-01-31 23:00:00,10.0\n"
+            f"{uuid.uuid4()},{user_id},1,2023-02-01 01:00:00,20.0\n"
+            f"{uuid.uuid4()},{user_id},1,2023-02-15 12:00:00,40.0\n")
+    client.post("/upload/", files={"file": ("series.csv", io.BytesIO((header + rows).encode()), "text/csv")})
+    
+    response = client.get(f"/summary/{user_id}", params={"start_date": "2023-01-15", "end_date": "2023-02-15T12:00:00", "bucket": "month"})
+    
+    assert response.status_code == 200
+    series = response.json()["series"]
+    assert [(item["bucket_start"], item["transaction_count"], item["total_transaction_amount"]) for item in series] == [
+        ("2023-01-01", 1, 10.0),
+        ("2023-02-01", 2, 60.0),
+    ]
+    assert "transaction_count" not in response.json()
+
+# This test checks that the plain summary response is unchanged
+# expected: only the four original fields
+def test_summary_default_fields():
+    response = client.get("/summary/1", params={"start_date": "2023-01-01", "end_date": "2023-12-31"})
+    assert set(response.json()) == {"user_id", "min_transaction_amount", "max_transaction_amount", "average_transaction_amount"}
+
+# This test checks ranges that reach the first and last moment a datetime can hold
+# expected: HTTP 200 status code and the user's transactions summarised, with and without stats
+def test_summary_range_to_datetime_limits():
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    header = "transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+    rows = (f"{uuid.uuid4()},{user_id},1,2023-03-01 10:00:00,10.0\n"
+            f"{uuid.uuid4()},{user_id},1,2023-03-05 23:00:00,20.0\n")
+    client.post("/upload/", files={"file": ("limits.csv", io.BytesIO((header + rows).encode()), "text/csv")})
+    
+    for start_date, end_date in (
+        ("2023-01-01", "9999-12-31T23:59:59.999999"),
+        ("0001-01-01", "2023-12-31"),
+        ("0001-01-01T00:00:01", "9999-12-31T12:00:00"),
+    ):
+        params = {"start_date": start_date, "end_date": end_date}
+        response = client.get(f"/summary/{user_id}", params=params)
+        assert response.status_code == 200
+        assert response.json()["average_transaction_amount"] == 15.0
+        response = client.get(f"/summary/{user_id}", params={**params, "stats": "true", "bucket": "month"})
+        assert response.status_code == 200
+        assert response.json()["transaction_count"] == 2
+        response = client.post("/summary/batch", json={"user_ids": [user_id], **params})
+        assert response.json()[0]["max_transaction_amount"] == 20.0
+    for start_date, end_date in (("9999-12-31T06:00:00", "9999-12-31T23:59:59.999999"), ("0001-01-01", "0001-01-01T05:00:00")):
+        response = client.get(f"/summary/{user_id}", params={"start_date": start_date, "end_date": end_date, "stats": "true"})
+        assert response.status_code == 200
+        assert response.json()["transaction_count"] == 0
+
+# This builds a client for an app with only the async summary endpoint, reading through its own async engine
+def async_summary_client(engine):
+    async_app = FastAPI()
+    async_app.get("/summary/{user_id}", response_model=summaryresponse.summaryResponse, response_model_exclude_none=True)(
+        main.get_CSV_summary_async
+    )
+    sessions = database.async_sessionmaker_for(engine)
+    
+    async def override():
+        async with sessions() as db:
+            yield db
+    async_app.dependency_overrides[main.get_async_read_database] = override
+    return TestClient(async_app)
+
+# This test checks that the async summary endpoint answers the same as the sync one
+# expected: identical responses for plain summaries and for stats with a monthly series
+def test_async_summary_matches_sync():
+    pytest.importorskip("aiosqlite")
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    header = "transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+    rows = "".join(f"{uuid.uuid4()},{user_id},1,2023-0{1 + i % 3}-1{i % 9} 10:00:00,{i * 1.5}\n" for i in range(30))
+    client.post("/upload/", files={"file": ("async.csv", io.BytesIO((header + rows).encode()), "text/csv")})
+    
+    engine = database.create_async_reader_engine(database.async_url(database.DATABASE_READ_URL))
+    with async_summary_client(engine) as async_client:
+        for params in (
+            {"start_date": "2023-01-01", "end_date": "2023-12-31"},
+            {"start_date": "2023-01-12T06:00:00", "end_date": "2023-03-15", "stats": "true", "bucket": "month"},
+        ):
+            # The summary cache is cleared so both answers are computed
+            cache.summary_cache.clear()
+            expected = client.get(f"/summary/{user_id}", params=params)
+            cache.summary_cache.clear()
+            response = async_client.get(f"/summary/{user_id}", params=params)
+            assert response.status_code == 200
+            assert response.json() == expected.json()
+        assert async_client.get(f"/summary/{user_id}", params={"start_date": "2023-12-31", "end_date": "2023-01-01"}).status_code == 400
+    asyncio.run(engine.dispose())
@@ -5,13 +5,29 @@ contains the required columns, and handles various error cases.
 """
 from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from datetime import datetime
 from pathlib import Path
 from main import app
+from database import session
+from sqlalchemy import select
+import columnar
+import gzip
+import ingest
 import io
+import partitions
+import pytest
+import sys
+import uuid
 
 # This sets up a test client for the FastAPI application
 client = TestClient(app)
 
+# This returns the stored rows whose column is one of the values, read from every month's table
+# when the transactions are partitioned by month, or from the transactions table when they are not
+def stored_rows(db, column, values):
+    return [row for table in partitions.tables(db, datetime.min, datetime.max)
+            for row in db.execute(select(table).where(table.c[column].in_(values)))]
+
 # This test checks if the file upload endpoint works correctly
 # Expected: HTTP 200 status code and a success message
 def test_upload_file():
@@ -27,8 +43,13 @@ def test_upload_file():
         response = client.post("/upload/", files={"file": ("test_upload.csv", file, "text/csv")})
         
     # Check if the response status code is 200 and the message is as expected
+    # The rows may already be stored from an earlier run, so they can count as inserted, updated or unchanged
     assert response.status_code == 200
-    assert response.json() == {"message": "Data saved succesfully."}
+    body = response.json()
+    assert body["message"] == "Data saved succesfully."
+    assert body["rows_written"] == 2
+    assert body["inserted"] + body["updated"] + body["unchanged"] == 2
+    assert [(file["filename"], file["rows_written"]) for file in body["files"]] == [("test_upload.csv", 2)]
 
 # This test checks if the uploaded file is a valid CSV file
 # Expected: HTTP 400 status code and an error message
@@ -142,4 +163,187 @@ def test_performance_large_file():
 
     
     
-    
\ No newline at end of file
+    
+# This test checks that a file larger than one chunk is streamed and fully saved
+# Expected: HTTP 200 status code and every row saved
+def test_upload_streams_in_chunks(monkeypatch):
+    # The chunk size is made tiny so the upload is split into several chunks
+    monkeypatch.setattr(ingest, "UPLOAD_CHUNK_ROWS", 2)
+    ids = [str(uuid.uuid4()) for _ in range(5)]
+    rows = "".join(f"{tid},700001,200,2023-01-01 12:00:00,{i}.5\n" for i, tid in enumerate(ids))
+    csv_content = "transaction_id,user_id,product_id,timestamp,transaction_amount\n" + rows
+    
+    response = client.post("/upload/", files={"file": ("chunked.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+    
+    assert response.status_code == 200
+    db = session()
+    assert len(stored_rows(db, "transaction_id", ids)) == 5
+    db.close()
+
+# This test checks that an invalid row in a later chunk discards the earlier chunks
+# Expected: HTTP 400 status code and nothing from the file saved
+def test_upload_invalid_later_chunk_saves_nothing(monkeypatch):
+    monkeypatch.setattr(ingest, "UPLOAD_CHUNK_ROWS", 2)
+    ids = [str(uuid.uuid4()) for _ in range(5)]
+    rows = "".join(f"{tid},700002,200,2023-01-01 12:00:00,10.0\n" for tid in ids[:4])
+    rows += f"{ids[4]},non_integer,200,2023-01-01 12:00:00,10.0\n"
+    csv_content = "transaction_id,user_id,product_id,timestamp,transaction_amount\n" + rows
+    
+    response = client.post("/upload/", files={"file": ("bad_chunk.csv", io.BytesIO(csv_content.encode()), "text/csv")})
+    
+    assert response.status_code == 400
+    assert response.json() == {"detail": "user_id must be integers."}
+    db = session()
+    assert len(stored_rows(db, "transaction_id", ids)) == 0
+    db.close()
+
+
+# This builds the content of a small upload with new transaction ids for the given user
+def make_rows(user_id, count):
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    rows = "".join(f"{tid},{user_id},200,2023-01-01 12:00:00,{i}.5\n" for i, tid in enumerate(ids))
+    return ids, ("transaction_id,user_id,product_id,timestamp,transaction_amount\n" + rows).encode()
+
+# This test checks that a gzip compressed upload is decompressed and saved
+# Expected: HTTP 200 status code and every row saved
+def test_upload_gzip_file(monkeypatch):
+    monkeypatch.setattr(ingest, "UPLOAD_CHUNK_ROWS", 2)
+    ids, content = make_rows(700003, 5)
+    
+    response = client.post("/upload/", files={"file": ("shard.csv.gz", io.BytesIO(gzip.compress(content)), "application/gzip")})
+    
+    assert response.status_code == 200
+    assert response.json()["rows_written"] == 5
+    db = session()
+    assert len(stored_rows(db, "transaction_id", ids)) == 5
+    db.close()
+
+# This test checks that a zstd compressed upload is decompressed and saved
+# Expected: HTTP 200 status code and every row saved
+def test_upload_zstd_file():
+    zstandard = pytest.importorskip("zstandard")
+    ids, content = make_rows(700004, 3)
+    
+    response = client.post("/upload/", files={"file": ("shard.csv.zst", io.BytesIO(zstandard.compress(content)), "application/zstd")})
+    
+    assert response.status_code == 200
+    db = session()
+    assert len(stored_rows(db, "transaction_id", ids)) == 3
+    db.close()
+
+# This test checks a zstd compressed upload when the zstandard package is not installed
+# Expected: HTTP 400 status code and an error message naming the package
+def test_upload_zstd_file_without_zstandard(monkeypatch):
+    # A None entry in sys.modules makes import zstandard raise ImportError
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+
+    response = client.post("/upload/", files={"file": ("shard.csv.zst", io.BytesIO(b"not read"), "application/zstd")})
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Uploading .csv.zst files needs the zstandard package."}
+
+# This test checks that a file that is not really gzip compressed is rejected
+# Expected: HTTP 400 status code and an error message
+def test_upload_corrupt_gzip_file():
+    response = client.post("/upload/", files={"file": ("shard.csv.gz", io.BytesIO(b"not gzip data"), "application/gzip")})
+    
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Uploaded file could not be decompressed."}
+
+# This test checks that several files sent in one request are saved with a count for each file
+# Expected: HTTP 200 status code, the rows of every file saved and the rows saved from each file
+def test_upload_several_files(monkeypatch):
+    monkeypatch.setattr(ingest, "UPLOAD_CHUNK_ROWS", 2)
+    first_ids, first = make_rows(700005, 3)
+    second_ids, second = make_rows(700005, 4)
+    
+    response = client.post("/upload/", files=[
+        ("file", ("day1.csv", io.BytesIO(first), "text/csv")),
+        ("file", ("day2.csv.gz", io.BytesIO(gzip.compress(second)), "application/gzip")),
+    ])
+    
+    assert response.status_code == 200
+    assert response.json()["rows_written"] == 7
+    assert [(file["filename"], file["rows_written"], file["inserted"]) for file in response.json()["files"]] == [
+        ("day1.csv", 3, 3),
+        ("day2.csv.gz", 4, 4),
+    ]
+    db = session()
+    assert len(stored_rows(db, "transaction_id", first_ids + second_ids)) == 7
+    db.close()
+
+# This test checks that an invalid row in one file of a batch means nothing from any file is saved
+# Expected: HTTP 400 status code, an error naming the file and nothing saved
+def test_upload_several_files_invalid_file_saves_nothing():
+    first_ids, first = make_rows(700006, 3)
+    second = ("transaction_id,user_id,product_id,timestamp,transaction_amount\n"
+              f"{uuid.uuid4()},non_integer,200,2023-01-01 12:00:00,10.0\n").encode()
+    
+    response = client.post("/upload/", files=[
+        ("file", ("day1.csv", io.BytesIO(first), "text/csv")),
+        ("file", ("day2.csv", io.BytesIO(second), "text/csv")),
+    ])
+    
+    assert response.status_code == 400
+    assert response.json() == {"detail": "day2.csv: user_id must be integers."}
+    db = session()
+    assert len(stored_rows(db, "transaction_id", first_ids)) == 0
+    db.close()
+
+# This test checks that re-sending an overlapping export only writes the rows that changed
+# Expected: HTTP 200 status codes, then the counts of inserted, updated and unchanged rows
+def test_upload_reports_unchanged_rows():
+    ids, content = make_rows(700007, 4)
+    first = client.post("/upload/", files={"file": ("export.csv", io.BytesIO(content), "text/csv")})
+    assert first.json()["inserted"] == 4
+    
+    # One amount is changed and one new row is added
+    lines = content.decode().splitlines(keepends=True)
+    lines[1] = lines[1].replace(",0.5\n", ",99.5\n")
+    lines.append(f"{uuid.uuid4()},700007,200,2023-01-01 12:00:00,7.5\n")
+    second = client.post("/upload/", files={"file": ("export.csv", io.BytesIO("".join(lines).encode()), "text/csv")})
+    
+    assert second.status_code == 200
+    body = second.json()
+    assert (body["inserted"], body["updated"], body["unchanged"]) == (1, 1, 3)
+    assert body["already_uploaded"] is False
+    db = session()
+    assert stored_rows(db, "transaction_id", ids[:1])[0].transaction_amount == 99.5
+    db.close()
+
+# This test checks an upload whose copy to the Parquet dataset fails after it was committed
+# Expected: HTTP 200 status code, the rows saved and the user's cached summary cleared
+def test_upload_survives_parquet_sync_failure(monkeypatch):
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    params = {"start_date": "2023-01-01", "end_date": "2023-01-31", "stats": "true"}
+    first_ids, first = make_rows(user_id, 2)
+    client.post("/upload/", files={"file": ("first.csv", io.BytesIO(first), "text/csv")})
+    assert client.get(f"/summary/{user_id}", params=params).json()["transaction_count"] == 2
+    def failing_sync(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(columnar, "ENABLED", True)
+    monkeypatch.setattr(columnar, "sync_users", failing_sync)
+    
+    second_ids, second = make_rows(user_id, 3)
+    response = client.post("/upload/", files={"file": ("second.csv", io.BytesIO(second), "text/csv")})
+    
+    assert response.status_code == 200
+    assert response.json()["rows_written"] == 3
+    assert client.get(f"/summary/{user_id}", params=params).json()["transaction_count"] == 5
+
+# This test checks an upload whose removal of the months older than the retention period fails after it was committed
+# Expected: HTTP 200 status code and the rows saved
+def test_upload_survives_retention_failure(monkeypatch):
+    user_id = 10**8 + uuid.uuid4().int % 10**8
+    def failing_retention(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(partitions, "apply_retention", failing_retention)
+    
+    ids, content = make_rows(user_id, 3)
+    response = client.post("/upload/", files={"file": ("rows.csv", io.BytesIO(content), "text/csv")})
+    
+    assert response.status_code == 200
+    assert response.json()["rows_written"] == 3
+    params = {"start_date": "2023-01-01", "end_date": "2023-01-31", "stats": "true"}
+    assert client.get(f"/summary/{user_id}", params=params).json()["transaction_count"] == 3
+
@@ -0,0 +1,86 @@
+"""
+This file contains the test cases for the upload validation.
+It tests that each check reports the right message, the number of rows affected
+and the row offsets of the first violations.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import validation
+
+# This builds a valid DataFrame shaped like a parsed upload
+def make_frame(**overrides):
+    frame = pd.DataFrame({
+        "transaction_id": ["a", "b", "c", "d"],
+        "user_id": [1, 2, 3, 4],
+        "product_id": [10, 20, 30, 40],
+        "timestamp": ["2023-01-01 12:00:00", "2023-01-02", "2023-01-03 08:30:00", "2023-01-04 00:00:00"],
+        "transaction_amount": [5.0, 10.5, 0.0, 99.99],
+    })
+    for column, values in overrides.items():
+        frame[column] = values
+    return frame
+
+# This test checks that a valid frame is returned with converted columns
+# expected: int64 ids, datetime timestamps and float amounts
+def test_valid_frame_is_converted():
+    frame = validation.validate_transactions(make_frame(user_id=[1.0, 2.0, 3.0, 4.0]))
+    assert frame["user_id"].dtype == np.int64
+    assert frame["timestamp"].iloc[1] == pd.Timestamp("2023-01-02")
+    assert frame["transaction_amount"].dtype == np.float64
+
+# This test checks that every violation is reported with its row offsets
+# expected: one issue per problem, in check order, with counts and rows
+def test_report_lists_row_offsets():
+    frame = make_frame(
+        user_id=["1", "x", "3", "2.5"],
+        timestamp=["2023-01-01", "bad", "2023-01-03", "2023-01-04"],
+        transaction_amount=[5.0, -1.0, np.inf, 1.0],
+        transaction_id=["a", "b", "a", "d"],
+    )
+    with pytest.raises(validation.ValidationError) as error:
+        validation.validate_transactions(frame)
+    
+    issues = [(issue.column, issue.count, issue.rows) for issue in error.value.report.issues]
+    assert issues == [
+        ("timestamp", 1, [1]),
+        ("user_id", 2, [1, 3]),
+        ("transaction_amount", 2, [1, 2]),
+        ("transaction_id", 1, [2]),
+    ]
+    assert str(error.value) == "Invalid Timestamp. Use YYYY-MM-DD"
+
+# This test checks that missing values are reported as empty instead of as wrong types
+# expected: the empty user_id is reported once
+def test_missing_values_are_reported():
+    with pytest.raises(validation.ValidationError) as error:
+        validation.validate_transactions(make_frame(user_id=[1, None, 3, 4]))
+    assert str(error.value) == "user_id must not be empty."
+    assert len(error.value.report.issues) == 1
+
+# This test checks that transaction_ids repeated across chunks are found
+# expected: the id from the first chunk is reported in the second chunk
+def test_duplicates_across_chunks():
+    duplicates = validation.DuplicateTracker()
+    validation.validate_transactions(make_frame(), duplicates)
+    second = make_frame(transaction_id=["e", "f", "b", "g"])
+    second.index = second.index + 4
+    with pytest.raises(validation.ValidationError) as error:
+        validation.validate_transactions(second, duplicates)
+    assert error.value.report.issues[0].rows == [6]
+
+# This test checks timestamps written with a UTC offset
+# expected: a file with one offset keeps its wall clock times, a file that mixes offsets is read in UTC
+def test_timestamps_with_offsets_keep_wall_clock():
+    frame = validation.validate_transactions(make_frame(timestamp=[
+        "2023-01-01 12:00:00+02:00", "2023-01-02 00:30:00+02:00", "2023-01-03 08:30:00+02:00", "2023-01-04 23:00:00+02:00",
+    ]))
+    assert frame["timestamp"].dt.tz is None
+    assert frame["timestamp"].iloc[0] == pd.Timestamp("2023-01-01 12:00:00")
+    assert frame["timestamp"].iloc[3] == pd.Timestamp("2023-01-04 23:00:00")
+
+    mixed = validation.validate_transactions(make_frame(timestamp=[
+        "2023-01-01 12:00:00+02:00", "2023-01-02 00:30:00-05:00", "2023-01-03 08:30:00", "2023-01-04 00:00:00",
+    ]))
+    assert mixed["timestamp"].iloc[0] == pd.Timestamp("2023-01-01 10:00:00")
+    assert mixed["timestamp"].iloc[1] == pd.Timestamp("2023-01-02 05:30:00")
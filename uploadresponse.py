@@ -0,0 +1,25 @@
+"""
+This file defines Pydantic models for the upload responses.
+They are kept apart from ingest.py and validation.py, so the upload job status can be
+described without importing pandas, which is only loaded once an upload arrives.
+"""
+from pydantic import BaseModel
+
+# The rows of an upload that were new, that changed a stored row, or that were already stored with the same values
+class MergeCounts(BaseModel):
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+# The number of rows saved from one file of an upload, split into inserted, updated and unchanged rows
+class FileResult(MergeCounts):
+    filename: str
+    rows_written: int = 0
+
+# One problem found in the upload
+# rows holds the 0-based data row offsets (header excluded) of the first violations
+class ValidationIssue(BaseModel):
+    column: str
+    message: str
+    count: int
+    rows: list[int] = []
@@ -0,0 +1,160 @@
+"""
+This file contains the validation of uploaded transaction data.
+Every check works on whole DataFrame columns, so the cost depends on the number of columns
+and not on running Python code for every row.
+Problems are collected into a structured report that lists, for each problem, how many rows
+are affected and the row offsets of the first few of them.
+"""
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+import metrics
+from uploadresponse import ValidationIssue
+
+# The columns every upload must contain
+REQUIRED_COLUMNS = ["transaction_id", "user_id", "product_id", "timestamp", "transaction_amount"]
+
+# Timestamps must be ISO 8601, e.g. YYYY-MM-DD or YYYY-MM-DD HH:MM:SS
+TIMESTAMP_FORMAT = "ISO8601"
+
+# How many row offsets are kept for each problem in the report
+MAX_REPORTED_ROWS = 20
+
+# The largest magnitude an integer column can hold in the database
+INT64_LIMIT = 2**63
+
+
+# The full result of validating an upload
+class ValidationReport(BaseModel):
+    issues: list[ValidationIssue] = []
+
+    @property
+    def ok(self) -> bool:
+        return not self.issues
+
+
+# This error is raised when an upload fails validation
+# Its message is the message of the first problem found
+class ValidationError(ValueError):
+    def __init__(self, report: ValidationReport):
+        super().__init__(report.issues[0].message)
+        self.report = report
+
+
+"""
+This class remembers the transaction_ids seen in earlier chunks of the same upload.
+Only a 64-bit hash of each id is kept in a sorted numpy array, so a 1M row upload needs
+about 8MB instead of a Python set of strings, and lookups are a binary search.
+Each chunk's hashes are sorted on their own, looked up in that order and inserted at the
+positions found, so adding a chunk costs one pass over the array instead of sorting
+everything seen so far.
+"""
+class DuplicateTracker:
+    def __init__(self):
+        self.seen = np.empty(0, dtype=np.uint64)
+
+    # This returns a mask of the ids that already appeared in an earlier chunk, then remembers the new ones
+    def check_and_add(self, ids: pd.Series) -> np.ndarray:
+        hashes = pd.util.hash_pandas_object(ids, index=False).to_numpy()
+        order = np.argsort(hashes)
+        hashes = hashes[order]
+        positions = np.searchsorted(self.seen, hashes)
+        repeated = np.zeros(len(hashes), dtype=bool)
+        if len(self.seen):
+            repeated[order] = self.seen[np.minimum(positions, len(self.seen) - 1)] == hashes
+        self.seen = np.insert(self.seen, positions, hashes)
+        return repeated
+
+
+# This adds an issue to the report for every row selected by the mask
+def _add_issue(report: ValidationReport, frame: pd.DataFrame, column: str, mask, message: str) -> None:
+    mask = np.asarray(mask, dtype=bool)
+    count = int(mask.sum())
+    if count:
+        rows = frame.index.to_numpy()[mask][:MAX_REPORTED_ROWS]
+        report.issues.append(ValidationIssue(column=column, message=message, count=count, rows=rows.tolist()))
+
+
+# This converts a column to int64, or reports the rows that are not whole numbers
+def _integer_column(report: ValidationReport, frame: pd.DataFrame, column: str):
+    values = frame[column]
+    if pd.api.types.is_integer_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.astype("int64")
+
+    # Floats such as 100.0 are accepted, anything else that is not a whole number is reported
+    numeric = pd.to_numeric(values, errors="coerce") if not pd.api.types.is_bool_dtype(values) else None
+    if numeric is None:
+        bad = np.ones(len(values), dtype=bool)
+    else:
+        numbers = numeric.to_numpy(dtype="float64", na_value=np.nan)
+        with np.errstate(invalid="ignore"):
+            bad = ~np.isfinite(numbers) | (np.mod(numbers, 1) != 0) | (np.abs(numbers) >= INT64_LIMIT)
+        bad &= values.notna().to_numpy()
+    _add_issue(report, frame, column, bad, f"{column} must be integers.")
+    # Empty values were already reported, so the column is only converted when it is complete
+    if bad.any() or values.isna().any():
+        return None
+    return numeric.astype("int64")
+
+
+"""
+This function validates one chunk of an upload and returns it with converted columns.
+The checks are: required columns, missing values, timestamp format, integer ids,
+finite and non-negative amounts, and transaction_ids repeated within the file.
+If duplicates is given, transaction_ids are also checked against earlier chunks.
+It raises a ValidationError holding the full report if any check fails.
+"""
+def validate_transactions(frame: pd.DataFrame, duplicates: DuplicateTracker = None) -> pd.DataFrame:
+    report = ValidationReport()
+
+    missing_columns = set(REQUIRED_COLUMNS) - set(frame.columns)
+    if missing_columns:
+        report.issues.append(ValidationIssue(
+            column=", ".join(sorted(missing_columns)),
+            message=f"CSV file is missing required columns: {sorted(missing_columns)}",
+            count=0,
+        ))
+        raise ValidationError(report)
+
+    # Missing values are reported once here, so the later checks only look at filled in values
+    for column in REQUIRED_COLUMNS:
+        _add_issue(report, frame, column, frame[column].isna(), f"{column} must not be empty.")
+
+    # Timestamps are parsed with an explicit format instead of guessing it from the first value
+    # Values with different UTC offsets can only be parsed together by converting them to UTC
+    with metrics.phase("timestamps"):
+        try:
+            timestamps = pd.to_datetime(frame["timestamp"], format=TIMESTAMP_FORMAT, errors="coerce")
+        except ValueError:
+            timestamps = pd.to_datetime(frame["timestamp"], format=TIMESTAMP_FORMAT, errors="coerce", utc=True)
+    _add_issue(report, frame, "timestamp", timestamps.isna() & frame["timestamp"].notna(), "Invalid Timestamp. Use YYYY-MM-DD")
+
+    product_ids = _integer_column(report, frame, "product_id")
+    user_ids = _integer_column(report, frame, "user_id")
+
+    amounts = pd.to_numeric(frame["transaction_amount"], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    with np.errstate(invalid="ignore"):
+        bad_amounts = ~(np.isfinite(amounts) & (amounts >= 0))
+    bad_amounts &= frame["transaction_amount"].notna().to_numpy()
+    _add_issue(report, frame, "transaction_amount", bad_amounts, "transaction_amount must be a finite, non-negative number.")
+
+    transaction_ids = frame["transaction_id"].astype(str)
+    repeated = np.array(transaction_ids.duplicated(keep="first"), dtype=bool)
+    if duplicates is not None:
+        repeated |= duplicates.check_and_add(transaction_ids)
+    _add_issue(report, frame, "transaction_id", repeated, "transaction_id must be unique within the file.")
+
+    if not report.ok:
+        raise ValidationError(report)
+
+    # Timezones are dropped and the wall clock time is kept, as uploads always stored it
+    # A file that mixes offsets was read in UTC above, so its times are the UTC wall clock
+    if getattr(timestamps.dt, "tz", None) is not None:
+        timestamps = timestamps.dt.tz_localize(None)
+    return frame.assign(
+        transaction_id=transaction_ids,
+        user_id=user_ids,
+        product_id=product_ids,
+        timestamp=timestamps,
+        transaction_amount=amounts,
+    )